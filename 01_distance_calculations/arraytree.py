@@ -0,0 +1,1033 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+arraytree.py -- Array-backed representation of phylome trees
+
+Trees are stored as flat NumPy arrays instead of ete3 node objects. Nodes
+are numbered in preorder, so the subtree below node i spans the indices
+[i, i + size[i]) and every parent has a lower index than its children.
+LCAIndex answers MRCA queries between nodes in constant time and
+StatsIndex holds the tree_stats of every subtree. The functions at the end
+of the module mirror the ones in treefuns.py (annotate_tree,
+get_group_mrca, get_groups_mrca, tree_stats and count_dupl_specs) so the
+distance scripts can switch engine without changing their logic.
+
+Requirements:
+ - copy
+ - numpy
+ - ete3
+'''
+
+# Import libraries ----
+import copy
+import numpy as np
+import ete3
+from treefuns import (agrees_first_split, get_moments,
+                      get_segment_moments, TREE_STATS_KEYS)
+
+
+# Evolutionary event codes ----
+EVOLCODES = {'S': 1, 'D': 2}
+EVOLTYPES = {v: k for k, v in EVOLCODES.items()}
+
+
+# Define classes ----
+class ArrayTree:
+    '''
+    Phylogenetic tree stored in flat NumPy arrays
+
+    An ArrayTree behaves as a handle to one of its nodes (top), which is the
+    root of the tree unless it is obtained through node(). Handles share all
+    the arrays, so annotating one of them annotates the whole tree, as it
+    happens with ete3 nodes.
+
+    Attributes:
+        parent (np.ndarray): int32 parent index of each node, -1 for the root
+        brlen (np.ndarray): float64 branch length of each node
+        supports (np.ndarray): float64 support of each node
+        names (np.ndarray): node names
+        species (list): species codes, indexed by the ids in leaf_sp
+        leaf_sp (np.ndarray): int32 species id of each leaf, -1 otherwise
+        evolcode (np.ndarray): int8 event of each node, 0 none, 1 S or 2 D
+        size (np.ndarray): number of nodes of the subtree below each node
+        level (np.ndarray): number of edges from the root to each node
+        depth (np.ndarray): distance from the root to each node
+        preorder (np.ndarray): node indices in preorder
+        postorder (np.ndarray): node indices in postorder
+        is_leaf (np.ndarray): boolean mask of the leaves
+        features (dict): boolean leaf annotations computed by annotate_tree
+    '''
+
+    def __init__(self, parent, brlen, supports, names, species, leaf_sp,
+                 evolcode=None):
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.brlen = np.asarray(brlen, dtype=np.float64)
+        self.supports = np.asarray(supports, dtype=np.float64)
+        self.names = np.asarray(names, dtype=object)
+        self.species = list(species)
+        self.leaf_sp = np.asarray(leaf_sp, dtype=np.int32)
+        if evolcode is None:
+            evolcode = np.zeros(len(self.parent), dtype=np.int8)
+        self.evolcode = np.asarray(evolcode, dtype=np.int8)
+        self.features = dict()
+        self.top = 0
+        self.update()
+
+    def update(self):
+        '''
+        Compute the derived arrays from the parent and branch length arrays
+
+        It has to be called again whenever the topology or the branch
+        lengths are modified.
+        '''
+
+        n = len(self.parent)
+        par = self.parent.tolist()
+        brlen = self.brlen.tolist()
+
+        # Subtree sizes accumulated from the last node to the first one
+        size = [1] * n
+        for i in range(n - 1, 0, -1):
+            size[par[i]] += size[i]
+
+        # Root distances and levels accumulated in preorder
+        depth = [0.0] * n
+        level = [0] * n
+        for i in range(1, n):
+            depth[i] = depth[par[i]] + brlen[i]
+            level[i] = level[par[i]] + 1
+
+        self.size = np.array(size, dtype=np.int32)
+        self.depth = np.array(depth, dtype=np.float64)
+        self.level = np.array(level, dtype=np.int32)
+        self.is_leaf = self.size == 1
+        self.preorder = np.arange(n, dtype=np.int32)
+
+        # Nodes before i in postorder are the preorder predecessors which
+        # are not its ancestors plus its own descendants
+        postrank = self.preorder - self.level + self.size - 1
+        self.postorder = np.empty(n, dtype=np.int32)
+        self.postorder[postrank] = self.preorder
+
+        # Leaves in preorder and number of leaves before each index
+        self.leafidx = np.flatnonzero(self.is_leaf).astype(np.int32)
+        self.leafcum = np.concatenate(([0], np.cumsum(self.is_leaf)))
+        self.name2idx = {name: i for i, name in enumerate(self.names)}
+
+    # Construction ----
+    @classmethod
+    def from_phylotree(cls, tree, spidx=None):
+        '''
+        Convert an ete3 PhyloTree into an ArrayTree
+
+        Args:
+            tree (PhyloTree): ete3 PhyloTree object with a get_species_tag
+            function, its evoltype features are kept if present
+
+            spidx (dict): species code to integer id dictionary, if None the
+            ids are assigned in order of appearance
+
+        Returns:
+            ArrayTree: array representation of the tree below the node
+        '''
+
+        nodes = list(tree.traverse('preorder'))
+        index = {node: i for i, node in enumerate(nodes)}
+
+        if spidx is None:
+            species = list()
+            spidx = dict()
+        else:
+            species = sorted(spidx, key=spidx.get)
+
+        parent = list()
+        leaf_sp = list()
+        evolcode = list()
+        for node in nodes:
+            parent.append(index.get(node.up, -1) if node is not tree else -1)
+            if node.is_leaf():
+                sp = node.species
+                if sp not in spidx:
+                    spidx[sp] = len(species)
+                    species.append(sp)
+                leaf_sp.append(spidx[sp])
+            else:
+                leaf_sp.append(-1)
+            evolcode.append(EVOLCODES.get(getattr(node, 'evoltype', None), 0))
+
+        return cls(parent,
+                   [node.dist for node in nodes],
+                   [node.support for node in nodes],
+                   [node.name for node in nodes],
+                   species, leaf_sp, evolcode)
+
+    def to_phylotree(self):
+        '''
+        Convert the subtree below the handle node into an ete3 PhyloTree
+
+        The species of the leaves and the evoltype of the internal nodes
+        are copied to the new nodes.
+
+        Returns:
+            PhyloTree: ete3 PhyloTree object
+        '''
+
+        nodes = dict()
+        for i in range(self.top, self.top + self.size[self.top]):
+            node = ete3.PhyloTree(sp_naming_function=None)
+            node.name = self.names[i]
+            node.dist = float(self.brlen[i])
+            node.support = float(self.supports[i])
+            if self.is_leaf[i]:
+                node.species = self.species[self.leaf_sp[i]]
+            elif self.evolcode[i]:
+                node.add_feature('evoltype', EVOLTYPES[self.evolcode[i]])
+            if i != self.top:
+                nodes[self.parent[i]].add_child(node)
+            nodes[i] = node
+
+        return nodes[self.top]
+
+    def set_species_index(self, spidx):
+        '''
+        Translate the species ids of the leaves to the ones of a dictionary
+
+        The species missing in the dictionary are added to it, as in
+        from_phylotree.
+
+        Args:
+            spidx (dict): species code to integer id dictionary
+        '''
+
+        for sp in self.species:
+            spidx.setdefault(sp, len(spidx))
+        spmap = np.array([spidx[sp] for sp in self.species] + [-1],
+                         dtype=np.int32)
+        self.leaf_sp = spmap[self.leaf_sp]
+        self.species = sorted(spidx, key=spidx.get)
+
+    def get_descendant_evol_events(self):
+        '''
+        Label the duplication and speciation nodes by species overlap
+
+        As ete3 get_descendant_evol_events (sos_thr=0), the whole tree is
+        labelled from its root: an internal node is a duplication if the
+        species below its two children overlap and a speciation otherwise.
+        The species bitmasks of the nodes are accumulated from the last
+        node to the first one, so the children are merged into their parent
+        in a single pass.
+
+        Returns:
+            np.ndarray: the evolcode array
+
+        Raises:
+            TypeError: if the root or any internal node does not have two
+            children
+        '''
+
+        n = len(self.parent)
+        nchildren = np.bincount(self.parent[1:], minlength=n)
+        if nchildren[0] != 2:
+            raise TypeError('Tree is not rooted')
+        if np.any(nchildren[~self.is_leaf] != 2):
+            raise TypeError('nodes are expected to have two childs.')
+
+        par = self.parent.tolist()
+        leaf_sp = self.leaf_sp.tolist()
+        masks = [0] * n
+        dup = np.zeros(n, dtype=bool)
+        for i in range(n - 1, 0, -1):
+            if leaf_sp[i] >= 0:
+                masks[i] = 1 << leaf_sp[i]
+            if masks[par[i]] & masks[i]:
+                dup[par[i]] = True
+            masks[par[i]] |= masks[i]
+
+        self.evolcode[:] = np.where(dup, EVOLCODES['D'], EVOLCODES['S'])
+        self.evolcode[self.is_leaf] = 0
+
+        return self.evolcode
+
+    # Node handles ----
+    def node(self, idx):
+        '''
+        Get a handle to a node of the tree sharing all the arrays
+
+        Args:
+            idx (int or str): node index or node name
+
+        Returns:
+            ArrayTree: handle whose top is the requested node
+        '''
+
+        handle = copy.copy(self)
+        handle.top = self._idx(idx)
+
+        return handle
+
+    def _idx(self, node):
+        # Translate names and handles to node indices
+        if isinstance(node, ArrayTree):
+            return node.top
+        elif isinstance(node, str):
+            return self.name2idx[node]
+        else:
+            return int(node)
+
+    @property
+    def name(self):
+        return self.names[self.top]
+
+    @property
+    def dist(self):
+        return float(self.brlen[self.top])
+
+    @property
+    def support(self):
+        return float(self.supports[self.top])
+
+    @property
+    def evoltype(self):
+        try:
+            return EVOLTYPES[self.evolcode[self.top]]
+        except KeyError:
+            raise AttributeError('Node %s has no evoltype.' % self.top)
+
+    # Tree queries ----
+    def subtree(self, node=None):
+        '''
+        Get the index range of the subtree below a node
+
+        Args:
+            node (int): node index, the handle node if None
+
+        Returns:
+            tuple: first and last plus one node indices
+        '''
+
+        if node is None:
+            node = self.top
+
+        return node, node + int(self.size[node])
+
+    def get_leaves(self, node=None):
+        '''
+        Get the leaf indices below a node in preorder
+
+        Args:
+            node (int): node index, the handle node if None
+
+        Returns:
+            np.ndarray: leaf indices
+        '''
+
+        start, end = self.subtree(node)
+
+        return self.leafidx[self.leafcum[start]:self.leafcum[end]]
+
+    def get_leaf_names(self, node=None):
+        return self.names[self.get_leaves(node)].tolist()
+
+    def get_species(self, node=None):
+        return set(self.species[sp] for sp in
+                   np.unique(self.leaf_sp[self.get_leaves(node)]))
+
+    def get_species_mask(self, node=None):
+        '''
+        Get the bitmask of the species ids below a node
+
+        Args:
+            node (int): node index, the handle node if None
+
+        Returns:
+            int: species bitmask, bit i set for the species id i
+        '''
+
+        mask = 0
+        for sp in np.unique(self.leaf_sp[self.get_leaves(node)]).tolist():
+            mask |= 1 << sp
+
+        return mask
+
+    def get_children(self, node=None):
+        '''
+        Get the children indices of a node in order
+
+        Args:
+            node (int): node index, the handle node if None
+
+        Returns:
+            list: children indices
+        '''
+
+        start, end = self.subtree(node)
+        children = list()
+        child = start + 1
+        while child < end:
+            children.append(child)
+            child += int(self.size[child])
+
+        return children
+
+    def is_ancestor(self, anc, node):
+        return anc <= node < anc + self.size[anc]
+
+    def get_common_ancestor(self, target, target2):
+        '''
+        Get the most recent common ancestor of two nodes
+
+        Args:
+            target (int, str or ArrayTree): first node
+            target2 (int, str or ArrayTree): second node
+
+        Returns:
+            ArrayTree: handle to the common ancestor
+        '''
+
+        anc = self._idx(target)
+        node = self._idx(target2)
+        while not self.is_ancestor(anc, node):
+            anc = int(self.parent[anc])
+
+        return self.node(anc)
+
+    def get_distance(self, target, target2=None):
+        '''
+        Get the branch length distance between two nodes
+
+        As in ete3, the distance is computed from the handle node when only
+        one target is given.
+
+        Args:
+            target (int, str or ArrayTree): first node
+            target2 (int, str or ArrayTree): second node
+
+        Returns:
+            float: distance between the nodes
+        '''
+
+        if target2 is None:
+            target2 = self.top
+        a = self._idx(target)
+        b = self._idx(target2)
+        anc = self.get_common_ancestor(a, b).top
+
+        return float(self.depth[a] + self.depth[b] - 2 * self.depth[anc])
+
+    def get_farthest_leaf(self, node=None):
+        '''
+        Get the farthest leaf below a node and its distance
+
+        Args:
+            node (int): node index, the handle node if None
+
+        Returns:
+            tuple: farthest leaf handle and its distance to the node
+        '''
+
+        if node is None:
+            node = self.top
+        leaves = self.get_leaves(node)
+        far = leaves[np.argmax(self.depth[leaves])]
+
+        return self.node(far), float(self.depth[far] - self.depth[node])
+
+
+class LCAIndex:
+    '''
+    Constant time MRCA queries over an ArrayTree
+
+    As nodes are numbered in preorder, the MRCA of two different nodes a < b
+    is the parent of the shallowest node in the index range (a, b]. The
+    index keeps a sparse table with the position of the minimum level of
+    every power of two range, so each query compares two precomputed
+    ranges. The speciation and duplication counts below every node are
+    also precomputed, so the pair MRCA type and counts are plain lookups.
+
+    Attributes:
+        tree (ArrayTree): indexed tree
+        table (np.ndarray): sparse table, row k holds the index of the
+        minimum level node in the ranges of length 2 ** k
+        events (dict): S and D counts below every node
+    '''
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.events = get_subtree_events(tree)
+
+        level = tree.level
+        n = len(level)
+        self.table = np.empty((max(n.bit_length(), 1), n), dtype=np.int32)
+        self.table[0] = tree.preorder
+        for k in range(1, len(self.table)):
+            prev = self.table[k - 1]
+            half = 1 << (k - 1)
+            left = prev[:n - half]
+            right = prev[half:]
+            self.table[k, :n - half] = np.where(level[right] < level[left],
+                                                right, left)
+            self.table[k, n - half:] = prev[n - half:]
+
+    def query(self, a, b):
+        '''
+        Get the MRCA of pairs of nodes
+
+        Args:
+            a (int or np.ndarray): first node indices
+            b (int or np.ndarray): second node indices
+
+        Returns:
+            int or np.ndarray: MRCA node indices
+        '''
+
+        a, b = np.minimum(a, b), np.maximum(a, b)
+        same = a == b
+
+        # Shallowest node in (a, b] from two overlapping power of two ranges
+        length = np.where(same, 1, b - a)
+        k = np.floor(np.log2(length)).astype(np.int32)
+        left = self.table[k, a + 1 - same]
+        right = self.table[k, b - (1 << k) + 1]
+        level = self.tree.level
+        shallow = np.where(level[right] < level[left], right, left)
+
+        return np.where(same, a, self.tree.parent[shallow])
+
+    def get_common_ancestor(self, target, target2):
+        return int(self.query(self.tree._idx(target), self.tree._idx(target2)))
+
+    def get_evoltype(self, node):
+        return EVOLTYPES[self.tree.evolcode[node]]
+
+    def count_dupl_specs(self, node):
+        return {'D': int(self.events['D'][node]),
+                'S': int(self.events['S'][node])}
+
+
+class StatsIndex:
+    '''
+    tree_stats of the subtrees below every internal node
+
+    The leaf counts, branch length sums and event counts of every subtree
+    are taken from the preorder ranges and the species sets are accumulated
+    in postorder. The medians and moments come from the values of all the
+    subtrees concatenated and sorted by subtree, so the statistics of any
+    candidate MRCA or normalising clade are a lookup instead of a new
+    traversal. The subtrees are processed in batches of about maxvalues
+    nodes in total to bound the memory.
+
+    Args:
+        tree (ArrayTree): indexed tree
+
+        maxvalues (int): maximum number of subtree nodes in a batch
+
+    Attributes:
+        tree (ArrayTree): indexed tree
+        stats (dict): arrays indexed by node for each TREE_STATS_KEYS key,
+        nan for the leaves
+    '''
+
+    def __init__(self, tree, maxvalues=1000000):
+        self.tree = tree
+        n = len(tree.parent)
+        ends = tree.preorder + tree.size
+
+        self.stats = {k: np.full(n, np.nan) for k in TREE_STATS_KEYS}
+        self.stats['leafno'] = tree.leafcum[ends] - tree.leafcum[tree.preorder]
+
+        # Species sets accumulated in postorder
+        masks = [0] * n
+        for leaf, sp in zip(tree.leafidx.tolist(),
+                            tree.leaf_sp[tree.leafidx].tolist()):
+            masks[leaf] = 1 << sp
+        par = tree.parent.tolist()
+        for i in range(n - 1, 0, -1):
+            masks[par[i]] |= masks[i]
+        self.stats['spno'] = np.array([bin(x).count('1') for x in masks])
+
+        events = get_subtree_events(tree)
+        internal = np.flatnonzero(self.stats['leafno'] > 1)
+        self.stats['S'][internal] = events['S'][internal]
+        self.stats['D'][internal] = events['D'][internal]
+
+        # Batches of subtrees with a bounded number of nodes in total
+        cumsize = np.cumsum(tree.size[internal])
+        batch = cumsize // max(maxvalues, 1)
+        for b in np.unique(batch):
+            self.add_stats(internal[batch == b])
+
+    def add_stats(self, nodes):
+        tree = self.tree
+
+        # Nodes of every subtree, seg is the position of the subtree root
+        sizes = tree.size[nodes]
+        seg = np.repeat(np.arange(len(nodes)), sizes)
+        pos = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes,
+                                                 sizes)
+        pos += nodes[seg]
+        leafm = tree.is_leaf[pos]
+
+        # Root-to-tip distances from each subtree root
+        r2t = tree.depth[pos[leafm]] - tree.depth[nodes[seg[leafm]]]
+        brlens = tree.brlen[pos]
+
+        segstats = dict()
+        segstats['r2t'] = get_segment_moments(r2t, seg[leafm], len(nodes))
+        segstats['brlens'] = get_segment_moments(brlens, seg, len(nodes))
+        segstats['int_brlens'] = get_segment_moments(brlens[~leafm],
+                                                     seg[~leafm], len(nodes))
+        segstats['tip_brlens'] = get_segment_moments(brlens[leafm],
+                                                     seg[leafm], len(nodes))
+        for name, moments in segstats.items():
+            for stat in ['median', 'mean', 'var', 'kurt', 'skew']:
+                self.stats[stat + '_' + name][nodes] = moments[stat]
+
+        supports = get_segment_moments(tree.supports[pos[~leafm]],
+                                       seg[~leafm], len(nodes))
+        treelen = segstats['brlens']['sum']
+        leafno = self.stats['leafno'][nodes]
+        S = self.stats['S'][nodes]
+        D = self.stats['D'][nodes]
+
+        self.stats['mean_bs'][nodes] = supports['mean']
+        self.stats['width'][nodes] = segstats['r2t']['max']
+        self.stats['tree_length'][nodes] = treelen
+        self.stats['tlen_leafno_ratio'][nodes] = treelen / leafno
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.stats['duprate'][nodes] = S / (S + D)
+            self.stats['treeness'][nodes] = np.where(
+                treelen != 0, segstats['int_brlens']['sum'] / treelen, np.nan)
+        self.stats['single_copy'][nodes] = D == 0
+
+    def get_stats(self, node):
+        '''
+        Get the tree_stats dictionary of the subtree below a node
+
+        Args:
+            node (int): node index
+
+        Returns:
+            dictionary: same keys and values as tree_stats on the node
+        '''
+
+        nodedict = dict()
+        nodedict['leafno'] = int(self.stats['leafno'][node])
+        nodedict['spno'] = int(self.stats['spno'][node])
+
+        if nodedict['leafno'] > 1:
+            for k in TREE_STATS_KEYS[2:]:
+                nodedict[k] = self.stats[k][node]
+            nodedict['S'] = int(nodedict['S'])
+            nodedict['D'] = int(nodedict['D'])
+            nodedict['single_copy'] = bool(nodedict['single_copy'])
+            if nodedict['tree_length'] == 0:
+                del nodedict['treeness']
+
+        return nodedict
+
+
+# Define functions ----
+def annotate_tree(tree, key, splist):
+    '''
+    Tree leaves annotation
+
+    The leaves whose species is in the list are marked in a boolean array
+    stored in the tree features under the key.
+
+    Args:
+        tree (ArrayTree): array tree
+
+        key (string): feature name
+
+        splist (list): species belonging to the group
+
+    Returns:
+        int: the input tree is annotated, the function returns 0
+    '''
+
+    spids = [i for i, sp in enumerate(tree.species) if sp in splist]
+    tree.features[key] = tree.is_leaf & np.isin(tree.leaf_sp, spids)
+
+    return 0
+
+
+def get_first_split_sp(tree, node):
+    # Species bitmasks of the first two descendants of the node in levelorder
+    ol = list()
+    queue = tree.get_children(node)
+    while len(ol) < 2:
+        child = queue.pop(0)
+        ol.append(tree.get_species_mask(child))
+        queue += tree.get_children(child)
+
+    return (ol[0], ol[1])
+
+
+def get_split_masks(tree, firstsplit):
+    # Species tree partitions as bitmasks of the tree species ids. Species
+    # absent from the tree do not change the subset checks, so species sets
+    # can be converted with the tree ids, bitmasks have to share them.
+    if isinstance(firstsplit[0], int):
+        return firstsplit
+    else:
+        return tuple(sum(1 << i for i, sp in enumerate(tree.species)
+                         if sp in x) for x in firstsplit)
+
+
+def get_mrca_conditions(tree, sp_in=None):
+    '''
+    Evaluate the group independent conditions of the group MRCAs
+
+    The nodes below the handle node need more than one leaf, not to be the
+    whole tree, a non-zero width, to be a speciation and to contain the
+    sp_in sequence. No node fulfils them if sp_in is not in the tree, as
+    with ete3.
+
+    Args:
+        tree (ArrayTree): array tree handle
+
+        sp_in (string): the name of the sequence that has to be inside the
+        MRCA group
+
+    Returns:
+        tuple: node indices, subtree ends, leaves number and mask of the
+        nodes fulfilling the conditions
+    '''
+
+    start, end = tree.subtree()
+    nodes = np.arange(start, end)
+    ends = nodes + tree.size[start:end]
+
+    # Leaves below each node
+    leafno = tree.leafcum[ends] - tree.leafcum[nodes]
+
+    # Width of each subtree from the deepest leaf in its range
+    par = (tree.parent[start:end] - start).tolist()
+    brlen = tree.brlen[start:end].tolist()
+    width = [0.0] * len(nodes)
+    for i in range(len(nodes) - 1, 0, -1):
+        width[par[i]] = max(width[par[i]], width[i] + brlen[i])
+    width = np.array(width)
+
+    cond = ((leafno > 1) & (leafno != leafno[0]) & (width != 0) &
+            (tree.evolcode[start:end] == EVOLCODES['S']))
+
+    if sp_in is not None:
+        seed = tree.name2idx.get(sp_in)
+        if seed is None:
+            cond[:] = False
+        else:
+            cond &= (nodes <= seed) & (seed < ends)
+
+    return nodes, ends, leafno, cond
+
+
+def select_group_mrca(tree, tree_id, feature, nodes, leafno, cand,
+                      sptspl=None):
+    '''
+    Select the largest candidate node agreeing with the species tree
+
+    Args:
+        tree (ArrayTree): array tree
+
+        tree_id (string): the phylome tree id
+
+        feature (string): the group name
+
+        nodes (np.ndarray): node indices from get_mrca_conditions
+
+        leafno (np.ndarray): leaves number from get_mrca_conditions
+
+        cand (np.ndarray): mask of the candidate nodes
+
+        sptspl (tuple): species tree first split of the group, as species
+        sets or as bitmasks of the tree species ids
+
+    Returns:
+        dictionary: get_group_mrca dictionary, None if there is no group
+    '''
+
+    if sptspl is not None:
+        sptspl = get_split_masks(tree, sptspl)
+
+    # Sorting the candidates by size and then in levelorder
+    start = nodes[0]
+    cand = nodes[cand]
+    cand = cand[np.lexsort((cand, tree.level[cand], -leafno[cand - start]))]
+
+    for node in cand:
+        if sptspl is not None:
+            if not agrees_first_split(get_first_split_sp(tree, node), sptspl):
+                continue
+
+        mphy = dict()
+        mphy['tree'] = tree_id
+        mphy['node'] = tree.node(node)
+        mphy['seq_no'] = int(leafno[node - start])
+        mphy['set_featlist'] = {feature}
+        mphy['sp_no'] = bin(tree.get_species_mask(node)).count('1')
+        mphy['evoltype'] = 'S'
+        mphy[feature] = feature
+
+        return mphy
+
+    return None
+
+
+def get_group_mrca(tree, tree_id, feature, sp_in=None, firstsplit=None):
+    '''
+    Get the greatest monophyletic subtree of a labeled group
+
+    Same conditions as treefuns.get_group_mrca, evaluated over the arrays of
+    the whole tree at once. Ties are solved in levelorder as in ete3.
+
+    Args:
+        tree (ArrayTree): array tree annotated with annotate_tree
+
+        tree_id (string): the phylome tree id
+
+        feature (string): the name of the feature where the MRCA label
+        is stored
+
+        sp_in (string): the name of the sequence that has to be inside the
+        MRCA group
+
+        firstsplit (dict or tuple): species tree first split of the groups
+
+    Returns:
+        dictionary: dictionary with some information about the node and
+        the node handle
+
+    Raises:
+        IndexError: there is no subtree fulfilling the conditions
+    '''
+
+    sptspl = None
+    if firstsplit is not None:
+        if isinstance(firstsplit, tuple):
+            sptspl = firstsplit
+        else:
+            sptspl = firstsplit[feature]
+
+    nodes, ends, leafno, cond = get_mrca_conditions(tree, sp_in)
+
+    # Annotated leaves below each node
+    featcum = np.concatenate(([0], np.cumsum(tree.features[feature])))
+    featno = featcum[ends] - featcum[nodes]
+
+    mphy = select_group_mrca(tree, tree_id, feature, nodes, leafno,
+                             cond & (featno == leafno), sptspl)
+    if mphy is None:
+        raise IndexError('No monophyletic group for %s in %s.' %
+                         (feature, tree_id))
+
+    return mphy
+
+
+def get_groups_mrca(tree, tree_id, event_species, spgroups, sp_in=None,
+                    firstsplit=None, spidx=None):
+    '''
+    Get the greatest monophyletic subtree of every group at once
+
+    Same as treefuns.get_groups_mrca. The leaves group membership is a
+    boolean matrix with one column per group, so the number of leaves of
+    each group below every node comes from a single cumulative sum.
+
+    Args:
+        tree (ArrayTree): array tree
+
+        tree_id (string): the phylome tree id
+
+        event_species (dict): dictionary with the group as key and the
+        species list as value
+
+        spgroups (dict): species group bitmasks from get_group_bitmasks
+
+        sp_in (string): the name of the sequence that has to be inside the
+        MRCA groups
+
+        firstsplit (dict): species tree first split of each group, as species
+        sets or as bitmasks of the tree species ids
+
+        spidx (dict): unused, the tree species ids are set in from_phylotree
+
+    Returns:
+        dictionary: dictionary with the group as key and the get_group_mrca
+        dictionary as value, groups without MRCA are missing
+    '''
+
+    groups = list(event_species)
+    nodes, ends, leafno, cond = get_mrca_conditions(tree, sp_in)
+
+    # Species by group membership matrix expanded to the nodes
+    spmember = np.array([[spgroups.get(sp, 0) >> i & 1 for i in
+                          range(len(groups))] for sp in tree.species],
+                        dtype=bool).reshape(len(tree.species), len(groups))
+    member = spmember[tree.leaf_sp] & tree.is_leaf[:, None]
+    featcum = np.concatenate((np.zeros((1, len(groups)), dtype=np.int64),
+                              np.cumsum(member, axis=0)))
+    featno = featcum[ends] - featcum[nodes]
+    cand = cond[:, None] & (featno == leafno[:, None])
+
+    best = dict()
+    for i, group in enumerate(groups):
+        sptspl = None if firstsplit is None else firstsplit[group]
+        mphy = select_group_mrca(tree, tree_id, group, nodes, leafno,
+                                 cand[:, i], sptspl)
+        if mphy is not None:
+            best[group] = mphy
+
+    return best
+
+
+def tree_stats(tree):
+    '''
+    Get tree branch stats
+
+    Same statistics as treefuns.tree_stats for the subtree below the handle
+    node. The tree is expected to be rooted and to have its evolutionary
+    events computed before the conversion.
+
+    Args:
+        tree (ArrayTree): array tree handle
+
+    Returns:
+        dictionary: dictionary with the tree statistics
+    '''
+
+    start, end = tree.subtree()
+    brlenl = tree.brlen[start:end]
+    leafm = tree.is_leaf[start:end]
+    int_brlenl = brlenl[~leafm]
+    supportl = tree.supports[start:end][~leafm]
+    tip_brlenl = brlenl[leafm]
+    r2t_distl = tree.depth[tree.get_leaves()] - tree.depth[start]
+
+    evolcount = np.bincount(tree.evolcode[start:end], minlength=3)
+    evoltypes = dict()
+    evoltypes['S'] = int(evolcount[EVOLCODES['S']])
+    evoltypes['D'] = int(evolcount[EVOLCODES['D']])
+
+    treelen = brlenl.sum()
+
+    # Generating the output dictionary
+    nodedict = dict()
+    nodedict['leafno'] = len(r2t_distl)
+    nodedict['spno'] = len(np.unique(tree.leaf_sp[tree.get_leaves()]))
+
+    if nodedict['leafno'] > 1:
+        nodedict.update(get_moments({'r2t': r2t_distl,
+                                     'brlens': brlenl,
+                                     'int_brlens': int_brlenl,
+                                     'tip_brlens': tip_brlenl}))
+        nodedict['mean_bs'] = np.mean(supportl)
+        nodedict['width'] = r2t_distl.max()
+        nodedict['tree_length'] = treelen
+        nodedict['tlen_leafno_ratio'] = (nodedict['tree_length'] /
+                                         nodedict['leafno'])
+        nodedict['S'] = evoltypes['S']
+        nodedict['D'] = evoltypes['D']
+        nodedict['duprate'] = evoltypes['S'] / sum(evoltypes.values())
+        if treelen != 0:
+            nodedict['treeness'] = int_brlenl.sum() / treelen
+        if nodedict['D'] == 0:
+            nodedict['single_copy'] = True
+        else:
+            nodedict['single_copy'] = False
+
+    return nodedict
+
+
+def count_dupl_specs(tree):
+    # Events of the internal nodes below the handle node
+    start, end = tree.subtree()
+    evolcount = np.bincount(tree.evolcode[start:end][~tree.is_leaf[start:end]],
+                            minlength=3)
+
+    return {'D': int(evolcount[EVOLCODES['D']]),
+            'S': int(evolcount[EVOLCODES['S']])}
+
+
+def get_subtree_events(tree):
+    '''
+    Count the speciation and duplication nodes below every node
+
+    The counts include the node itself, as count_dupl_specs does, and are
+    taken from prefix sums over the preorder arrays.
+
+    Args:
+        tree (ArrayTree): array tree
+
+    Returns:
+        dict: S and D counts arrays indexed by node
+    '''
+
+    internal = ~tree.is_leaf
+    ends = tree.preorder + tree.size
+
+    cdict = dict()
+    for evtype in ['D', 'S']:
+        evcum = np.cumsum(internal & (tree.evolcode == EVOLCODES[evtype]))
+        evcum = np.concatenate(([0], evcum))
+        cdict[evtype] = evcum[ends] - evcum[tree.preorder]
+
+    return cdict
+
+
+def get_pairwise_lca(tree):
+    '''
+    Get the MRCA of every pair of leaves below the handle node
+
+    Each internal node is assigned to the blocks of leaf pairs that lay in
+    different children subtrees, so every cell of the matrix is written once
+    per side.
+
+    Args:
+        tree (ArrayTree): array tree handle
+
+    Returns:
+        np.ndarray: square matrix with the MRCA node index of each pair of
+        leaves, in the get_leaves order
+    '''
+
+    start, end = tree.subtree()
+    leaves = tree.get_leaves()
+    base = tree.leafcum[start]
+
+    lca = np.empty((len(leaves), len(leaves)), dtype=np.int32)
+    lca[np.diag_indices(len(leaves))] = leaves
+
+    for node in np.flatnonzero(~tree.is_leaf[start:end]) + start:
+        ranges = [(tree.leafcum[child] - base,
+                   tree.leafcum[child + tree.size[child]] - base)
+                  for child in tree.get_children(node)]
+        for i, (lo, hi) in enumerate(ranges):
+            for lo2, hi2 in ranges[i + 1:]:
+                lca[lo:hi, lo2:hi2] = node
+                lca[lo2:hi2, lo:hi] = node
+
+    return lca
+
+
+def get_pairwise_distances(tree, lca=None):
+    '''
+    Get the distance between every pair of leaves below the handle node
+
+    The distances are the root-to-tip depths of both leaves minus twice the
+    depth of their MRCA.
+
+    Args:
+        tree (ArrayTree): array tree handle
+
+        lca (np.ndarray): MRCA matrix from get_pairwise_lca, computed if None
+
+    Returns:
+        np.ndarray: square distances matrix in the get_leaves order
+    '''
+
+    if lca is None:
+        lca = get_pairwise_lca(tree)
+    depth = tree.depth[tree.get_leaves()]
+
+    return depth[:, None] + depth[None, :] - 2 * tree.depth[lca]
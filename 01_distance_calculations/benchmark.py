@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+benchmark.py -- Scaling benchmarks of the tree functions and scripts
+
+The benchmark simulates a phylome of each tree size with
+simulate_phylome.py, from 20 to 2000 leaves by default, and times on each
+of its trees the functions the distance scripts spend their time in:
+read_treeline, tree_stats, get_group_mrca and count_dupl_specs, with each
+tree engine. For the array engine, read_treeline includes the conversion
+of the parsed tree to arrays. The functions are run on the tree rooted by
+the species ages, as get_t2in_dist.py does, and the best time of the
+repeats is kept. Then the distance scripts are run on the phylome of each
+size and their wall time is measured, start and imports included.
+
+The phylomes only depend on the random seed, so two benchmarks with the
+same sizes, seed and species tree time the same trees. The times of each
+tree are written to <prefix>_functions.tsv, the ones of the scripts to
+<prefix>_drivers.tsv, and <prefix>.txt has the median time of each
+function and size, with the slope of log(time) over log(leaves), which is
+the scaling exponent of the function, and the script times. Given the
+prefix of a previous benchmark, the speedup of each function and script
+over it is reported too.
+
+Requirements:
+ - math
+ - os
+ - subprocess
+ - sys
+ - time
+ - numpy
+ - pandas
+ - ete3
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+import math
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from treefuns import read_treeline
+from arraytree import ArrayTree
+from treecache import read_rooted
+from rooting import get_rooting
+from simulate_phylome import write_species_data, simulate_phylome
+from utils import create_folder
+import get_t2in_dist
+import treefuns
+import arraytree
+
+
+# Tree engines ----
+ENGINES = {'ete3': treefuns, 'array': arraytree}
+
+# Benchmarked functions and scripts ----
+FUNCTIONS = ['read_treeline', 'tree_stats', 'get_group_mrca',
+             'count_dupl_specs']
+
+DRIVERS = {'t2t': 'get_t2t_dist.py',
+           't2in': 'get_t2in_dist.py',
+           'all': 'get_all_dist.py'}
+
+SIZES = [20, 50, 100, 200, 500, 1000, 2000]
+
+
+# Define functions ----
+def time_call(func, repeats=3):
+    '''
+    Get the best wall time of a function over some repeats
+
+    Args:
+        func (function): function without arguments
+
+        repeats (int): number of calls
+
+    Returns:
+        float: minimum time of a call in seconds
+    '''
+
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def get_normgroup(event_species):
+    # Clade with the number of species closest to half of the species, so
+    # that its MRCA is found in most trees
+    spno = len(set(sp for spl in event_species.values() for sp in spl))
+    return min(event_species,
+               key=lambda k: abs(len(event_species[k]) - spno / 2))
+
+
+def read_tree(line, engine):
+    # Parsing a tree line as the scripts do with each engine
+    tree = read_treeline(line)
+    if engine == 'array':
+        tree['tree'] = ArrayTree.from_phylotree(tree['tree'])
+
+    return tree
+
+
+def time_functions(line, engine, context, normgroup, repeats=3):
+    '''
+    Time the tree functions on a tree
+
+    Args:
+        line (str): tree line
+
+        engine (str): tree engine (ete3 or array)
+
+        context (dict): species context, as get_t2in_dist.get_context
+        returns it
+
+        normgroup (str): clade of the get_group_mrca calls
+
+        repeats (int): number of calls of each function
+
+    Returns:
+        dict: seed, leaf number and time of each function, NaN for
+        get_group_mrca if the clade MRCA cannot be computed
+    '''
+
+    funcs = ENGINES[engine]
+    times = dict()
+    times['read_treeline'] = time_call(lambda: read_tree(line, engine),
+                                       repeats)
+
+    root_tree, params = get_rooting('species_age', context['sp2agedic'])
+    tree = read_rooted(line, read_treeline, root_tree, 'species_age',
+                       params, engine=engine, spidx=context['spidx'])
+    seed = tree['seed']
+    tree = tree['tree']
+
+    times['tree_stats'] = time_call(lambda: funcs.tree_stats(tree), repeats)
+    times['count_dupl_specs'] = time_call(
+        lambda: funcs.count_dupl_specs(tree), repeats)
+
+    funcs.annotate_tree(tree, 'normalising',
+                        context['event_species'][normgroup])
+    try:
+        funcs.get_group_mrca(tree, seed, 'normalising', seed)
+        times['get_group_mrca'] = time_call(
+            lambda: funcs.get_group_mrca(tree, seed, 'normalising', seed),
+            repeats)
+    except IndexError:
+        times['get_group_mrca'] = np.nan
+
+    return {'seed': seed, 'leafno': len(tree.get_leaves()), **times}
+
+
+def get_driver_cmd(driver, data, engine, threads, oprefix):
+    '''
+    Get the command line of a distance script run
+
+    Args:
+        driver (str): script key in DRIVERS
+
+        data (dict): trees, sptree, cladedf, seedsp and normgroup of the
+        phylome
+
+        engine (str): tree engine
+
+        threads (int): number of processes
+
+        oprefix (str): output prefix of the script
+
+    Returns:
+        list: command line arguments
+    '''
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          DRIVERS[driver])
+    cmd = [sys.executable, script, '-i', data['trees'],
+           '-c', data['cladedf'], '-n', data['normgroup'],
+           '-p', oprefix, '-t', str(threads), '-e', engine, '-r']
+    if driver != 't2t':
+        cmd += ['-s', data['sptree'], '-l', data['seedsp']]
+
+    return cmd
+
+
+def time_driver(cmd, repeats=1):
+    # Best wall time of a script run, its output is discarded
+    return time_call(lambda: subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                                            check=True), repeats)
+
+
+def get_scaling(times):
+    '''
+    Get the median times and the scaling exponent of each function
+
+    Args:
+        times (DataFrame): function times, one row per tree
+
+    Returns:
+        DataFrame: median time of each function, engine and size, and the
+        slope of log(time) over log(leafno) of all their trees
+    '''
+
+    longdf = times.melt(id_vars=['size', 'seed', 'leafno', 'engine'],
+                        value_vars=[x for x in FUNCTIONS if x in times],
+                        var_name='function', value_name='time')
+    longdf = longdf.dropna(subset=['time'])
+    medians = longdf.pivot_table(index=['function', 'engine'],
+                                 columns='size', values='time',
+                                 aggfunc='median')
+
+    slopes = dict()
+    for (func, engine), group in longdf.groupby(['function', 'engine']):
+        group = group[group['time'] > 0]
+        if group['leafno'].nunique() > 1:
+            slopes[(func, engine)] = np.polyfit(np.log(group['leafno']),
+                                                np.log(group['time']), 1)[0]
+    medians['exponent'] = pd.Series(slopes)
+
+    return medians
+
+
+def get_speedups(current, baseline, index):
+    # Baseline over current median times, above 1 when the current run is
+    # faster
+    current = current.groupby(index)['time'].median()
+    baseline = baseline.groupby(index)['time'].median()
+    speedup = (baseline / current).dropna()
+
+    return speedup.unstack('size')
+
+
+def write_summary(ofile, functions, drivers, baseline=None):
+    '''
+    Write the summary of a benchmark
+
+    Args:
+        ofile (str): output text file
+
+        functions (DataFrame): function times, one row per tree
+
+        drivers (DataFrame): script times, one row per size, engine and
+        script
+
+        baseline (str): prefix of a previous benchmark to compare with
+    '''
+
+    with open(ofile, 'w') as handle:
+        handle.write('Function median times (s) by tree size, and scaling '
+                     'exponent\n')
+        handle.write(get_scaling(functions).to_string(
+            float_format='%.3g'))
+        handle.write('\n')
+
+        if not drivers.empty:
+            handle.write('\nScript times (s) by tree size\n')
+            handle.write(drivers.pivot_table(
+                index=['driver', 'engine'], columns='size',
+                values='time').to_string(float_format='%.3g'))
+            handle.write('\n')
+
+        if baseline is not None:
+            basefun = pd.read_csv('%s_functions.tsv' % baseline, sep='\t')
+            longdf = [x.melt(id_vars=['size', 'engine'],
+                             value_vars=[y for y in FUNCTIONS if y in x],
+                             var_name='function', value_name='time')
+                      for x in [functions, basefun]]
+            handle.write('\nFunction speedups over %s\n' % baseline)
+            handle.write(get_speedups(
+                longdf[0], longdf[1],
+                ['function', 'engine', 'size']).to_string(
+                    float_format='%.3g'))
+            handle.write('\n')
+
+            basedrv = '%s_drivers.tsv' % baseline
+            if not drivers.empty and os.path.isfile(basedrv):
+                speedups = get_speedups(drivers,
+                                        pd.read_csv(basedrv, sep='\t'),
+                                        ['driver', 'engine', 'size'])
+                if not speedups.empty:
+                    handle.write('\nScript speedups over %s\n' % baseline)
+                    handle.write(speedups.to_string(float_format='%.3g'))
+                    handle.write('\n')
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-z', '--sizes', dest='sizes',
+                      help='Leaf numbers of the simulated trees.',
+                      metavar='<N1,N2,...>',
+                      default=','.join(str(x) for x in SIZES))
+    parser.add_option('-N', '--trees', dest='treeno',
+                      help='Number of trees of each size.',
+                      metavar='<N>', type='int', default=5)
+    parser.add_option('-s', '--sptree', dest='sptree',
+                      help=('Newick file containing the species tree, a '
+                            'random one is simulated if not given.'),
+                      metavar='<file.nwk>')
+    parser.add_option('-x', '--species', dest='spno',
+                      help='Number of species of the random species tree.',
+                      metavar='<N>', type='int', default=25)
+    parser.add_option('-l', '--seedsp', dest='seedsp',
+                      help=('Species\' code for the seed, the last species '
+                            'of the species tree by default.'),
+                      metavar='<SPECIES>')
+    parser.add_option('-n', '--normgroup', dest='normgroup',
+                      help=('Normalisation group header in the clades '
+                            'dataframe, the clade with about half of the '
+                            'species by default.'),
+                      metavar='<group_column_name>')
+    parser.add_option('-g', '--seed', dest='seed',
+                      help='Random seed of the phylomes.',
+                      metavar='<N>', type='int', default=1)
+    parser.add_option('-e', '--engines', dest='engines',
+                      help='Tree engines to benchmark.',
+                      metavar='<engine1,engine2>', default='ete3,array')
+    parser.add_option('-D', '--drivers', dest='drivers',
+                      help=('Distance scripts to run on each phylome '
+                            '(t2t, t2in or all), none if empty.'),
+                      metavar='<script1,script2,...>', default='t2t,t2in')
+    parser.add_option('-y', '--repeats', dest='repeats',
+                      help=('Number of calls of each function on each tree, '
+                            'the best time is kept.'),
+                      metavar='<N>', type='int', default=3)
+    parser.add_option('-t', '--threads', dest='threads',
+                      help='Number of threads of the distance scripts.',
+                      metavar='<N>', type='int', default=1)
+    parser.add_option('-M', '--ete3-max-leaves', dest='ete3_max_leaves',
+                      help=('Largest tree size the scripts are run on with '
+                            'the ete3 engine, whose tip-to-tip pair loop is '
+                            'quadratic.'),
+                      metavar='<N>', type='int', default=500)
+    parser.add_option('-b', '--baseline', dest='baseline',
+                      help=('Prefix of a previous benchmark to report the '
+                            'speedups over.'),
+                      metavar='<prefix>')
+    parser.add_option('-p', '--prefix', dest='prefix',
+                      help=('Output prefix, the phylomes are written to '
+                            '<prefix>_data and the script outputs to '
+                            '<prefix>_runs.'),
+                      metavar='</path/to/dir/prefix> or <prefix>',
+                      default='benchmark')
+    (options, args) = parser.parse_args()
+
+    prefix = options.prefix
+    sizes = [int(x) for x in options.sizes.split(',')]
+    engines = options.engines.split(',')
+    drivers = [x for x in options.drivers.split(',') if x]
+    for name in engines:
+        if name not in ENGINES:
+            raise ValueError('Unknown engine %s, it must be one of: %s.' %
+                             (name, ', '.join(ENGINES)))
+    for name in drivers:
+        if name not in DRIVERS:
+            raise ValueError('Unknown script %s, it must be one of: %s.' %
+                             (name, ', '.join(DRIVERS)))
+
+    if '/' in prefix:
+        odir = prefix.rsplit('/', 1)[0]
+        create_folder(odir)
+
+    datadir = '%s_data' % prefix
+    rundir = '%s_runs' % prefix
+    create_folder(datadir)
+    create_folder(rundir)
+
+    # Species tree and clades shared by the phylomes of every size
+    data = dict()
+    sptree, data['seedsp'] = write_species_data(
+        os.path.join(datadir, 'synthetic'), options.sptree, options.seedsp,
+        options.spno, options.seed)
+    data['sptree'] = os.path.join(datadir, 'synthetic_sp_tree.nwk')
+    data['cladedf'] = os.path.join(datadir, 'synthetic_node_data.tsv')
+    context = get_t2in_dist.get_context(data['sptree'], data['cladedf'],
+                                        data['seedsp'])
+    data['normgroup'] = options.normgroup
+    if data['normgroup'] is None:
+        data['normgroup'] = get_normgroup(context['event_species'])
+
+    functions = list()
+    runs = list()
+    for size in sizes:
+        data['trees'] = os.path.join(datadir, 'trees_%s.nwk' % size)
+        leafnos = simulate_phylome(sptree, data['seedsp'], data['trees'],
+                                   options.treeno, size, size,
+                                   seed=options.seed + size)
+        print('Size %s: %s trees, %s leaves' % (size, len(leafnos),
+                                                sum(leafnos)))
+
+        with open(data['trees']) as handle:
+            lines = [x.rstrip('\n') for x in handle]
+        for engine in engines:
+            # Warming up the imports and first calls of the engine
+            if size == sizes[0]:
+                time_functions(lines[0], engine, context, data['normgroup'],
+                               1)
+            for line in lines:
+                row = time_functions(line, engine, context,
+                                     data['normgroup'], options.repeats)
+                functions.append({'size': size, 'engine': engine, **row})
+
+        for driver in drivers:
+            for engine in engines:
+                if (engine == 'ete3' and driver != 't2in' and
+                        size > options.ete3_max_leaves):
+                    continue
+                oprefix = os.path.join(rundir, '%s_%s_%s' % (driver, engine,
+                                                             size))
+                cmd = get_driver_cmd(driver, data, engine, options.threads,
+                                     oprefix)
+                runs.append({'size': size, 'driver': driver,
+                             'engine': engine, 'trees': len(leafnos),
+                             'leaves': sum(leafnos),
+                             'time': time_driver(cmd)})
+                print('  %s %s: %.2f s' % (driver, engine,
+                                           runs[-1]['time']))
+
+    functions = pd.DataFrame(functions)
+    functions = functions[['size', 'seed', 'leafno', 'engine'] + FUNCTIONS]
+    functions.to_csv('%s_functions.tsv' % prefix, sep='\t', index=False)
+    runs = pd.DataFrame(runs, columns=['size', 'driver', 'engine', 'trees',
+                                       'leaves', 'time'])
+    runs.to_csv('%s_drivers.tsv' % prefix, sep='\t', index=False)
+
+    write_summary('%s.txt' % prefix, functions, runs, options.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+filter_t2in_dist.py -- Long format and filtering of tip-to-internode distances
+
+The script reads the wide table of get_t2in_dist.py in chunks and writes
+the distances to each group node in a long seed,node,dist,ndist table,
+with the rooting column of the tables of several rooting modes. As in
+distances_filtering.R, the missing distances are removed and only the
+normalised distances up to a quantile are kept.
+
+The quantile is computed in a few passes through the table with bounded
+memory: the values are counted in histograms whose range is narrowed
+around the quantile until the values in the range fit in memory.
+
+Requirements:
+ - numpy
+ - pandas
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+import os
+import numpy as np
+import pandas as pd
+from utils import create_folder, file_exists
+
+
+# Define functions ----
+def iter_long(ifile, chunksize=10000):
+    '''
+    Read the get_t2in_dist.py table in long format
+
+    The node is the prefix of the _dist and _ndist columns before the first
+    underscore. The rooting column of the tables with several rooting
+    modes is kept, so the distances of each rooting stay in their rows.
+
+    Args:
+        ifile (str): get_t2in_dist.py output table
+
+        chunksize (int): number of table rows read at once
+
+    Returns:
+        generator: data frames with the seed, rooting if the table has
+        it, node, dist and ndist columns without missing distances
+    '''
+
+    for chunk in pd.read_csv(ifile, chunksize=chunksize, dtype={'seed': str}):
+        idcols = get_id_columns(chunk.columns)
+        ldfs = list()
+        for suffix in ['_dist', '_ndist']:
+            cols = [x for x in chunk.columns if suffix in x]
+            ldf = chunk.melt(id_vars=idcols, value_vars=cols,
+                             var_name='node', value_name=suffix[1:])
+            ldf['node'] = ldf['node'].str.split('_').str[0]
+            ldfs.append(ldf)
+
+        ldf = ldfs[0].merge(ldfs[1], on=idcols + ['node'])
+
+        yield ldf.dropna()
+
+
+def get_id_columns(columns):
+    # Columns identifying the rows of a table, the rooting mode of the
+    # trees is one of them if they are rooted in several ways
+    if 'rooting' in columns:
+        return ['seed', 'rooting']
+
+    return ['seed']
+
+
+def in_range(values, lo, hi, closed):
+    # Values in [lo, hi] if closed, else in [lo, hi)
+    if closed:
+        return values[(values >= lo) & (values <= hi)]
+    else:
+        return values[(values >= lo) & (values < hi)]
+
+
+def get_quantile(passes, prob, bins=4096, maxvalues=1000000):
+    '''
+    Get a quantile of a stream of values with bounded memory
+
+    The quantile interpolates between the order statistics floor(h) and
+    floor(h) + 1, h = (n - 1) * prob, as R quantile default type. The first
+    pass counts the values and the next ones narrow the range containing
+    both order statistics with histograms, until they fall in different
+    bins or the values in the range fit in memory and are sorted.
+
+    Args:
+        passes (function): function without arguments returning an iterator
+        through arrays of values, it is called once per pass
+
+        prob (float): probability of the quantile
+
+        bins (int): number of bins of the histograms
+
+        maxvalues (int): maximum number of values kept in memory
+
+    Returns:
+        float: the quantile, nan if there are no values
+    '''
+
+    # Counting the values and getting their range
+    count, vmin, vmax = 0, np.inf, -np.inf
+    for values in passes():
+        if len(values) > 0:
+            count += len(values)
+            vmin = min(vmin, values.min())
+            vmax = max(vmax, values.max())
+
+    if count == 0:
+        return np.nan
+
+    h = (count - 1) * prob
+    ranks = [int(np.floor(h)), min(int(np.floor(h)) + 1, count - 1)]
+
+    # Narrowing the range of the order statistics, below is the number of
+    # values under the range
+    below = 0
+    lo, hi, closed = vmin, vmax, True
+    while count > maxvalues and vmin < vmax:
+        edges = np.linspace(vmin, vmax, bins + 1)
+        counts = np.zeros(bins, dtype=np.int64)
+        binmin = np.full(bins, np.inf)
+        binmax = np.full(bins, -np.inf)
+        for values in passes():
+            values = in_range(values, lo, hi, closed)
+            idx = np.searchsorted(edges, values, side='right') - 1
+            idx = np.clip(idx, 0, bins - 1)
+            counts += np.bincount(idx, minlength=bins)
+            np.minimum.at(binmin, idx, values)
+            np.maximum.at(binmax, idx, values)
+
+        # Bins containing the order statistics, consecutive order statistics
+        # in different bins are the largest and smallest values of them
+        cum = below + np.cumsum(counts)
+        first = np.searchsorted(cum, ranks[0], side='right')
+        last = np.searchsorted(cum, ranks[1], side='right')
+        if first != last:
+            x0, x1 = binmax[first], binmin[last]
+            return float(x0 + (h - ranks[0]) * (x1 - x0))
+
+        if first > 0:
+            below = cum[first - 1]
+        if cum[first] - below == count:
+            # The bins cannot split the values closer than the float
+            # resolution
+            break
+        count = cum[first] - below
+
+        lo = edges[first]
+        if first < bins - 1:
+            hi, closed = edges[first + 1], False
+        vmin, vmax = binmin[first], binmax[first]
+
+    if vmin == vmax:
+        return float(vmin)
+
+    # Sorting the values in the range
+    kept = np.concatenate([in_range(values, lo, hi, closed)
+                           for values in passes()])
+    kept.sort()
+    x0 = kept[ranks[0] - below]
+    x1 = kept[ranks[1] - below]
+
+    return float(x0 + (h - ranks[0]) * (x1 - x0))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='ifile',
+                      help='Distances table from get_t2in_dist.py.',
+                      metavar='<file.csv>')
+    parser.add_option('-q', '--quantile', dest='quantile',
+                      help=('Normalised distances quantile, larger distances '
+                            'are removed.'),
+                      metavar='<prob>', type='float', default=0.99)
+    parser.add_option('-k', '--chunksize', dest='chunksize',
+                      help='Number of table rows read at once.',
+                      metavar='<N>', type='int', default=10000)
+    parser.add_option('-p', '--prefix', dest='prefix',
+                      help='Output prefix.',
+                      metavar='</path/to/dir/prefix> or <prefix>',
+                      default='dist_long')
+    parser.add_option('-r', '--redo', dest='redo',
+                      help='Ommit done file and redo.',
+                      action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    ifile = options.ifile
+    prob = options.quantile
+    chunksize = options.chunksize
+    prefix = options.prefix
+    redo = options.redo
+
+    if '/' in prefix:
+        odir = prefix.rsplit('/', 1)[0]
+        create_folder(odir)
+
+    ofile = '%s.csv' % prefix
+
+    if not file_exists(ofile) or redo:
+        # Getting the normalised distances quantile
+        def passes():
+            return (ldf['ndist'].to_numpy(dtype=float)
+                    for ldf in iter_long(ifile, chunksize))
+
+        qndist = get_quantile(passes, prob)
+        print('Normalised distances %s quantile: %s' % (prob, qndist))
+
+        # Writing the distances up to the quantile
+        partfile = '%s.part' % ofile
+        header = True
+        for ldf in iter_long(ifile, chunksize):
+            ldf = ldf[ldf['ndist'] <= qndist]
+            ldf.to_csv(partfile, index=False, header=header,
+                       mode='w' if header else 'a')
+            header = False
+        if header:
+            idcols = get_id_columns(pd.read_csv(ifile, nrows=0).columns)
+            pd.DataFrame(columns=idcols + ['node', 'dist', 'ndist']).to_csv(
+                partfile, index=False)
+        os.replace(partfile, ofile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+get_all_dist.py -- Tip-to-tip and tip-to-internode distances in one pass
+
+The script computes the tables of get_t2t_dist.py and get_t2in_dist.py in
+a single pass through the trees, plus a table with the stats of each
+tree. Every tree line is read, screened and parsed once: the parsed tree
+is kept as arrays and each rooting, the species age one of the
+tip-to-internode distances and the midpoint one of the tip-to-tip
+distances, reroots its own handle to them. The rooted trees are then handled by
+the workers of both scripts, and the rows of the three tables are written
+to <prefix>_t2t, <prefix>_t2in and <prefix>_trees.
+
+Requirements:
+ - os
+ - numpy
+ - pandas
+ - ete3
+ - pyarrow (optional, Parquet output)
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+from contextlib import ExitStack
+import os
+from treefuns import TREE_STATS_KEYS
+from arraytree import EVOLCODES
+from utils import create_folder
+from runner import run_pool
+from treestore import TreeStore
+from treecache import get_shared_reader
+from rooting import parse_root_modes
+from profiling import stage, get_profile, write_report
+from shards import get_shard_rows, get_shard_file
+from writers import TREE_BATCH, get_common_done_seeds, read_seeds
+import get_t2t_dist
+import get_t2in_dist
+
+
+# Output tables and columns ----
+TABLES = ['t2t', 't2in', 'trees']
+
+SEEDCOLS = {'t2t': 'tree', 't2in': 'seed', 'trees': 'seed'}
+
+TREES_COLUMNS = (['seed', 'model', 'likelihood'] +
+                 ['tree_' + k for k in TREE_STATS_KEYS] +
+                 ['norm_' + k for k in TREE_STATS_KEYS])
+
+# Columns of the Parquet tables which are not floats
+TYPES = {'t2t': get_t2t_dist.TYPES,
+         't2in': {'seed': 'string', 'rooting': 'string'},
+         'trees': {'seed': 'string', 'model': 'string'}}
+
+
+# Define classes ----
+class dist_process:
+    # Built once per pool process with the contexts of the workers of both
+    # scripts, run() processes one tree line and returns the rows of the
+    # three tables
+    def __init__(self, t2t, t2in, filters=None):
+        self.t2t = get_t2t_dist.dist_process(**t2t)
+        self.t2in = get_t2in_dist.dist_process(**t2in)
+        self.engine = get_t2t_dist.ENGINES[self.t2t.engine]
+        self.filters = filters or dict()
+        self.read = self.t2in.read
+        self.screen = self.t2in.screen
+
+    def run(self, tree_row):
+        # Checking the tree size on the raw newick before parsing it
+        if not self.screen(tree_row, **self.filters):
+            return None
+
+        # Parsing the tree once for all its rootings
+        read = get_shared_reader(self.read)
+        rows = dict()
+
+        # Tip-to-internode distances on the tree rooted by species ages, or
+        # by each rooting mode
+        rows['t2in'] = self.t2in.get_mode_rows(tree_row, read)
+
+        # Tip-to-tip distances and tree stats on the midpoint rooted tree
+        tree = self.t2t.get_tree(tree_row, read)
+        rows['t2t'] = None
+        if self.t2t.screen(tree_row, **self.t2t.filters):
+            rows['t2t'] = self.t2t.get_rows(tree)
+
+        stats = {'seed': tree['seed'],
+                 'model': tree['model'],
+                 'likelihood': tree['likelihood']}
+        with stage('tree_stats'):
+            tree_stats = self.engine.tree_stats(tree['tree'])
+        stats.update({'tree_' + k: v for k, v in tree_stats.items()})
+        if tree.get('norm_stats') is not None:
+            stats.update({'norm_' + k: v for k, v in
+                          tree['norm_stats'].items()})
+        rows['trees'] = [stats]
+
+        return rows
+
+
+# Define functions ----
+def main():
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='ifile',
+                      help=('File with multiple trees in newick, each line has'
+                            ' the format: seed\tmodel\tlikelihood\tnewick,'
+                            ' or a tree store written by treestore.py.'),
+                      metavar='<file.nwk>')
+    parser.add_option('-s', '--sptree', dest='sptree',
+                      help='Newick file containing the species tree.',
+                      metavar='<file.nwk>')
+    parser.add_option('-c', '--clades', dest='cladedf',
+                      help=('Species belonging to clades, columns show the '
+                            'clades and rows the species belonging to them.'),
+                      metavar='<file.tsv>')
+    parser.add_option('-l', '--seedsp', dest='seedsp',
+                      help='Species\' code for the seed.',
+                      metavar='<SPECIES>')
+    parser.add_option('-n', '--normgroup', dest='normgroup',
+                      help='Normalisation group header in clades dataframe.',
+                      metavar='<group_column_name>')
+    parser.add_option('-t', '--threads', dest='threads',
+                      help='Number of threads.',
+                      metavar='<N>', type='int', default=4)
+    parser.add_option('-k', '--chunksize', dest='chunksize',
+                      help='Number of trees sent to a process at once.',
+                      metavar='<N>', type='int', default=8)
+    parser.add_option('-p', '--prefix', dest='prefix',
+                      help='Output prefix.',
+                      metavar='</path/to/dir/prefix> or <prefix>',
+                      default='dist_output')
+    parser.add_option('-r', '--redo', dest='redo',
+                      help='Ommit done file and redo.',
+                      action='store_true', default=False)
+    parser.add_option('-f', '--force', dest='force',
+                      help=('Seeds to compute again, the rest of the trees '
+                            'done in a previous run are kept (file with one '
+                            'seed per line or comma separated seeds).'),
+                      metavar='<seeds.txt>')
+    parser.add_option('-j', '--shard', dest='shard',
+                      help=('Only compute the i-th of N shards of the trees, '
+                            'balanced by their size, written to '
+                            '<prefix>_<table>.<i>of<N>.<format>.'),
+                      metavar='<i/N>')
+    parser.add_option('-S', '--min-species', dest='min_species',
+                      help=('Skip the trees with fewer species, checked '
+                            'before parsing them.'),
+                      metavar='<N>', type='int')
+    parser.add_option('-L', '--max-leaves', dest='max_leaves',
+                      help=('Skip the trees with more leaves, checked before '
+                            'parsing them.'),
+                      metavar='<N>', type='int')
+    parser.add_option('-C', '--max-copies', dest='max_copies',
+                      help=('Skip the trees with at least this mean number of '
+                            'sequences per species, checked before parsing '
+                            'them.'),
+                      metavar='<X>', type='float')
+    parser.add_option('-M', '--t2t-min-species', dest='t2t_min_species',
+                      help=('Only compute the tip-to-tip distances of the '
+                            'trees with at least this number of species.'),
+                      metavar='<N>', type='int', default=11)
+    parser.add_option('-K', '--t2t-max-copies', dest='t2t_max_copies',
+                      help=('Only compute the tip-to-tip distances of the '
+                            'trees with less than this mean number of '
+                            'sequences per species.'),
+                      metavar='<X>', type='float', default=3)
+    parser.add_option('-e', '--engine', dest='engine',
+                      help=('Tree engine: ete3 objects or flat arrays '
+                            '(ete3 or array).'),
+                      metavar='<engine>', type='choice',
+                      choices=list(get_t2t_dist.ENGINES), default='ete3')
+    parser.add_option('-R', '--root-modes', dest='root_modes',
+                      help=('Compute the tip-to-internode distances of each '
+                            'tree rooted by each of these rooting modes '
+                            '(species_age or midpoint), with a rooting '
+                            'column telling the mode of each row. By default '
+                            'the trees are only rooted by the species ages.'),
+                      metavar='<mode1,mode2,...>')
+    parser.add_option('-a', '--cache', dest='cache',
+                      help=('Directory caching the rooted trees and their '
+                            'evolutionary events, shared by the runs of '
+                            'both scripts.'),
+                      metavar='<dir>')
+    parser.add_option('-q', '--seedseq', dest='seedseq',
+                      help=('Only compute the tip-to-tip distances of the '
+                            'pairs with the seed sequence.'),
+                      action='store_true', default=False)
+    parser.add_option('-w', '--seedsp-pairs', dest='seedsp_pairs',
+                      help=('Only compute the tip-to-tip distances of the '
+                            'pairs with a sequence of the seed species.'),
+                      action='store_true', default=False)
+    parser.add_option('-m', '--mrca', dest='mrca',
+                      help=('Only compute the tip-to-tip distances of the '
+                            'pairs whose MRCA is a speciation or a '
+                            'duplication (S or D).'),
+                      metavar='<type>', type='choice',
+                      choices=list(EVOLCODES))
+    parser.add_option('-x', '--species', dest='species',
+                      help=('Only compute the tip-to-tip distances of the '
+                            'pairs whose sequences belong to these species.'),
+                      metavar='<SP1,SP2,...>')
+    parser.add_option('-o', '--format', dest='format',
+                      help='Output tables format (csv or parquet).',
+                      metavar='<format>', type='choice',
+                      choices=list(get_t2t_dist.FORMATS), default='csv')
+    parser.add_option('-d', '--float', dest='floattype',
+                      help=('Type of the float columns in the parquet '
+                            'output (float64 or float32).'),
+                      metavar='<type>', type='choice',
+                      choices=['float64', 'float32'], default='float64')
+    parser.add_option('-P', '--profile', dest='profile',
+                      help=('Profile the stages of each tree and report them '
+                            'with the slowest trees in <prefix>.profile.txt: '
+                            'their wall time, or also their peak memory '
+                            'allocation, which slows them down (time or '
+                            'memory).'),
+                      metavar='<mode>', type='choice',
+                      choices=['time', 'memory'])
+    (options, args) = parser.parse_args()
+
+    ifile = options.ifile
+    cpus = options.threads
+    chunksize = options.chunksize
+    prefix = options.prefix
+    redo = options.redo
+    force = read_seeds(options.force)
+    shard = options.shard
+    engine = options.engine
+    cache = options.cache
+    oformat = options.format
+    if options.root_modes is not None:
+        root_modes = parse_root_modes(options.root_modes)
+    else:
+        root_modes = None
+    store = ifile if os.path.isdir(ifile) else None
+    filters = {'min_species': options.min_species,
+               'max_leaves': options.max_leaves,
+               'max_copies': options.max_copies}
+    t2t_filters = {'min_species': options.t2t_min_species,
+                   'max_copies': options.t2t_max_copies}
+    if options.species is not None:
+        species = set(options.species.split(','))
+    else:
+        species = None
+
+    if '/' in prefix:
+        odir = prefix.rsplit('/', 1)[0]
+        create_folder(odir)
+
+    ofiles = dict()
+    for table in TABLES:
+        ofiles[table] = '%s_%s.%s' % (prefix, table, oformat)
+        if shard is not None:
+            ofiles[table] = get_shard_file(ofiles[table], shard)
+    writer_class = get_t2t_dist.FORMATS[oformat]
+    if oformat == 'parquet':
+        writer_args = {'floattype': options.floattype}
+    else:
+        writer_args = dict()
+
+    # Getting the trees done in all the tables by previous runs
+    done = get_common_done_seeds([(ofiles[x], SEEDCOLS[x], writer_class)
+                                  for x in TABLES], redo, force)
+
+    if done is not None:
+        # Profiling the trees of this run, next to the trees table
+        profile = get_profile(ofiles['trees'], options.profile)
+
+        # Read-only contexts of the workers of both scripts, sent once to
+        # each process of the pool
+        t2in = get_t2in_dist.get_context(options.sptree, options.cladedf,
+                                         options.seedsp)
+        columns = {'t2t': get_t2t_dist.COLUMNS,
+                   't2in': get_t2in_dist.get_columns(t2in['sorted_keys'],
+                                                     root_modes is not None),
+                   'trees': TREES_COLUMNS}
+        t2in.update({'normgroup': options.normgroup,
+                     'engine': engine,
+                     'store': store,
+                     'cache': cache,
+                     'root_modes': root_modes})
+        t2t = {'event_species': t2in['event_species'],
+               'normgroup': options.normgroup,
+               'engine': engine,
+               'seedseq': options.seedseq,
+               'seedsp': options.seedsp_pairs,
+               'mrca': options.mrca,
+               'species': species,
+               'filters': t2t_filters,
+               'store': store,
+               'cache': cache}
+        context = {'t2t': t2t, 't2in': t2in, 'filters': filters}
+
+        # Appending the rows of each tree to the three tables, an
+        # interrupted run keeps the rows of all of them in their part files.
+        # The t2in and trees tables have one row per tree, so they are
+        # flushed every few trees, and the three tables are flushed together
+        # to be done with the same trees
+        with ExitStack() as stack:
+            writers = dict()
+            for table in TABLES:
+                targs = dict(writer_args, seedsize=TREE_BATCH)
+                if oformat == 'parquet':
+                    targs['types'] = TYPES[table]
+                    if table == 't2t':
+                        targs['dictionary'] = get_t2t_dist.DICTIONARY
+                writers[table] = stack.enter_context(
+                    writer_class(ofiles[table], columns[table],
+                                 resume=len(done) > 0, **targs))
+
+            if shard is not None:
+                tree_rows = get_shard_rows(ifile, shard, store, 2, filters)
+            elif store is not None:
+                tree_rows = iter(TreeStore(store).seeds)
+            else:
+                tree_rows = (x for x in open(ifile, 'r') if x.strip() != '')
+            tree_rows = (x for x in tree_rows
+                         if x.split('\t', 1)[0] not in done)
+            for result in run_pool(tree_rows, dist_process, context, cpus,
+                                   chunksize, profile):
+                # Failed trees are not logged and run again on resume
+                if result is not None:
+                    seed, rows = result
+                    for table in TABLES:
+                        writers[table].write(None if rows is None
+                                             else rows[table], seed)
+                    if not all(writers[x].seeds for x in TABLES):
+                        for table in TABLES:
+                            writers[table].flush()
+
+        if profile is not None:
+            write_report(profile['profdir'],
+                         os.path.splitext(ofiles['trees'])[0])
+
+
+if __name__ == '__main__':
+    main()
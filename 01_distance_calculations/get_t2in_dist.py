@@ -24,76 +24,67 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-import pandas as pd
 import ete3
-from multiprocessing import Process, Manager
-from treefuns import (read_treeline, root, get_sp2age, annotate_tree,
-                      get_group_species, get_group_mrca,
-                      tree_stats, count_dupl_specs, get_species_sptree)
-from utils import create_folder, file_exists
+from treefuns import (read_treeline, screen_treeline, get_sp2age,
+                      get_group_species, get_species_sptree,
+                      get_group_bitmasks, get_species_index,
+                      get_fist_part_sp, TREE_STATS_KEYS)
+from utils import create_folder
+from runner import run_pool
+from treestore import TreeStore
+from treecache import TreeCache, read_rooted, get_shared_reader
+from rooting import get_rooting, parse_root_modes
+from profiling import stage, get_profile, write_report
+from shards import get_shard_rows, get_shard_file
+from workqueue import get_queue, run_queue
+from writers import TableWriter, TREE_BATCH, get_done_seeds, read_seeds
 from optparse import OptionParser
+import os
 from operator import itemgetter
+import treefuns
+import arraytree
 
 
-def get_fist_part_sp(sptree, event_species, sorted_keys, seed):
-    # Getting the evolutionary events of the tree (MRCA function requirement)
-    sptree.get_descendant_evol_events()
+# Tree engines ----
+ENGINES = {'ete3': treefuns, 'array': arraytree}
 
-    # Generating the output dictionary
-    odict = dict()
 
-    # Iterating thorugh the groups in the event_species dictionary
-    for group in sorted_keys:
-        # Annotating the tree with the node
-        annotate_tree(sptree, group, event_species[group])
-
-        # Getting the MRCA group
-        spgroupt = get_group_mrca(sptree, seed, group, seed)
-
-        # Writing in a tupple the species after the first partition
-        # in two groups
-        i = 0
-        ol = list()
-        for node in spgroupt['node'].iter_descendants():
-            if i < 2:
-                ol.append(node.get_species())
-                i += 1
-            else:
-                break
-
-        odict[group] = (ol[0], ol[1])
-
-    return odict
-
-
-def event_dist(tree, event_species, sorted_keys, normgroup, firstsplit):
+def event_dist(tree, event_species, sorted_keys, normgroup, firstsplit,
+               spgroups, spidx, engine=treefuns):
+    # The engine module provides the tree functions for the tree['tree']
+    # type, the tree has to be rooted and its evolutionary events computed
     dfd = dict()
     dfd['seed'] = tree['seed']
 
-    tree['tree'].get_descendant_evol_events()
-
     # Calculating the tree stats and storing in the dictionary
-    wholet_stats = tree_stats(tree['tree'])
-    tdupl = count_dupl_specs(tree['tree'])
+    with stage('tree_stats'):
+        wholet_stats = engine.tree_stats(tree['tree'])
+    with stage('dupl_specs'):
+        tdupl = engine.count_dupl_specs(tree['tree'])
     dfd = {**dfd, **{'tree_' + k: v for k, v in wholet_stats.items()},
            **{'tree_' + k: v for k, v in tdupl.items()}}
 
-    # Getting the normalising factor
-    annotate_tree(tree['tree'], 'normalising', event_species[normgroup])
+    # Getting the MRCA of every group, the normalising one included, in a
+    # single traversal
+    with stage('group_mrca'):
+        groupsmrca = engine.get_groups_mrca(tree['tree'], tree['seed'],
+                                            event_species, spgroups,
+                                            tree['seed'], firstsplit, spidx)
 
+    # Getting the normalising factor
     try:
-        normt = get_group_mrca(tree['tree'], tree['seed'],
-                               'normalising', tree['seed'],
-                               firstsplit[normgroup])
-        normtdupl = count_dupl_specs(normt['node'])
-    except IndexError:
+        normt = groupsmrca[normgroup]
+        with stage('dupl_specs'):
+            normtdupl = engine.count_dupl_specs(normt['node'])
+    except KeyError:
         print('Tree %s: cannot compute the normalising group.' % tree['seed'])
         normt = None
 
     if normt is not None:
         # Calculating the normalising subtree stats and storing in
         # the dictionary
-        normt_stats = tree_stats(normt['node'])
+        with stage('tree_stats'):
+            normt_stats = engine.tree_stats(normt['node'])
         dfd = {**dfd, **{'norm_' + k: v for k, v in normt_stats.items()},
                **{'norm_' + k: v for k, v in normtdupl.items()}}
 
@@ -102,25 +93,19 @@ def event_dist(tree, event_species, sorted_keys, normgroup, firstsplit):
         # Getting the distances from the seed to the group MRCA
         last_group = [0, 0]
         for group in sorted_keys:
-            # Annotating the tree with the group info
-            annotate_tree(tree['tree'], group, event_species[group])
-
             # Obtaining each group MRCA
-            try:
-                groupt = get_group_mrca(tree['tree'], tree['seed'],
-                                        group, tree['seed'],
-                                        firstsplit[group])
-            except IndexError:
+            groupt = groupsmrca.get(group)
+            if groupt is None:
                 print('Distance to node %s in tree %s cannot be computed.' %
                       (group, tree['seed']))
-                groupt = None
 
             if groupt is not None:
                 # Checking whether the subtrees are the same
                 if (last_group[0] != groupt['seq_no'] and
                         last_group[1] != groupt['sp_no']):
                     # Calculating group MRCA (event) to seed distance
-                    dist = groupt['node'].get_distance(tree['seed'])
+                    with stage('distances'):
+                        dist = groupt['node'].get_distance(tree['seed'])
                     ndist = dist / normt_stats['median_r2t']
                     dfd[group + '_dist'] = dist
                     dfd[group + '_ndist'] = ndist
@@ -130,35 +115,140 @@ def event_dist(tree, event_species, sorted_keys, normgroup, firstsplit):
     return dfd
 
 
-class dist_process(Process):
-    def __init__(self, tree_row, event_species, sorted_keys,
-                 normgroup, sp2agedic, olist, firstsplit):
-        Process.__init__(self)
-        self.tree_row = tree_row
+def get_columns(sorted_keys, rooting=False):
+    # Columns of the event_dist table in order, with the rooting mode of
+    # each row if the trees are rooted in several ways
+    columns = ['seed']
+    if rooting:
+        columns += ['rooting']
+    columns += ['tree_' + k for k in TREE_STATS_KEYS]
+    columns += ['norm_' + k for k in TREE_STATS_KEYS]
+    columns += ['wdth_ratio']
+    for group in sorted_keys:
+        columns += [group + '_dist', group + '_ndist']
+
+    return columns
+
+
+def get_context(sptree, cladedf, seedsp):
+    '''
+    Get the species context of the tip-to-internode distances
+
+    Args:
+        sptree (str): newick file containing the species tree
+
+        cladedf (str): table of the species belonging to each clade
+
+        seedsp (str): species code of the seed
+
+    Returns:
+        dict: event_species, sorted_keys, sp2agedic, firstsplit, spgroups
+        and spidx arguments of dist_process
+    '''
+
+    # Computing the species to age dictionary from the species tree
+    sptree = ete3.PhyloTree(sptree, sp_naming_function=get_species_sptree)
+    sp2agedic = get_sp2age(sptree, seedsp)
+
+    # Getting the speies belonging to interest groups dictionary
+    event_species = get_group_species(cladedf)
+    sorted_keys = [(k, v, len(v)) for k, v in event_species.items()]
+    sorted_keys = sorted(sorted_keys, key=itemgetter(2))
+    sorted_keys = [x[0] for x in sorted_keys]
+    spgroups = get_group_bitmasks(event_species)
+
+    # Numbering the species to handle species sets as bitmasks
+    spidx = get_species_index(sptree, event_species)
+
+    # Getting the species tree first split species for each group
+    firstsplit = get_fist_part_sp(sptree, event_species,
+                                  sorted_keys, seedsp, spidx)
+
+    return {'event_species': event_species,
+            'sorted_keys': sorted_keys,
+            'sp2agedic': sp2agedic,
+            'firstsplit': firstsplit,
+            'spgroups': spgroups,
+            'spidx': spidx}
+
+
+class dist_process:
+    # Built once per pool process with the run context, run() processes
+    # one tree line and returns its rows
+    def __init__(self, event_species, sorted_keys, normgroup, sp2agedic,
+                 firstsplit, spgroups, spidx, engine='ete3', filters=None,
+                 store=None, cache=None, root_modes=None):
         self.event_species = event_species
         self.sorted_keys = sorted_keys
         self.normgroup = normgroup
         self.sp2agedic = sp2agedic
-        self.olist = olist
         self.firstsplit = firstsplit
+        self.spgroups = spgroups
+        self.spidx = spidx
+        self.engine = engine
+        self.filters = filters or dict()
+        self.root_modes = root_modes
+
+        # Trees are read from the tree lines or by seed from a tree store
+        if store is None:
+            self.store = None
+            self.read = read_treeline
+            self.screen = screen_treeline
+        else:
+            self.store = TreeStore(store)
+            self.read = self.store.read_arraytree
+            self.screen = self.store.screen_treeline
+
+        # Rooted trees with their evolutionary events cached on disk
+        if cache is None:
+            self.cache = None
+        else:
+            self.cache = TreeCache(cache, self.store)
+
+    def get_tree(self, tree_row, read, mode='species_age'):
+        # Rooting the tree by the species ages, or by another rooting mode,
+        # and getting its evolutionary events, or loading them from the cache
+        root_tree, params = get_rooting(mode, self.sp2agedic)
+        return read_rooted(tree_row, read, root_tree, mode, params,
+                           self.cache, self.engine, self.spidx)
+
+    def get_rows(self, tree, mode=None):
+        # Calculating distances of a rooted tree
+        odict = event_dist(tree, self.event_species,
+                           self.sorted_keys, self.normgroup, self.firstsplit,
+                           self.spgroups, self.spidx, ENGINES[self.engine])
+        if mode is not None:
+            odict['rooting'] = mode
 
-    def run(self):
-        tree = read_treeline(self.tree_row)
+        return [odict]
 
-        # Rooting the tree
-        root(tree['tree'], self.sp2agedic)
+    def get_mode_rows(self, tree_row, read):
+        # Calculating the distances of the tree rooted by each rooting
+        # mode, one row per mode from a single parse of the tree
+        if self.root_modes is None:
+            return self.get_rows(self.get_tree(tree_row, read))
 
-        # Calculating distances
-        odict = event_dist(tree, self.event_species,
-                           self.sorted_keys, self.normgroup, self.firstsplit)
-        self.olist.append(odict)
+        read = get_shared_reader(read)
+        rows = list()
+        for mode in self.root_modes:
+            rows += self.get_rows(self.get_tree(tree_row, read, mode), mode)
+
+        return rows
+
+    def run(self, tree_row):
+        # Checking the tree size on the raw newick before parsing it
+        if not self.screen(tree_row, **self.filters):
+            return None
+
+        return self.get_mode_rows(tree_row, self.read)
 
 
 def main():
     parser = OptionParser()
     parser.add_option('-i', '--input', dest='ifile',
                       help=('File with multiple trees in newick, each line has'
-                            ' the format: seed\tmodel\tlikelihood\tnewick'),
+                            ' the format: seed\tmodel\tlikelihood\tnewick,'
+                            ' or a tree store written by treestore.py.'),
                       metavar='<file.nwk>')
     parser.add_option('-s', '--sptree', dest='sptree',
                       help='Newick file containing the species tree.',
@@ -176,6 +266,9 @@ def main():
     parser.add_option('-t', '--threads', dest='threads',
                       help='Number of threads.',
                       metavar='<N>', type='int', default=4)
+    parser.add_option('-k', '--chunksize', dest='chunksize',
+                      help='Number of trees sent to a process at once.',
+                      metavar='<N>', type='int', default=8)
     parser.add_option('-p', '--prefix', dest='prefix',
                       help='Output prefix.',
                       metavar='</path/to/dir/prefix> or <prefix>',
@@ -183,6 +276,59 @@ def main():
     parser.add_option('-r', '--redo', dest='redo',
                       help='Ommit done file and redo.',
                       action='store_true', default=False)
+    parser.add_option('-f', '--force', dest='force',
+                      help=('Seeds to compute again, the rest of the trees '
+                            'done in a previous run are kept (file with one '
+                            'seed per line or comma separated seeds).'),
+                      metavar='<seeds.txt>')
+    parser.add_option('-j', '--shard', dest='shard',
+                      help=('Only compute the i-th of N shards of the trees, '
+                            'balanced by their size, written to '
+                            '<prefix>.<i>of<N>.<format>.'),
+                      metavar='<i/N>')
+    parser.add_option('-u', '--queue', dest='queue',
+                      help=('Work as a worker of a queue run, computing '
+                            'batches of trees leased from this queue file '
+                            'until none is left.'),
+                      metavar='<queue.db>')
+    parser.add_option('-S', '--min-species', dest='min_species',
+                      help=('Skip the trees with fewer species, checked '
+                            'before parsing them.'),
+                      metavar='<N>', type='int')
+    parser.add_option('-L', '--max-leaves', dest='max_leaves',
+                      help=('Skip the trees with more leaves, checked before '
+                            'parsing them.'),
+                      metavar='<N>', type='int')
+    parser.add_option('-C', '--max-copies', dest='max_copies',
+                      help=('Skip the trees with at least this mean number of '
+                            'sequences per species, checked before parsing '
+                            'them.'),
+                      metavar='<X>', type='float')
+    parser.add_option('-a', '--cache', dest='cache',
+                      help=('Directory caching the rooted trees and their '
+                            'evolutionary events, shared by the runs of '
+                            'both scripts.'),
+                      metavar='<dir>')
+    parser.add_option('-e', '--engine', dest='engine',
+                      help=('Tree engine: ete3 objects or flat arrays '
+                            '(ete3 or array).'),
+                      metavar='<engine>', type='choice',
+                      choices=list(ENGINES), default='ete3')
+    parser.add_option('-R', '--root-modes', dest='root_modes',
+                      help=('Compute the distances of each tree rooted by '
+                            'each of these rooting modes (species_age or '
+                            'midpoint), with a rooting column telling the '
+                            'mode of each row. By default the trees are '
+                            'only rooted by the species ages.'),
+                      metavar='<mode1,mode2,...>')
+    parser.add_option('-P', '--profile', dest='profile',
+                      help=('Profile the stages of each tree and report them '
+                            'with the slowest trees in <prefix>.profile.txt: '
+                            'their wall time, or also their peak memory '
+                            'allocation, which slows them down (time or '
+                            'memory).'),
+                      metavar='<mode>', type='choice',
+                      choices=['time', 'memory'])
     (options, args) = parser.parse_args()
 
     ifile = options.ifile
@@ -191,58 +337,85 @@ def main():
     seedsp = options.seedsp
     normgroup = options.normgroup
     cpus = options.threads
+    chunksize = options.chunksize
     prefix = options.prefix
     redo = options.redo
+    force = read_seeds(options.force)
+    shard = options.shard
+    queue = options.queue
+    engine = options.engine
+    cache = options.cache
+    if options.root_modes is not None:
+        root_modes = parse_root_modes(options.root_modes)
+    else:
+        root_modes = None
+    store = ifile if os.path.isdir(ifile) else None
+    filters = {'min_species': options.min_species,
+               'max_leaves': options.max_leaves,
+               'max_copies': options.max_copies}
 
     if '/' in prefix:
         odir = prefix.rsplit('/', 1)[0]
         create_folder(odir)
 
     ofile = '%s.csv' % prefix
-
-    if not file_exists(ofile) or redo:
-        # Computing the species to age dictionary from the species tree
-        sptree = ete3.PhyloTree(sptree, sp_naming_function=get_species_sptree)
-        sp2agedic = get_sp2age(sptree, seedsp)
-
-        # Getting the speies belonging to interest groups dictionary
-        event_species = get_group_species(cladedf)
-        sorted_keys = [(k, v, len(v)) for k, v in event_species.items()]
-        sorted_keys = sorted(sorted_keys, key=itemgetter(2))
-        sorted_keys = [x[0] for x in sorted_keys]
-
-        # Getting the species tree first split species for each group
-        firstsplit = get_fist_part_sp(sptree, event_species,
-                                      sorted_keys, seedsp)
-
-        # Iterating in parallel thorugh newick file lines and appending to a
-        # dictionary list
-        with Manager() as manager:
-            olist = manager.list()
-
-            processes = list()
-            for tree_row in open(ifile, 'r'):
-                if tree_row != '':
-                    if len(processes) >= cpus:
-                        done = False
-                        while not done:
-                            for process in processes:
-                                if not process.is_alive():
-                                    processes.remove(process)
-                                    done = True
-
-                    process = dist_process(tree_row, event_species, sorted_keys,
-                                           normgroup, sp2agedic, olist,
-                                           firstsplit)
-                    processes.append(process)
-                    process.start()
-
-            for process in processes:
-                process.join()
-
-            # Writing output files
-            odf = pd.DataFrame(list(olist))
-            odf.to_csv(ofile, index=False)
+    if shard is not None:
+        ofile = get_shard_file(ofile, shard)
+
+    # Getting the trees done in previous runs of the same output
+    if queue is not None:
+        done = set()
+    else:
+        done = get_done_seeds(ofile, 'seed', redo, force)
+
+    if done is not None:
+        # Profiling the trees of this run, the workers of a queue share the
+        # records of the whole queue run
+        profile = get_profile(ofile, options.profile, queue is None)
+
+        # Read-only context sent once to each process of the pool
+        context = get_context(sptree, cladedf, seedsp)
+        sorted_keys = context['sorted_keys']
+        context.update({'normgroup': normgroup,
+                        'engine': engine,
+                        'filters': filters,
+                        'store': store,
+                        'cache': cache,
+                        'root_modes': root_modes})
+        columns = get_columns(sorted_keys, root_modes is not None)
+
+        if queue is not None:
+            # Computing the batches of the queue, each in its part table
+            wqueue = get_queue(queue, ifile, store)
+            run_queue(wqueue, ifile, store, dist_process, context, cpus,
+                      chunksize, ofile, TableWriter, columns,
+                      profile=profile)
+            wqueue.close()
+        else:
+            # Iterating in parallel thorugh newick file lines and appending the
+            # returned rows to the output file
+            # One row per tree, the batches are written every few trees
+            with TableWriter(ofile, columns, resume=len(done) > 0,
+                             seedsize=TREE_BATCH) as writer:
+                if shard is not None:
+                    tree_rows = get_shard_rows(ifile, shard, store, 1,
+                                               filters)
+                elif store is not None:
+                    tree_rows = iter(TreeStore(store).seeds)
+                else:
+                    tree_rows = (x for x in open(ifile, 'r')
+                                 if x.strip() != '')
+                tree_rows = (x for x in tree_rows
+                             if x.split('\t', 1)[0] not in done)
+                for result in run_pool(tree_rows, dist_process, context, cpus,
+                                       chunksize, profile):
+                    # Failed trees are not logged and run again on resume
+                    if result is not None:
+                        seed, rows = result
+                        writer.write(rows, seed)
+
+        if profile is not None:
+            write_report(profile['profdir'], os.path.splitext(ofile)[0])
 
 
 if __name__ == '__main__':
@@ -23,33 +23,117 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from multiprocessing import Process, Manager
 from optparse import OptionParser
-from treefuns import (read_treeline, get_sp2age, annotate_tree,
-                      get_group_mrca, tree_stats, get_species,
-                      count_dupl_specs, get_group_species)
+import os
+from treefuns import (read_treeline, screen_treeline, get_species,
+                      get_group_species)
+from arraytree import (ArrayTree, LCAIndex, EVOLCODES, EVOLTYPES,
+                       get_pairwise_lca, get_pairwise_distances,
+                       get_subtree_events)
+import numpy as np
 import pandas as pd
-from utils import create_folder, file_exists
+from utils import create_folder
+from runner import run_pool
+from treestore import TreeStore
+from treecache import TreeCache, read_rooted
+from rooting import midpoint_root
+from profiling import stage, get_profile, write_report
+from shards import get_shard_rows, get_shard_file
+from workqueue import get_queue, run_queue
+from writers import TableWriter, ParquetWriter, get_done_seeds, read_seeds
+import treefuns
+import arraytree
+
+
+# Tree engines ----
+ENGINES = {'ete3': treefuns, 'array': arraytree}
+
+# Output formats and columns ----
+FORMATS = {'csv': TableWriter, 'parquet': ParquetWriter}
+
+COLUMNS = ['tree', 'from', 'from_seq', 'to', 'to_seq', 'MRCA_type',
+           'sp_count', 'dup_count', 'dist', 'ndist']
+
+# Repeated text columns, dictionary encoded in the Parquet output
+DICTIONARY = ['tree', 'from_seq', 'to_seq', 'MRCA_type']
+
+# Columns of the Parquet output which are not floats
+TYPES = {'from': 'string', 'to': 'string', 'sp_count': 'int64',
+         'dup_count': 'int64'}
 
 
 # Definitions ----
-class dist_process(Process):
-    def __init__(self, line, event_species, normgroup, olist):
-        Process.__init__(self)
-        self.line = line
+class dist_process:
+    # Built once per pool process with the run context, run() processes
+    # one tree line and returns its rows. The pairs can be restricted to
+    # the ones with the seed sequence or a seed species sequence, with
+    # both species in a list or with a given MRCA type.
+    def __init__(self, event_species, normgroup, engine='ete3',
+                 seedseq=False, seedsp=False, mrca=None, species=None,
+                 filters=None, store=None, cache=None):
         self.event_species = event_species
         self.normgroup = normgroup
-        self.olist = olist
-    
+        self.engine = engine
+        self.filters = filters or dict()
+
+        # Trees are read from the tree lines or by seed from a tree store
+        if store is None:
+            self.store = None
+            self.read = read_treeline
+            self.screen = screen_treeline
+        else:
+            self.store = TreeStore(store)
+            self.read = self.store.read_arraytree
+            self.screen = self.store.screen_treeline
+
+        # Rooted trees with their evolutionary events cached on disk
+        if cache is None:
+            self.cache = None
+        else:
+            self.cache = TreeCache(cache, self.store)
+        self.seedseq = seedseq
+        self.seedsp = seedsp
+        self.mrca = mrca
+        self.species = species
+        self.selection = seedseq or seedsp or species is not None
+
+    def get_pairs(self, seed, names):
+        # Leaf pairs indices in the order of the pairwise loop
+        n = len(names)
+        species = np.array([get_species(x) for x in names], dtype=object)
+        if self.seedseq:
+            anchor = names == seed
+        elif self.seedsp:
+            anchor = species == get_species(seed)
+        else:
+            anchor = None
+
+        if anchor is None:
+            i, j = np.triu_indices(n, 1)
+        else:
+            # Pairing only the seed sequences with the rest of the leaves
+            a = np.repeat(np.flatnonzero(anchor), n)
+            b = np.tile(np.arange(n), anchor.sum())
+            pairs = np.unique(np.minimum(a, b) * n + np.maximum(a, b))
+            i, j = np.divmod(pairs, n)
+            i, j = i[i < j], j[i < j]
+
+        if self.species is not None:
+            listed = np.isin(species, list(self.species))
+            keep = listed[i] & listed[j]
+            i, j = i[keep], j[keep]
+
+        return i, j
 
     def get_dists(self, tree, from_seq, to_seq, normfact):
         # Calculating the distances
         dist = tree['tree'].get_distance(from_seq, to_seq)
         ndist = dist / normfact
 
-        # Getting the duplication and speciation events in the path between tips
-        st = tree['tree'].get_common_ancestor(from_seq, to_seq)
-        stcount = count_dupl_specs(st)
+        # Getting the duplication and speciation events in the path between
+        # tips from the tree MRCA index
+        st = tree['lca'].get_common_ancestor(from_seq, to_seq)
+        stcount = tree['lca'].count_dupl_specs(st)
 
         # Creating and adding data to the output dictionary
         leafdistd = dict()
@@ -58,46 +142,130 @@ class dist_process(Process):
         leafdistd['from_seq'] = get_species(from_seq)
         leafdistd['to'] = to_seq
         leafdistd['to_seq'] = get_species(to_seq)
-        leafdistd['MRCA_type'] = st.evoltype
+        leafdistd['MRCA_type'] = tree['lca'].get_evoltype(st)
         leafdistd['sp_count'] = stcount['S']
         leafdistd['dup_count'] = stcount['D']
         leafdistd['dist'] = dist
         leafdistd['ndist'] = ndist
 
-        self.olist.append(leafdistd)
+        return leafdistd
+
+    def get_all_dists(self, tree, normfact):
+        # Calculating the distances and MRCAs of all the pairs at once, or
+        # of the selected ones from the tree MRCA index
+        leaves = tree['tree'].get_leaves()
+        names = tree['tree'].names[leaves]
+        if self.selection:
+            i, j = self.get_pairs(tree['seed'], names)
+            pairlca = LCAIndex(tree['tree']).query(leaves[i], leaves[j])
+            depth = tree['tree'].depth
+            dists = (depth[leaves[i]] + depth[leaves[j]] -
+                     2 * depth[pairlca])
+        else:
+            # Upper triangle pairs follow the order of the pairwise loop
+            lca = get_pairwise_lca(tree['tree'])
+            i, j = np.triu_indices(len(leaves), 1)
+            pairlca = lca[i, j]
+            dists = get_pairwise_distances(tree['tree'], lca)[i, j]
+
+        if self.mrca is not None:
+            keep = tree['tree'].evolcode[pairlca] == EVOLCODES[self.mrca]
+            i, j, pairlca, dists = i[keep], j[keep], pairlca[keep], dists[keep]
+
+        stcount = get_subtree_events(tree['tree'])
+        species = np.array([get_species(x) for x in names], dtype=object)
+        evoltypes = np.array([EVOLTYPES.get(x) for x in range(3)],
+                             dtype=object)
+
+        # Creating the output data frame
+        odf = pd.DataFrame()
+        odf['tree'] = [tree['seed']] * len(i)
+        odf['from'] = names[i]
+        odf['from_seq'] = species[i]
+        odf['to'] = names[j]
+        odf['to_seq'] = species[j]
+        odf['MRCA_type'] = evoltypes[tree['tree'].evolcode[pairlca]]
+        odf['sp_count'] = stcount['S'][pairlca]
+        odf['dup_count'] = stcount['D'][pairlca]
+        odf['dist'] = dists
+        odf['ndist'] = odf['dist'] / normfact
 
+        return odf
 
-    def run(self):
-        tree = read_treeline(self.line)
-        if (len(tree['tree'].get_species()) > 10 and
-            len(tree['tree'].get_leaf_names()) < 3 * len(tree['tree'].get_species())):
-            print('Processing:', tree['seed'])
+    def get_tree(self, line, read):
+        # Rooting the tree at its midpoint and getting its evolutionary
+        # events, or loading them from the cache
+        return read_rooted(line, read, midpoint_root, 'midpoint',
+                           cache=self.cache, engine=self.engine)
 
-            tree['tree'].set_outgroup(tree['tree'].get_midpoint_outgroup())
-            tree['tree'].get_descendant_evol_events()
+    def get_rows(self, tree):
+        # Computing the pairs of a rooted tree, the normalising group stats
+        # are kept in the tree dictionary
+        odf = None
+        print('Processing:', tree['seed'])
+        engine = ENGINES[self.engine]
 
-            annotate_tree(tree['tree'], 'normalising', self.event_species[self.normgroup])
+        with stage('annotate'):
+            engine.annotate_tree(tree['tree'], 'normalising',
+                                 self.event_species[self.normgroup])
 
-            try:
-                normt = get_group_mrca(tree['tree'], tree['seed'],
-                                'normalising', tree['seed'])
-                normt_stats = tree_stats(normt['node'])
-            except IndexError:
-                print('Tree %s: cannot compute the normalising group.' % tree['seed'])
-                normt_stats = None
+        try:
+            with stage('group_mrca'):
+                normt = engine.get_group_mrca(tree['tree'], tree['seed'],
+                                              'normalising', tree['seed'])
+            with stage('tree_stats'):
+                normt_stats = engine.tree_stats(normt['node'])
+        except IndexError:
+            print('Tree %s: cannot compute the normalising group.' %
+                  tree['seed'])
+            normt_stats = None
+        tree['norm_stats'] = normt_stats
 
-            if normt_stats is not None:
-                tnames = tree['tree'].get_leaf_names()
-                for i, from_seq in enumerate(tnames):
-                    for to_seq in tnames[i + 1:]:
-                        self.get_dists(tree, from_seq, to_seq, normt_stats['median_r2t'])
+        if normt_stats is not None and self.engine == 'array':
+            with stage('pairs'):
+                odf = self.get_all_dists(tree, normt_stats['median_r2t'])
+        elif normt_stats is not None:
+            with stage('pairs'):
+                odf = self.get_loop_dists(tree, normt_stats['median_r2t'])
+
+        return odf
+
+    def get_loop_dists(self, tree, normfact):
+        # Calculating the distances of the selected pairs one by one on the
+        # ete3 tree, with its MRCAs and events indexed once for all the pairs
+        tree['lca'] = LCAIndex(ArrayTree.from_phylotree(tree['tree']))
+
+        # Selecting the pairs before computing their distances
+        tnames = np.array(tree['tree'].get_leaf_names(), dtype=object)
+        i, j = self.get_pairs(tree['seed'], tnames)
+        if self.mrca is not None:
+            leaves = tree['lca'].tree.get_leaves()
+            pairlca = tree['lca'].query(leaves[i], leaves[j])
+            keep = (tree['lca'].tree.evolcode[pairlca] ==
+                    EVOLCODES[self.mrca])
+            i, j = i[keep], j[keep]
+
+        rows = list()
+        for from_seq, to_seq in zip(tnames[i], tnames[j]):
+            rows.append(self.get_dists(tree, from_seq, to_seq, normfact))
+
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def run(self, line):
+        odf = None
+        # Checking the tree size on the raw newick before parsing it
+        if self.screen(line, **self.filters):
+            odf = self.get_rows(self.get_tree(line, self.read))
+
+        return odf
 
 
 def main():
     parser = OptionParser()
     parser.add_option('-i', '--input', dest='ifile',
                       help=('File with multiple trees in newick, each line has'
-                            ' the format: seed\tmodel\tlikelihood\tnewick'),
+                            ' the format: seed\tmodel\tlikelihood\tnewick,'
+                            ' or a tree store written by treestore.py.'),
                       metavar='<file.nwk>')
     parser.add_option('-c', '--clades', dest='cladedf',
                       help=('Species belonging to clades, columns show the '
@@ -109,6 +277,9 @@ def main():
     parser.add_option('-t', '--threads', dest='threads',
                       help='Number of threads.',
                       metavar='<N>', type='int', default=4)
+    parser.add_option('-k', '--chunksize', dest='chunksize',
+                      help='Number of trees sent to a process at once.',
+                      metavar='<N>', type='int', default=8)
     parser.add_option('-p', '--prefix', dest='prefix',
                       help='Output prefix.',
                       metavar='</path/to/dir/prefix> or <prefix>',
@@ -116,48 +287,176 @@ def main():
     parser.add_option('-r', '--redo', dest='redo',
                       help='Ommit done file and redo.',
                       action='store_true', default=False)
+    parser.add_option('-f', '--force', dest='force',
+                      help=('Seeds to compute again, the rest of the trees '
+                            'done in a previous run are kept (file with one '
+                            'seed per line or comma separated seeds).'),
+                      metavar='<seeds.txt>')
+    parser.add_option('-j', '--shard', dest='shard',
+                      help=('Only compute the i-th of N shards of the trees, '
+                            'balanced by their size, written to '
+                            '<prefix>.<i>of<N>.<format>.'),
+                      metavar='<i/N>')
+    parser.add_option('-u', '--queue', dest='queue',
+                      help=('Work as a worker of a queue run, computing '
+                            'batches of trees leased from this queue file '
+                            'until none is left.'),
+                      metavar='<queue.db>')
+    parser.add_option('-S', '--min-species', dest='min_species',
+                      help=('Skip the trees with fewer species, checked '
+                            'before parsing them.'),
+                      metavar='<N>', type='int', default=11)
+    parser.add_option('-L', '--max-leaves', dest='max_leaves',
+                      help=('Skip the trees with more leaves, checked before '
+                            'parsing them.'),
+                      metavar='<N>', type='int')
+    parser.add_option('-C', '--max-copies', dest='max_copies',
+                      help=('Skip the trees with at least this mean number of '
+                            'sequences per species, checked before parsing '
+                            'them.'),
+                      metavar='<X>', type='float', default=3)
+    parser.add_option('-a', '--cache', dest='cache',
+                      help=('Directory caching the rooted trees and their '
+                            'evolutionary events, shared by the runs of '
+                            'both scripts.'),
+                      metavar='<dir>')
+    parser.add_option('-e', '--engine', dest='engine',
+                      help=('Tree engine: ete3 objects or flat arrays '
+                            '(ete3 or array).'),
+                      metavar='<engine>', type='choice',
+                      choices=list(ENGINES), default='ete3')
+    parser.add_option('-q', '--seedseq', dest='seedseq',
+                      help='Only compute the pairs with the seed sequence.',
+                      action='store_true', default=False)
+    parser.add_option('-w', '--seedsp', dest='seedsp',
+                      help=('Only compute the pairs with a sequence of the '
+                            'seed species.'),
+                      action='store_true', default=False)
+    parser.add_option('-m', '--mrca', dest='mrca',
+                      help=('Only compute the pairs whose MRCA is a '
+                            'speciation or a duplication (S or D).'),
+                      metavar='<type>', type='choice',
+                      choices=list(EVOLCODES))
+    parser.add_option('-x', '--species', dest='species',
+                      help=('Only compute the pairs whose sequences belong to '
+                            'these species.'),
+                      metavar='<SP1,SP2,...>')
+    parser.add_option('-o', '--format', dest='format',
+                      help='Output table format (csv or parquet).',
+                      metavar='<format>', type='choice',
+                      choices=list(FORMATS), default='csv')
+    parser.add_option('-d', '--float', dest='floattype',
+                      help=('Type of the distance columns in the parquet '
+                            'output (float64 or float32).'),
+                      metavar='<type>', type='choice',
+                      choices=['float64', 'float32'], default='float64')
+    parser.add_option('-P', '--profile', dest='profile',
+                      help=('Profile the stages of each tree and report them '
+                            'with the slowest trees in <prefix>.profile.txt: '
+                            'their wall time, or also their peak memory '
+                            'allocation, which slows them down (time or '
+                            'memory).'),
+                      metavar='<mode>', type='choice',
+                      choices=['time', 'memory'])
     (options, args) = parser.parse_args()
 
     ifile = options.ifile
     cladedf = options.cladedf
     normgroup = options.normgroup
     cpus = options.threads
+    chunksize = options.chunksize
     prefix = options.prefix
     redo = options.redo
-    
+    force = read_seeds(options.force)
+    shard = options.shard
+    queue = options.queue
+    engine = options.engine
+    cache = options.cache
+    oformat = options.format
+    floattype = options.floattype
+    seedseq = options.seedseq
+    seedsp = options.seedsp
+    mrca = options.mrca
+    store = ifile if os.path.isdir(ifile) else None
+    filters = {'min_species': options.min_species,
+               'max_leaves': options.max_leaves,
+               'max_copies': options.max_copies}
+    if options.species is not None:
+        species = set(options.species.split(','))
+    else:
+        species = None
+
     event_species = get_group_species(cladedf)
 
     if '/' in prefix:
         odir = prefix.rsplit('/', 1)[0]
         create_folder(odir)
 
-    ofile = '%s.csv' % prefix
-
-    if not file_exists(ofile) or redo:
-        with Manager() as manager:
-            olist = manager.list()
-
-            processes = list()
-            for tree_row in open(ifile, 'r'):
-                if tree_row != '':
-                    if len(processes) >= cpus:
-                        done = False
-                        while not done:
-                            for process in processes:
-                                if not process.is_alive():
-                                    processes.remove(process)
-                                    done = True
-
-                    process = dist_process(tree_row, event_species, normgroup, olist)
-                    processes.append(process)
-                    process.start()
-
-            for process in processes:
-                process.join()
-
-            # Writing output files
-            odf = pd.DataFrame(list(olist))
-            odf.to_csv(ofile, index=False)
+    ofile = '%s.%s' % (prefix, oformat)
+    if shard is not None:
+        ofile = get_shard_file(ofile, shard)
+    writer_class = FORMATS[oformat]
+    if oformat == 'parquet':
+        writer_args = {'dictionary': DICTIONARY, 'floattype': floattype,
+                       'types': TYPES}
+    else:
+        writer_args = dict()
+
+    # Getting the trees done in previous runs of the same output
+    if queue is not None:
+        done = set()
+    else:
+        done = get_done_seeds(ofile, 'tree', redo, force, writer_class)
+
+    if done is not None:
+        # Profiling the trees of this run, the workers of a queue share the
+        # records of the whole queue run
+        profile = get_profile(ofile, options.profile, queue is None)
+
+        # Read-only context sent once to each process of the pool
+        context = {'event_species': event_species,
+                   'normgroup': normgroup,
+                   'engine': engine,
+                   'seedseq': seedseq,
+                   'seedsp': seedsp,
+                   'mrca': mrca,
+                   'species': species,
+                   'filters': filters,
+                   'store': store,
+                   'cache': cache}
+
+        if queue is not None:
+            # Computing the batches of the queue, each in its part table
+            wqueue = get_queue(queue, ifile, store)
+            run_queue(wqueue, ifile, store, dist_process, context, cpus,
+                      chunksize, ofile, writer_class, COLUMNS, writer_args,
+                      profile)
+            wqueue.close()
+        else:
+            # Appending the rows of each tree to the output file as they arrive
+            with writer_class(ofile, COLUMNS, resume=len(done) > 0,
+                              **writer_args) as writer:
+                if shard is not None:
+                    # The pairs with the seed are linear in the leaves
+                    power = 1 if seedseq or seedsp else 2
+                    tree_rows = get_shard_rows(ifile, shard, store, power,
+                                               filters)
+                elif store is not None:
+                    tree_rows = iter(TreeStore(store).seeds)
+                else:
+                    tree_rows = (x for x in open(ifile, 'r')
+                                 if x.strip() != '')
+                tree_rows = (x for x in tree_rows
+                             if x.split('\t', 1)[0] not in done)
+                for result in run_pool(tree_rows, dist_process, context, cpus,
+                                       chunksize, profile):
+                    # Failed trees are not logged and run again on resume
+                    if result is not None:
+                        seed, odf = result
+                        writer.write(odf, seed)
+
+        if profile is not None:
+            write_report(profile['profdir'], os.path.splitext(ofile)[0])
 
 
 if __name__ == '__main__':
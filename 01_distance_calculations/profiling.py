@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+profiling.py -- Per-stage profiling of the tree workers
+
+The distance scripts mark the stages of the work on each tree (parse,
+rooting, evol_events, tree_stats, group_mrca, pairs...) with stage(). When
+profiling is off, stage() returns a shared empty context and the marks
+cost a function call. When it is on, each pool process records the wall
+time and the number of calls of every stage of every tree, and appends
+them with the leaf count of the tree to its own file in a profile
+directory. The time spent out of the marked stages is recorded as the
+other stage. The peak memory allocated in each stage can be recorded too,
+traced with tracemalloc, which slows down every allocation: the times of
+a memory profile are only comparable between themselves.
+
+The records of all the processes, and of all the workers of a queue run
+sharing the directory, are gathered in a report with the totals and
+percentiles of each stage and the slowest trees. The report is written at
+the end of a profiled run, or from a profile directory with:
+
+    python3 profiling.py -i <prefix>.profile -o <prefix>
+
+Requirements:
+ - contextlib
+ - os
+ - socket
+ - time
+ - tracemalloc
+ - pandas
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+from contextlib import contextmanager, nullcontext
+import os
+import socket
+import time
+import tracemalloc
+import pandas as pd
+
+
+# Profiler of the current process, set by enable
+PROFILER = None
+
+# Stage returned when profiling is off, shared by all the calls
+NULL_STAGE = nullcontext()
+
+# Columns of the profile records
+COLUMNS = ['seed', 'leafno', 'failed', 'stage', 'calls', 'time', 'peak_mem']
+
+
+# Define classes ----
+class Profiler:
+    '''
+    Recorder of the stages of the trees processed by a process
+
+    Args:
+        profdir (str): profile directory, the records are appended to
+        <host>-<pid>.tsv in it
+
+        memory (boolean): trace the peak memory allocated in each stage
+    '''
+
+    def __init__(self, profdir, memory=False):
+        os.makedirs(profdir, exist_ok=True)
+        self.path = os.path.join(profdir, '%s-%s.tsv' % (socket.gethostname(),
+                                                         os.getpid()))
+        self.memory = memory
+        self.seed = None
+        self.leafno = None
+        self.stages = dict()
+        self.start = None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start_tree(self, seed):
+        self.seed = seed
+        self.leafno = None
+        self.stages = dict()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        # Stages are not nested, the allocation peak is reset at each one
+        if self.memory:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = 0
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1] - before
+            calls, total, maxpeak = self.stages.get(name, (0, 0.0, 0))
+            self.stages[name] = (calls + 1, total + elapsed,
+                                 max(maxpeak, peak))
+
+    def end_tree(self, failed=False):
+        '''
+        Append the records of the current tree to the process file
+
+        Args:
+            failed (boolean): whether the tree failed
+        '''
+
+        elapsed = time.perf_counter() - self.start
+        other = elapsed - sum(x[1] for x in self.stages.values())
+        self.stages['other'] = (1, max(other, 0.0), 0)
+        self.stages['total'] = (1, elapsed,
+                                max(x[2] for x in self.stages.values()))
+
+        leafno = '' if self.leafno is None else self.leafno
+        with open(self.path, 'a') as handle:
+            for name, (calls, total, peak) in self.stages.items():
+                peak = peak if self.memory else ''
+                handle.write('%s\t%s\t%d\t%s\t%d\t%.6f\t%s\n' %
+                             (self.seed, leafno, failed, name, calls, total,
+                              peak))
+        self.seed = None
+
+
+# Define functions ----
+def enable(profdir, memory=False):
+    '''
+    Turn on the profiling of the current process
+
+    Args:
+        profdir (str): profile directory
+
+        memory (boolean): trace the peak memory allocated in each stage
+    '''
+
+    global PROFILER
+    PROFILER = Profiler(profdir, memory)
+
+
+def stage(name):
+    '''
+    Mark a stage of the work on a tree
+
+    Args:
+        name (str): stage name
+
+    Returns:
+        context manager: timing the stage if profiling is on
+    '''
+
+    if PROFILER is None or PROFILER.seed is None:
+        return NULL_STAGE
+
+    return PROFILER.stage(name)
+
+
+def start_tree(seed):
+    if PROFILER is not None:
+        PROFILER.start_tree(seed)
+
+
+def end_tree(failed=False):
+    if PROFILER is not None and PROFILER.seed is not None:
+        PROFILER.end_tree(failed)
+
+
+def set_leafno(leafno):
+    # Leaf count of the current tree, shown next to the slowest trees
+    if PROFILER is not None:
+        PROFILER.leafno = leafno
+
+
+def get_profile(ofile, mode, clear=True):
+    '''
+    Get the profiling arguments of a run
+
+    Args:
+        ofile (str): output table of the run, the records are written to
+        the <prefix>.profile directory next to it
+
+        mode (str): profile mode, time or memory, None to not profile
+
+        clear (boolean): remove the records of a previous run, the workers
+        of a queue run keep the ones of the others
+
+    Returns:
+        dict: keyword arguments of enable, None if mode is None
+    '''
+
+    if mode is None:
+        return None
+
+    profdir = '%s.profile' % os.path.splitext(ofile)[0]
+    if clear and os.path.isdir(profdir):
+        for filename in os.listdir(profdir):
+            if filename.endswith('.tsv'):
+                os.remove(os.path.join(profdir, filename))
+
+    return {'profdir': profdir, 'memory': mode == 'memory'}
+
+
+def read_profiles(profdir):
+    '''
+    Read the profile records of all the processes of a run
+
+    Args:
+        profdir (str): profile directory
+
+    Returns:
+        DataFrame: one row per tree and stage
+    '''
+
+    tables = [pd.read_csv(os.path.join(profdir, x), sep='\t', header=None,
+                          names=COLUMNS, dtype={'seed': str})
+              for x in sorted(os.listdir(profdir)) if x.endswith('.tsv')]
+    if not tables:
+        return pd.DataFrame(columns=COLUMNS)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def get_stage_summary(profdf):
+    '''
+    Summarise the time and memory of each stage over the trees
+
+    Args:
+        profdf (DataFrame): profile records, as read by read_profiles
+
+    Returns:
+        DataFrame: trees, calls, total time and share of the run, time
+        percentiles per tree and peak memory of each stage
+    '''
+
+    total = profdf.loc[profdf['stage'] == 'total', 'time'].sum()
+    groups = profdf.groupby('stage', sort=False)
+    summary = pd.DataFrame({'trees': groups['seed'].nunique(),
+                            'calls': groups['calls'].sum(),
+                            'total_s': groups['time'].sum()})
+    summary['share'] = summary['total_s'] / total if total > 0 else 0.0
+    for q in [0.5, 0.9, 0.99]:
+        summary['p%d_s' % (q * 100)] = groups['time'].quantile(q)
+    summary['max_s'] = groups['time'].max()
+    if profdf['peak_mem'].notna().any():
+        summary['median_mem_mb'] = groups['peak_mem'].median() / 2 ** 20
+        summary['max_mem_mb'] = groups['peak_mem'].max() / 2 ** 20
+
+    return summary.sort_values('total_s', ascending=False)
+
+
+def get_tree_times(profdf):
+    '''
+    Get the time of each stage of each tree
+
+    Args:
+        profdf (DataFrame): profile records, as read by read_profiles
+
+    Returns:
+        DataFrame: seed, leaf count, failed flag, total time and time of
+        each stage of each tree, slowest trees first
+    '''
+
+    times = profdf.pivot_table(index=['seed', 'leafno', 'failed'],
+                               columns='stage', values='time',
+                               aggfunc='sum', fill_value=0.0)
+    times = times.reset_index()
+    times.columns.name = None
+    stages = [x for x in times.columns
+              if x not in ['seed', 'leafno', 'failed', 'total']]
+    times = times[['seed', 'leafno', 'failed', 'total'] + stages]
+
+    return times.sort_values('total', ascending=False)
+
+
+def write_report(profdir, prefix, top=20):
+    '''
+    Write the profile report of a run
+
+    The time of each stage of each tree is written to <prefix>.profile.tsv
+    and the stage summary with the slowest trees to <prefix>.profile.txt.
+
+    Args:
+        profdir (str): profile directory
+
+        prefix (str): report prefix
+
+        top (int): number of slowest trees in the report
+    '''
+
+    profdf = read_profiles(profdir)
+    profdf['leafno'] = profdf['leafno'].fillna(-1).astype(int)
+    times = get_tree_times(profdf)
+    times.to_csv('%s.profile.tsv' % prefix, sep='\t', index=False)
+
+    summary = get_stage_summary(profdf)
+    with open('%s.profile.txt' % prefix, 'w') as handle:
+        handle.write('Trees: %s (%s failed)\n' %
+                     (len(times), int(times['failed'].sum())))
+        handle.write('Tree time: %.2f s\n\n' % times['total'].sum())
+        handle.write('Stages\n')
+        handle.write(summary.to_string(float_format='%.4f'))
+        handle.write('\n\nSlowest %s trees\n' % top)
+        handle.write(times.head(top).to_string(index=False,
+                                               float_format='%.4f'))
+        handle.write('\n')
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='profdir',
+                      help='Profile directory of a profiled run.',
+                      metavar='<prefix.profile>')
+    parser.add_option('-o', '--output', dest='prefix',
+                      help=('Report prefix, the report is written to '
+                            '<prefix>.profile.txt and the stage times of '
+                            'each tree to <prefix>.profile.tsv.'),
+                      metavar='<prefix>')
+    parser.add_option('-n', '--top', dest='top',
+                      help='Number of slowest trees in the report.',
+                      metavar='<N>', type='int', default=20)
+    (options, args) = parser.parse_args()
+
+    write_report(options.profdir, options.prefix, options.top)
+
+
+if __name__ == '__main__':
+    main()
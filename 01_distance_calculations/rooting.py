@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+rooting.py -- Linear time rooting of array trees
+
+The outgroups of the midpoint and species age rootings are found on the
+arrays of an ArrayTree in O(n), and the tree is rerooted on its arrays
+without building node objects. The results are the ones of ete3: the
+midpoint outgroup is the node get_midpoint_outgroup returns, the species
+age one is the sequence treefuns.root selects, and set_outgroup orders the
+nodes, branch lengths and supports of the rerooted tree as the ete3
+set_outgroup method does.
+
+The rooting modes of the distance scripts are named in ROOT_MODES, and
+get_rooting gives the rooting function of each of them.
+
+Requirements:
+ - functools
+ - numpy
+'''
+
+# Import libraries ----
+from functools import partial
+import numpy as np
+
+
+# Rooting modes ----
+ROOT_MODES = ['species_age', 'midpoint']
+
+
+# Define functions ----
+def get_lca_depths(tree, node):
+    '''
+    Get the root distance of the MRCA of a node with every node of the tree
+
+    The MRCA depth of the nodes in the subtree of each ancestor of the node
+    is the depth of that ancestor, so the depths are accumulated as the
+    differences between consecutive ancestors at the start and end of
+    their subtrees, in O(n).
+
+    Args:
+        tree (ArrayTree): tree
+        node (int): node index
+
+    Returns:
+        np.ndarray: root distance of the MRCA of node with each node
+    '''
+
+    path = list()
+    while node >= 0:
+        path.append(node)
+        node = int(tree.parent[node])
+    path = np.array(path[::-1], dtype=np.int64)
+
+    steps = np.diff(tree.depth[path], prepend=0.0)
+    delta = np.zeros(len(tree.parent) + 1, dtype=np.float64)
+    np.add.at(delta, path, steps)
+    np.add.at(delta, path + tree.size[path], -steps)
+
+    return np.cumsum(delta[:-1])
+
+
+def get_midpoint_outgroup(tree):
+    '''
+    Get the outgroup of the midpoint rooting of a tree
+
+    As ete3 get_midpoint_outgroup, the farthest leaf from the root and the
+    farthest leaf from it define the longest path of the tree, and the
+    outgroup is the first node going up from the first leaf whose branch
+    crosses the middle of that path. Both farthest leaf sweeps are a pass
+    over the root distances of the leaves.
+
+    Args:
+        tree (ArrayTree): tree, rooted or unrooted
+
+    Returns:
+        int: outgroup node index
+    '''
+
+    leaves = tree.leafidx
+    first = int(leaves[np.argmax(tree.depth[leaves])])
+    dists = (tree.depth[first] + tree.depth[leaves] -
+             2 * get_lca_depths(tree, first)[leaves])
+    middist = float(np.max(dists)) / 2.0
+
+    # Going up from the first leaf until its path passes the middle
+    cdist = 0.0
+    current = first
+    while current >= 0:
+        cdist += tree.brlen[current]
+        if cdist > middist:
+            break
+        current = int(tree.parent[current])
+
+    # The tree is already rooted at its midpoint
+    if current < 0:
+        current = 1
+
+    return current
+
+
+def get_species_age_outgroup(tree, root_dict):
+    '''
+    Get the outgroup of the species age rooting of a tree
+
+    As treefuns.root, the outgroup is the first sequence whose name
+    contains the oldest species of the tree, or the farthest leaf from the
+    root if none of the tree species has an age.
+
+    Args:
+        tree (ArrayTree): tree
+        root_dict (dict): species age dictionary, the first species of the
+        maximum age is selected
+
+    Returns:
+        int: outgroup leaf index
+    '''
+
+    leaves = tree.leafidx
+    tree_sp = set(tree.species[x]
+                  for x in np.unique(tree.leaf_sp[leaves]).tolist())
+    if not any(sp in root_dict for sp in tree_sp):
+        return int(leaves[np.argmax(tree.depth[leaves])])
+
+    ogdval = max(root_dict.get(sp, 0) for sp in tree_sp)
+    ogsps = next(k for k, val in root_dict.items()
+                 if val == ogdval and k in tree_sp)
+
+    return next(int(x) for x in leaves if ogsps in tree.names[x])
+
+
+def set_outgroup(tree, outgroup):
+    '''
+    Reroot a tree in place with an outgroup
+
+    The moves of ete3 set_outgroup are applied to the children lists of the
+    nodes: the root children other than the one leading to the outgroup
+    are joined below a new node if there are more than one, the path from
+    the root to the outgroup parent is reversed passing each branch length
+    and support to the node below, and the outgroup branch is split in two
+    halves. The nodes are then numbered again in preorder. New arrays are
+    created, so the arrays of the tree may be read-only views such as the
+    ones of a tree store, and the leaf annotations are cleared.
+
+    Args:
+        tree (ArrayTree): tree, its handle has to be the root
+        outgroup (int): outgroup node index
+
+    Raises:
+        ValueError: if the outgroup is the root
+    '''
+
+    if outgroup == 0:
+        raise ValueError('Cannot set the root as outgroup.')
+
+    n = len(tree.parent)
+    par = tree.parent.tolist()
+    brlen = tree.brlen.tolist()
+    supports = tree.supports.tolist()
+    names = tree.names.tolist()
+    leaf_sp = tree.leaf_sp.tolist()
+    evolcode = tree.evolcode.tolist()
+    children = [list() for _ in range(n)]
+    for i in range(1, n):
+        children[par[i]].append(i)
+
+    # Path from the root child leading to the outgroup to its parent
+    path = list()
+    node = par[outgroup]
+    while node != 0:
+        path.append(node)
+        node = par[node]
+    path = path[::-1]
+    top = path[0] if path else outgroup
+
+    # Joining the rest of the root children
+    children[0].remove(top)
+    if len(children[0]) != 1:
+        connector = len(par)
+        par.append(0)
+        brlen.append(0.0)
+        supports.append(supports[top])
+        names.append('')
+        leaf_sp.append(-1)
+        evolcode.append(0)
+        children.append(children[0])
+    else:
+        connector = children[0][0]
+
+    if path:
+        # Reversing the path, each node gets the branch of its old child
+        for upper, lower in zip(path, path[1:]):
+            children[upper].remove(lower)
+            children[lower].append(upper)
+            brlen[upper] = brlen[lower]
+            supports[upper] = supports[lower]
+        children[top].append(connector)
+        brlen[connector] += tree.brlen[top]
+        outgroup2 = path[-1]
+        children[outgroup2].remove(outgroup)
+        brlen[outgroup2] = 0.0
+    else:
+        outgroup2 = connector
+
+    children[0] = [outgroup, outgroup2]
+    middist = (brlen[outgroup2] + brlen[outgroup]) / 2
+    brlen[outgroup] = middist
+    brlen[outgroup2] = middist
+    supports[outgroup2] = supports[outgroup]
+
+    # Numbering the nodes in preorder
+    order = list()
+    newpar = list()
+    stack = [(0, -1)]
+    while stack:
+        node, up = stack.pop()
+        newpar.append(up)
+        up = len(order)
+        order.append(node)
+        stack.extend((child, up) for child in reversed(children[node]))
+
+    tree.parent = np.array(newpar, dtype=np.int32)
+    tree.brlen = np.array([brlen[x] for x in order], dtype=np.float64)
+    tree.supports = np.array([supports[x] for x in order], dtype=np.float64)
+    tree.names = np.array([names[x] for x in order], dtype=object)
+    tree.leaf_sp = np.array([leaf_sp[x] for x in order], dtype=np.int32)
+    tree.evolcode = np.array([evolcode[x] for x in order], dtype=np.int8)
+    tree.features = dict()
+    tree.top = 0
+    tree.update()
+
+
+def midpoint_root(tree):
+    '''
+    Root an array tree at its midpoint in place
+
+    Args:
+        tree (ArrayTree): tree
+    '''
+
+    set_outgroup(tree, get_midpoint_outgroup(tree))
+
+
+def species_age_root(tree, root_dict):
+    '''
+    Root an array tree by the species ages in place
+
+    Args:
+        tree (ArrayTree): tree
+        root_dict (dict): species age dictionary, as in treefuns.root
+
+    Returns:
+        str: the outgroup sequence
+    '''
+
+    outgroup = get_species_age_outgroup(tree, root_dict)
+    ogseq = tree.names[outgroup]
+    set_outgroup(tree, outgroup)
+
+    return ogseq
+
+
+def get_rooting(mode, root_dict=None):
+    '''
+    Get the rooting function of a rooting mode
+
+    Args:
+        mode (str): rooting mode, one of ROOT_MODES
+
+        root_dict (dict): species age dictionary of the species age mode
+
+    Returns:
+        tuple: function rooting an ArrayTree in place and the rooting
+        parameters, as read_rooted takes them
+
+    Raises:
+        ValueError: if the mode is unknown
+    '''
+
+    if mode == 'species_age':
+        return partial(species_age_root, root_dict=root_dict), root_dict
+    elif mode == 'midpoint':
+        return midpoint_root, None
+    else:
+        raise ValueError('Unknown rooting mode %s, it must be one of: %s.' %
+                         (mode, ', '.join(ROOT_MODES)))
+
+
+def parse_root_modes(modes):
+    '''
+    Parse a list of rooting modes
+
+    Args:
+        modes (str): comma separated rooting modes
+
+    Returns:
+        list: rooting modes in the given order, without repetitions
+
+    Raises:
+        ValueError: if a mode is unknown
+    '''
+
+    parsed = list()
+    for mode in modes.split(','):
+        mode = mode.strip()
+        if mode not in ROOT_MODES:
+            raise ValueError('Unknown rooting mode %s, it must be one of: '
+                             '%s.' % (mode, ', '.join(ROOT_MODES)))
+        if mode not in parsed:
+            parsed.append(mode)
+
+    return parsed
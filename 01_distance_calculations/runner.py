@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+runner.py -- Parallel execution of the per-tree distance workers
+
+The distance scripts define a worker class whose constructor receives the
+read-only context of the run (clade species, species ages, first splits...)
+and whose run method processes one tree line. Each process of the pool
+builds its worker once in the pool initializer, so the context is sent once
+per process instead of once per tree, and the tree lines are dispatched in
+chunks. When profiling, each process records the stages of its trees (see
+profiling.py).
+
+Requirements:
+ - multiprocessing
+ - traceback
+'''
+
+# Import libraries ----
+from multiprocessing import Pool
+import traceback
+import profiling
+
+
+# Worker of the current process, set by init_worker
+WORKER = None
+
+
+# Define functions ----
+def init_worker(worker_class, context, profile=None):
+    '''
+    Pool initializer building the process worker
+
+    Args:
+        worker_class (class): worker class, it has a run(line) method
+
+        context (dict): keyword arguments of the worker class constructor
+
+        profile (dict): keyword arguments of profiling.enable, None to not
+        profile the trees
+    '''
+
+    global WORKER
+    if profile is not None:
+        profiling.enable(**profile)
+    WORKER = worker_class(**context)
+
+
+def run_worker(line):
+    '''
+    Process a tree line with the process worker
+
+    Errors are reported and the tree is skipped, as a failing tree must not
+    stop the whole phylome.
+
+    Args:
+        line (str): tree line
+
+    Returns:
+        tuple: the tree seed and the worker output, None if the tree failed
+    '''
+
+    seed = line.split('\t', 1)[0]
+    profiling.start_tree(seed)
+    try:
+        result = seed, WORKER.run(line)
+    except Exception:
+        print('Tree %s failed:' % seed)
+        traceback.print_exc()
+        result = None
+    profiling.end_tree(result is None)
+
+    return result
+
+
+def start_pool(worker_class, context, threads, profile=None):
+    '''
+    Start a pool of persistent workers
+
+    The pool can process several batches of tree lines with imap_unordered
+    and run_worker, its processes keep their worker between batches.
+
+    Args:
+        worker_class (class): worker class, it has a run(line) method
+
+        context (dict): keyword arguments of the worker class constructor
+
+        threads (int): number of processes
+
+        profile (dict): keyword arguments of profiling.enable, None to not
+        profile the trees
+
+    Returns:
+        Pool: the process pool
+    '''
+
+    return Pool(threads, initializer=init_worker,
+                initargs=(worker_class, context, profile))
+
+
+def run_pool(lines, worker_class, context, threads, chunksize=1,
+             profile=None):
+    '''
+    Process tree lines with a pool of persistent workers
+
+    Args:
+        lines (iterable): tree lines
+
+        worker_class (class): worker class, it has a run(line) method
+
+        context (dict): keyword arguments of the worker class constructor
+
+        threads (int): number of processes
+
+        chunksize (int): number of tree lines sent to a process at once
+
+        profile (dict): keyword arguments of profiling.enable, None to not
+        profile the trees
+
+    Returns:
+        generator: seed and worker output tuples in order of completion
+    '''
+
+    with start_pool(worker_class, context, threads, profile) as pool:
+        for result in pool.imap_unordered(run_worker, lines, chunksize):
+            yield result
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+shards.py -- Static sharding of a phylome across jobs
+
+The trees file is indexed once: the byte offset of each line is stored in
+<file.nwk>.idx with the seed and the number of leaves and species read
+from the raw newick string. A run with --shard i/N only reads the lines of
+the i-th of N shards, seeking to them through the index, so the phylome can
+be spread across the jobs of a cluster array. The shards are balanced by
+the estimated cost of their trees rather than by their number of lines.
+
+Each shard writes its own table, <prefix>.<i>of<N>.<format>, which can be
+resumed as the tables of a whole run. Once all of them are finished this
+script merges them into <prefix>.<format>.
+
+Requirements:
+ - os
+ - numpy
+ - pyarrow (optional, Parquet output)
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+import os
+import shutil
+import numpy as np
+from treefuns import get_newick_leaves, get_species, check_tree_size
+from treestore import TreeStore
+from utils import file_exists
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+# Define functions ----
+def index_trees(ifile):
+    '''
+    Index the lines of a phylome trees file
+
+    The index is written next to the file and reused while it is newer than
+    it. It is written to a temporary file first, so jobs building it at the
+    same time do not read a partial index.
+
+    Args:
+        ifile (str): file with multiple trees in newick, each line has the
+        format: seed\tmodel\tlikelihood\tnewick
+
+    Returns:
+        dict: seed list and offset, leafno and spno arrays of the non-empty
+        lines in the file order
+    '''
+
+    idxfile = '%s.idx' % ifile
+    if (not file_exists(idxfile) or
+            os.path.getmtime(idxfile) < os.path.getmtime(ifile)):
+        tmpfile = '%s.%s.tmp' % (idxfile, os.getpid())
+        with open(ifile, 'rb') as handle, open(tmpfile, 'w') as ohandle:
+            offset = 0
+            for line in handle:
+                if line.strip() != b'':
+                    fields = line.decode().rstrip('\n').split('\t')
+                    leaves = get_newick_leaves(fields[3])
+                    spno = len(set(get_species(x) for x in leaves))
+                    ohandle.write('%s\t%s\t%s\t%s\n' % (fields[0], offset,
+                                                        len(leaves), spno))
+                offset += len(line)
+        os.replace(tmpfile, idxfile)
+
+    seeds, values = list(), list()
+    with open(idxfile) as handle:
+        for line in handle:
+            fields = line.rstrip('\n').split('\t')
+            seeds.append(fields[0])
+            values.append([int(x) for x in fields[1:]])
+    values = np.array(values, dtype=np.int64).reshape(-1, 3)
+
+    return {'seeds': seeds,
+            'offset': values[:, 0],
+            'leafno': values[:, 1],
+            'spno': values[:, 2]}
+
+
+def index_store(store):
+    '''
+    Index the trees of a tree store as index_trees indexes a trees file
+
+    Args:
+        store (str): tree store directory
+
+    Returns:
+        dict: seed list and leafno and spno arrays in the store order
+    '''
+
+    tstore = TreeStore(store)
+    leafno, spno = list(), list()
+    for seed in tstore.seeds:
+        start, end = tstore.index[seed][2:]
+        leafsp = tstore.arrays['leafsp'][start:end]
+        leafsp = leafsp[leafsp >= 0]
+        leafno.append(len(leafsp))
+        spno.append(len(np.unique(leafsp)))
+
+    return {'seeds': tstore.seeds,
+            'leafno': np.array(leafno, dtype=np.int64),
+            'spno': np.array(spno, dtype=np.int64)}
+
+
+def get_tree_costs(index, power=1, filters=None):
+    '''
+    Estimate the cost of the trees of an index
+
+    The cost of a tree is its number of leaves to the given power, 1 for
+    the distance per leaf and 2 for the distance per leaf pair. Trees
+    skipped by the size filters only cost their screening.
+
+    Args:
+        index (dict): index from index_trees or index_store
+
+        power (int): exponent of the number of leaves
+
+        filters (dict): min_species, max_leaves and max_copies of the run
+
+    Returns:
+        numpy.ndarray: estimated cost of each tree
+    '''
+
+    costs = index['leafno'].astype(float) ** power
+    if filters:
+        for i in range(len(costs)):
+            if not check_tree_size(index['leafno'][i], index['spno'][i],
+                                   **filters):
+                costs[i] = 1
+
+    return costs
+
+
+def parse_shard(shard):
+    '''
+    Parse a shard specification
+
+    Args:
+        shard (str): i/N, the i-th of N shards, counting from 1
+
+    Returns:
+        tuple: shard number and number of shards
+
+    Raises:
+        ValueError: if the specification is not i/N with 1 <= i <= N
+    '''
+
+    try:
+        i, nshards = [int(x) for x in shard.split('/')]
+    except ValueError:
+        raise ValueError('The shard must be i/N, got %s.' % shard)
+
+    if not 1 <= i <= nshards:
+        raise ValueError('The shard must be between 1 and %s.' % nshards)
+
+    return i, nshards
+
+
+def get_shard(costs, shard, nshards):
+    '''
+    Get the trees of a shard balanced by their cost
+
+    The trees are assigned from the most to the least costly to the shard
+    with the lowest total cost so far, so every job computes the same
+    assignment from the same index.
+
+    Args:
+        costs (numpy.ndarray): estimated cost of each tree
+
+        shard (int): shard number, counting from 1
+
+        nshards (int): number of shards
+
+    Returns:
+        numpy.ndarray: positions of the shard trees in the index, sorted
+    '''
+
+    totals = np.zeros(nshards)
+    assigned = np.zeros(len(costs), dtype=np.int64)
+    for i in np.argsort(-costs, kind='stable'):
+        j = int(np.argmin(totals))
+        assigned[i] = j
+        totals[j] += costs[i]
+
+    return np.flatnonzero(assigned == shard - 1)
+
+
+def read_lines(ifile, offsets):
+    '''
+    Read the lines starting at some byte offsets of a file
+
+    Args:
+        ifile (str): file path
+
+        offsets (iterable): byte offsets of the lines
+
+    Returns:
+        generator: the lines
+    '''
+
+    with open(ifile, 'rb') as handle:
+        for offset in offsets:
+            handle.seek(offset)
+            yield handle.readline().decode()
+
+
+def get_shard_rows(ifile, shard, store=None, power=1, filters=None):
+    '''
+    Get the tree rows of a shard of a phylome
+
+    Args:
+        ifile (str): trees file, ignored if store is given
+
+        shard (str): i/N shard specification
+
+        store (str): tree store directory
+
+        power (int): exponent of the number of leaves in the tree costs
+
+        filters (dict): size filters of the run
+
+    Returns:
+        generator: tree lines, or tree seeds if store is given
+    '''
+
+    i, nshards = parse_shard(shard)
+    if store is not None:
+        index = index_store(store)
+    else:
+        index = index_trees(ifile)
+
+    positions = get_shard(get_tree_costs(index, power, filters), i, nshards)
+    if store is not None:
+        return (index['seeds'][x] for x in positions)
+    else:
+        return read_lines(ifile, index['offset'][positions])
+
+
+def get_shard_file(ofile, shard):
+    '''
+    Get the output table of a shard
+
+    Args:
+        ofile (str): output table of the whole run
+
+        shard (str): i/N shard specification
+
+    Returns:
+        str: <prefix>.<i>of<N>.<format> path
+    '''
+
+    i, nshards = parse_shard(shard)
+    root, ext = os.path.splitext(ofile)
+
+    return '%s.%sof%s%s' % (root, i, nshards, ext)
+
+
+def merge_tables(ofile, tfiles):
+    '''
+    Merge finished tables of the same run
+
+    The CSV tables are concatenated without their headers but the first one
+    and the row groups of the Parquet tables are copied to the merged table.
+    The merged table is written to <file>.part and renamed when it is done.
+
+    Args:
+        ofile (str): merged table path, Parquet if it ends with .parquet
+
+        tfiles (list): paths of the tables to merge, in order
+    '''
+
+    partfile = '%s.part' % ofile
+    if ofile.endswith('.parquet'):
+        if pq is None:
+            raise ImportError('The Parquet output requires pyarrow.')
+        schema = pq.ParquetFile(tfiles[0]).schema_arrow
+        with pq.ParquetWriter(partfile, schema) as writer:
+            for tfile in tfiles:
+                pfile = pq.ParquetFile(tfile)
+                for i in range(pfile.num_row_groups):
+                    writer.write_table(pfile.read_row_group(i).cast(schema))
+    else:
+        with open(partfile, 'wb') as ohandle:
+            for i, tfile in enumerate(tfiles):
+                with open(tfile, 'rb') as handle:
+                    header = handle.readline()
+                    if i == 0:
+                        ohandle.write(header)
+                    shutil.copyfileobj(handle, ohandle)
+
+    os.replace(partfile, ofile)
+
+
+def merge_shards(ofile, nshards):
+    '''
+    Merge the finished shard tables of a run
+
+    Args:
+        ofile (str): output table of the whole run
+
+        nshards (int): number of shards
+
+    Raises:
+        FileNotFoundError: if a shard table is not finished
+    '''
+
+    sfiles = [get_shard_file(ofile, '%s/%s' % (i, nshards))
+              for i in range(1, nshards + 1)]
+    for sfile in sfiles:
+        if not file_exists(sfile):
+            raise FileNotFoundError('Shard table %s is not finished.' % sfile)
+
+    merge_tables(ofile, sfiles)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-p', '--prefix', dest='prefix',
+                      help='Output prefix of the sharded run.',
+                      metavar='</path/to/dir/prefix> or <prefix>',
+                      default='dist_output')
+    parser.add_option('-n', '--shards', dest='nshards',
+                      help='Number of shards of the run.',
+                      metavar='<N>', type='int')
+    parser.add_option('-o', '--format', dest='format',
+                      help='Output table format (csv or parquet).',
+                      metavar='<format>', type='choice',
+                      choices=['csv', 'parquet'], default='csv')
+    parser.add_option('-r', '--redo', dest='redo',
+                      help='Ommit done file and redo.',
+                      action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    prefix = options.prefix
+    nshards = options.nshards
+    oformat = options.format
+    redo = options.redo
+
+    ofile = '%s.%s' % (prefix, oformat)
+
+    if not file_exists(ofile) or redo:
+        merge_shards(ofile, nshards)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+simulate_phylome.py -- Synthetic phylomes with duplications and losses
+
+The script simulates gene trees over a species tree and writes them in the
+seed\tmodel\tlikelihood\tnewick format of the distance scripts, with the
+species tree and a clade table to run them. Each gene family starts as a
+single gene at the root of the species tree and evolves along its
+branches by a birth-death process: every gene duplicates at the
+duplication rate and is lost at the loss rate, and it is copied to both
+child species at each speciation. The lost lineages are pruned, the
+branch lengths are the times scaled by a tree rate and a lognormal rate
+of each branch, and the tree is unrooted as the phylome trees are. The
+sequences are named Phy<number>_<SPECIES> and the seed of each tree is one
+of the sequences of the seed species.
+
+The size of the trees is set by the target leaf number: the duplication
+rate is the loss rate plus the growth rate that gives the target number
+of genes per species on average, and trees are simulated until one is
+within the size tolerance of the target. Targets are drawn log-uniformly
+from the leaf range. With the same random seed the same phylome is
+written, so phylomes can be shared as a seed and a command line.
+
+The species tree is the one given or a random ultrametric Yule tree. The
+clade table has a column for each clade containing the seed species, named
+by its preorder number in the species tree, with the species of the clade
+and NA in the rows of the rest of species, as node_data.tsv.
+
+Requirements:
+ - math
+ - random
+ - ete3
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+import math
+import random
+import ete3
+from treefuns import get_species_sptree
+from utils import create_folder
+
+
+# Inference models of the simulated tree lines
+MODELS = ['JTT+G4', 'LG+G4', 'WAG+G4', 'JTTDCMut+R4', 'LG+F+R4']
+
+
+# Define functions ----
+def get_random_sptree(spno, height=2.0, rng=random):
+    '''
+    Simulate an ultrametric species tree with a Yule process
+
+    Args:
+        spno (int): number of species, at least 2
+
+        height (float): root to tip distance
+
+        rng (Random): random number generator
+
+    Returns:
+        PhyloTree: species tree with the species codes SP<letters> as
+        leaf names
+
+    Raises:
+        ValueError: if there are fewer than two species
+    '''
+
+    if spno < 2:
+        raise ValueError('The species tree needs at least two species.')
+
+    # Splitting a random lineage at each step, the times are rescaled to
+    # the height at the end
+    root = ete3.PhyloTree(sp_naming_function=get_species_sptree)
+    lineages = [root]
+    now = 0.0
+    starts = {root: 0.0}
+    while len(lineages) < spno:
+        now += rng.expovariate(len(lineages))
+        node = lineages.pop(rng.randrange(len(lineages)))
+        node.dist = now - starts[node]
+        for _ in range(2):
+            child = node.add_child()
+            starts[child] = now
+            lineages.append(child)
+    now += rng.expovariate(len(lineages))
+    for node in lineages:
+        node.dist = now - starts[node]
+
+    root.dist = 0.0
+    for node in root.iter_descendants():
+        node.dist = node.dist * height / now
+
+    for i, leaf in enumerate(root.iter_leaves()):
+        code = ''
+        for _ in range(3):
+            code = chr(ord('A') + i % 26) + code
+            i //= 26
+        leaf.name = 'SP' + code
+
+    return root
+
+
+def get_sptree_height(sptree):
+    # Root to tip distance of the farthest species
+    return max(sptree.get_distance(x) for x in sptree.get_leaves())
+
+
+def get_clades(sptree, seedsp):
+    '''
+    Get the clades containing the seed species
+
+    Args:
+        sptree (PhyloTree): species tree
+
+        seedsp (str): species code of the seed
+
+    Returns:
+        dict: preorder number of each clade, from the largest to the
+        smallest one without the root and the seed species, as key and the
+        species of the clade as value
+
+    Raises:
+        ValueError: if the seed species is not in the species tree
+    '''
+
+    number = {node: i for i, node in enumerate(sptree.traverse('preorder'))}
+    seednode = sptree.search_nodes(name=seedsp)
+    if not seednode:
+        raise ValueError('Species %s is not in the species tree.' % seedsp)
+
+    clades = dict()
+    for node in reversed(seednode[0].get_ancestors()[:-1]):
+        clades[str(number[node])] = node.get_leaf_names()
+
+    return clades
+
+
+def write_clades(clades, species, ofile):
+    '''
+    Write the clade table of a species tree
+
+    Args:
+        clades (dict): species of each clade, as returned by get_clades
+
+        species (list): species codes, one row for each of them
+
+        ofile (str): output tsv file
+    '''
+
+    with open(ofile, 'w') as handle:
+        handle.write('\t'.join(clades) + '\n')
+        for sp in species:
+            row = [sp if sp in spl else 'NA' for spl in clades.values()]
+            handle.write('\t'.join(row) + '\n')
+
+
+def get_dupl_rate(target, spno, height, loss):
+    '''
+    Get the duplication rate giving a number of genes on average
+
+    A gene evolving by duplications and losses for a time t leaves
+    exp((dupl - loss) * t) genes on average, so the growth rate giving
+    target / spno genes per species at the tips is log(target / spno) / t.
+
+    Args:
+        target (int): target number of leaves of a tree
+
+        spno (int): number of species
+
+        height (float): root to tip distance of the species tree
+
+        loss (float): loss rate
+
+    Returns:
+        float: duplication rate, 0 if the losses alone give fewer genes
+    '''
+
+    growth = math.log(target / spno) / height
+
+    return max(loss + growth, 0.0)
+
+
+def grow_lineage(spnode, elapsed, dupl, loss, rng):
+    '''
+    Simulate a gene lineage from a point of a species tree branch
+
+    The events of the lineage are simulated until the end of the branch,
+    where the lineage is copied to the child species or, in a species tree
+    leaf, becomes a gene. Lost lineages are pruned on return, so a node
+    with a single surviving child is merged with its branch.
+
+    Args:
+        spnode (TreeNode): species tree node of the branch
+
+        elapsed (float): time of the lineage start from the branch start
+
+        dupl (float): duplication rate
+
+        loss (float): loss rate
+
+        rng (Random): random number generator
+
+    Returns:
+        list: gene node as [species, children, branch length], None if
+        all the genes of the lineage are lost
+    '''
+
+    rate = dupl + loss
+    wait = rng.expovariate(rate) if rate > 0 else math.inf
+    if elapsed + wait < spnode.dist:
+        if rng.random() * rate >= dupl:
+            return None
+        children = [grow_lineage(spnode, elapsed + wait, dupl, loss, rng)
+                    for _ in range(2)]
+        length = wait
+    elif spnode.is_leaf():
+        return [spnode.name, [], spnode.dist - elapsed]
+    else:
+        children = [grow_lineage(child, 0.0, dupl, loss, rng)
+                    for child in spnode.children]
+        length = spnode.dist - elapsed
+
+    children = [x for x in children if x is not None]
+    if not children:
+        return None
+    elif len(children) == 1:
+        children[0][2] += length
+        return children[0]
+
+    return [None, children, length]
+
+
+def get_gene_leaves(gene):
+    # Gene tree leaves in order, iterating to avoid deep recursions
+    leaves = list()
+    stack = [gene]
+    while stack:
+        node = stack.pop()
+        if node[1]:
+            stack.extend(reversed(node[1]))
+        else:
+            leaves.append(node)
+
+    return leaves
+
+
+def unroot_gene(gene):
+    # Joining the two root branches in a basal trifurcation
+    if len(gene[1]) != 2:
+        return gene
+    first, second = gene[1]
+    if not second[1]:
+        first, second = second, first
+    if not second[1]:
+        return gene
+
+    first[2] += second[2]
+    gene[1] = [first] + second[1]
+
+    return gene
+
+
+def get_newick(gene, rate, sd, rng):
+    '''
+    Write a simulated gene tree in newick
+
+    Args:
+        gene (list): gene tree root with the leaves named
+
+        rate (float): rate of the tree, branch length per unit of time
+
+        sd (float): standard deviation of the log of the branch rates
+
+        rng (Random): random number generator
+
+    Returns:
+        str: newick tree
+    '''
+
+    def write(node):
+        # Branches are scaled as they are written
+        length = node[2] * rate * rng.lognormvariate(0.0, sd)
+        if not node[1]:
+            return '%s:%.6f' % (node[0], length)
+        return '(%s):%.6f' % (','.join(write(x) for x in node[1]), length)
+
+    return '(%s);' % ','.join(write(x) for x in gene[1])
+
+
+def simulate_tree(sptree, seedsp, target, loss, tolerance=0.2,
+                  attempts=1000, rng=random):
+    '''
+    Simulate a gene tree of a target size
+
+    Trees without genes of the seed species or with fewer than four
+    leaves are rejected. The first tree within the tolerance of the target
+    size is returned, or the closest one after the attempts.
+
+    Args:
+        sptree (PhyloTree): species tree
+
+        seedsp (str): species code of the seed
+
+        target (int): target number of leaves
+
+        loss (float): loss rate
+
+        tolerance (float): relative difference allowed with the target
+
+        attempts (int): maximum number of simulations
+
+        rng (Random): random number generator
+
+    Returns:
+        list: gene tree root, as in grow_lineage, with its leaves
+    '''
+
+    dupl = get_dupl_rate(target, len(sptree), get_sptree_height(sptree),
+                         loss)
+
+    best, bestdiff = None, math.inf
+    for _ in range(attempts):
+        # The gene starts at the root, after the root branch if any
+        gene = grow_lineage(sptree, sptree.dist, dupl, loss, rng)
+        if gene is None or not gene[1]:
+            continue
+        leaves = get_gene_leaves(gene)
+        if len(leaves) < 4 or not any(x[0] == seedsp for x in leaves):
+            continue
+
+        diff = abs(len(leaves) - target) / target
+        if diff < bestdiff:
+            best, bestdiff = (gene, leaves), diff
+        if diff <= tolerance:
+            break
+
+    if best is None:
+        raise ValueError('No tree with genes of %s was simulated in %s '
+                         'attempts.' % (seedsp, attempts))
+
+    return best
+
+
+def simulate_phylome(sptree, seedsp, ofile, treeno, minleaves, maxleaves,
+                     loss=0.5, sd=0.3, tolerance=0.2, seed=None):
+    '''
+    Simulate a phylome and write its tree lines
+
+    Args:
+        sptree (PhyloTree): species tree
+
+        seedsp (str): species code of the seeds
+
+        ofile (str): output file of the tree lines
+
+        treeno (int): number of trees
+
+        minleaves (int): minimum target leaf number
+
+        maxleaves (int): maximum target leaf number
+
+        loss (float): loss rate, per unit of the species tree
+
+        sd (float): standard deviation of the log of the branch rates
+
+        tolerance (float): relative difference allowed with the target
+        leaf number
+
+        seed (int): random seed
+
+    Returns:
+        list: leaf number of each tree
+    '''
+
+    rng = random.Random(seed)
+    seqno = 0
+    leafnos = list()
+    with open(ofile, 'w') as handle:
+        for _ in range(treeno):
+            target = round(math.exp(rng.uniform(math.log(minleaves),
+                                                math.log(maxleaves))))
+            gene, leaves = simulate_tree(sptree, seedsp, target, loss,
+                                         tolerance, rng=rng)
+
+            # Naming the sequences and picking the seed
+            for leaf in leaves:
+                seqno += 1
+                leaf[0] = 'Phy%07d_%s' % (seqno, leaf[0])
+            seed_seq = rng.choice([x[0] for x in leaves
+                                   if x[0].endswith('_' + seedsp)])
+
+            newick = get_newick(unroot_gene(gene), rng.uniform(0.2, 1.0), sd,
+                                rng)
+            lk = -len(leaves) * rng.uniform(150, 400)
+            handle.write('%s\t%s\t%.4f\t%s\n' % (seed_seq, rng.choice(MODELS),
+                                                 lk, newick))
+            leafnos.append(len(leaves))
+
+    return leafnos
+
+
+def write_species_data(prefix, sptree=None, seedsp=None, spno=25, seed=None):
+    '''
+    Write the species tree and the clade table of a synthetic phylome
+
+    Args:
+        prefix (str): output prefix, the files are <prefix>_sp_tree.nwk and
+        <prefix>_node_data.tsv
+
+        sptree (str): newick file of the species tree, None to simulate a
+        random one
+
+        seedsp (str): species code of the seed, the last species of the
+        species tree by default
+
+        spno (int): number of species of the random species tree
+
+        seed (int): random seed of the species tree
+
+    Returns:
+        tuple: species tree and seed species
+    '''
+
+    if sptree is None:
+        sptree = get_random_sptree(spno, rng=random.Random(seed))
+    else:
+        sptree = ete3.PhyloTree(sptree, sp_naming_function=get_species_sptree)
+    if seedsp is None:
+        seedsp = sptree.get_leaf_names()[-1]
+
+    sptree.write(outfile='%s_sp_tree.nwk' % prefix, format=5)
+    write_clades(get_clades(sptree, seedsp), sptree.get_leaf_names(),
+                 '%s_node_data.tsv' % prefix)
+
+    return sptree, seedsp
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-s', '--sptree', dest='sptree',
+                      help=('Newick file containing the species tree, a '
+                            'random one is simulated if not given.'),
+                      metavar='<file.nwk>')
+    parser.add_option('-x', '--species', dest='spno',
+                      help='Number of species of the random species tree.',
+                      metavar='<N>', type='int', default=25)
+    parser.add_option('-l', '--seedsp', dest='seedsp',
+                      help=('Species\' code for the seed, the last species '
+                            'of the species tree by default.'),
+                      metavar='<SPECIES>')
+    parser.add_option('-N', '--trees', dest='treeno',
+                      help='Number of trees.',
+                      metavar='<N>', type='int', default=100)
+    parser.add_option('-L', '--leaves', dest='leaves',
+                      help=('Target leaf number of the trees, or range of '
+                            'target leaf numbers drawn log-uniformly.'),
+                      metavar='<N> or <min-max>', default='20-2000')
+    parser.add_option('-m', '--loss', dest='loss',
+                      help=('Loss rate per unit of the species tree branch '
+                            'lengths, the duplication rate is set by the '
+                            'target leaf number.'),
+                      metavar='<X>', type='float', default=0.5)
+    parser.add_option('-v', '--rate-sd', dest='sd',
+                      help=('Standard deviation of the log of the branch '
+                            'rates.'),
+                      metavar='<X>', type='float', default=0.3)
+    parser.add_option('-T', '--tolerance', dest='tolerance',
+                      help=('Relative difference allowed between the leaf '
+                            'number of a tree and its target.'),
+                      metavar='<X>', type='float', default=0.2)
+    parser.add_option('-g', '--seed', dest='seed',
+                      help=('Random seed, the same seed gives the same '
+                            'phylome.'),
+                      metavar='<N>', type='int', default=1)
+    parser.add_option('-p', '--prefix', dest='prefix',
+                      help=('Output prefix, the trees are written to '
+                            '<prefix>_trees.nwk, the species tree to '
+                            '<prefix>_sp_tree.nwk and the clade table to '
+                            '<prefix>_node_data.tsv.'),
+                      metavar='</path/to/dir/prefix> or <prefix>',
+                      default='synthetic')
+    (options, args) = parser.parse_args()
+
+    prefix = options.prefix
+    if '-' in options.leaves:
+        minleaves, maxleaves = [int(x) for x in options.leaves.split('-')]
+    else:
+        minleaves = maxleaves = int(options.leaves)
+
+    if '/' in prefix:
+        odir = prefix.rsplit('/', 1)[0]
+        create_folder(odir)
+
+    sptree, seedsp = write_species_data(prefix, options.sptree,
+                                        options.seedsp, options.spno,
+                                        options.seed)
+    leafnos = simulate_phylome(sptree, seedsp, '%s_trees.nwk' % prefix,
+                               options.treeno, minleaves, maxleaves,
+                               options.loss, options.sd, options.tolerance,
+                               options.seed)
+
+    print('Trees: %s, leaves: %s-%s (median %s)' %
+          (len(leafnos), min(leafnos), max(leafnos),
+           sorted(leafnos)[len(leafnos) // 2]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+conftest.py -- Shared fixtures of the distance calculation tests
+
+The tests run on a small synthetic phylome written by simulate_phylome.py,
+with a random species tree, its clade table and trees of 10 to 60 leaves.
+The phylome only depends on the random seed, so every run tests the same
+trees. The distance scripts are run on it as subprocesses and their
+tables are compared with the ones of a single run of each script.
+'''
+
+# Import libraries ----
+import os
+import subprocess
+import sys
+import pandas as pd
+import pytest
+
+SCRIPTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTDIR)
+
+from simulate_phylome import write_species_data, simulate_phylome  # noqa
+from benchmark import get_driver_cmd, get_normgroup  # noqa
+import get_t2in_dist  # noqa
+
+
+# Phylome of the tests ----
+SEED = 7
+SPNO = 12
+TREENO = 12
+
+# Row keys of the table of each script
+KEYS = {'t2t': ['tree', 'from', 'to'], 't2in': ['seed']}
+
+# The default t2t size filters skip most of the small trees of the phylome
+FILTERS = {'t2t': ['-S', '2', '-C', '100'], 't2in': []}
+
+
+# Define functions ----
+def run_tool(script, args):
+    # Running a script of the module, its output is discarded
+    subprocess.run([sys.executable, os.path.join(SCRIPTDIR, script)] + args,
+                   stdout=subprocess.DEVNULL, check=True)
+
+
+def get_script_cmd(phylome, driver, engine, oprefix, threads=2):
+    # Command line of a distance script run on every tree of the phylome
+    return (get_driver_cmd(driver, phylome, engine, threads, oprefix) +
+            FILTERS[driver])
+
+
+def run_script(phylome, driver, engine, oprefix, extra=None):
+    # Running a distance script, the table of the run is returned
+    cmd = get_script_cmd(phylome, driver, engine, oprefix) + (extra or [])
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+    return '%s.csv' % oprefix
+
+
+def read_table(ofile, keys):
+    odf = pd.read_csv(ofile)
+    return odf.sort_values(keys).reset_index(drop=True)
+
+
+def assert_same_rows(ofile, expected, keys):
+    '''
+    Check that two tables have the same rows, in any order
+
+    Args:
+        ofile (str): CSV table
+
+        expected (str): CSV table with the expected rows, at least one
+
+        keys (list): columns identifying each row
+    '''
+
+    odf = read_table(ofile, keys)
+    expected = read_table(expected, keys)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(odf, expected, check_dtype=False,
+                                  check_exact=False, rtol=1e-9)
+
+
+# Define fixtures ----
+@pytest.fixture(scope='session')
+def phylome(tmp_path_factory):
+    '''
+    Simulate the phylome of the tests
+
+    Returns:
+        dict: trees, sptree, cladedf, seedsp and normgroup arguments of the
+        distance scripts, the tree lines and the species context of
+        get_t2in_dist.get_context
+    '''
+
+    datadir = tmp_path_factory.mktemp('phylome')
+    prefix = str(datadir / 'synthetic')
+    sptree, seedsp = write_species_data(prefix, spno=SPNO, seed=SEED)
+    trees = str(datadir / 'trees.nwk')
+    simulate_phylome(sptree, seedsp, trees, TREENO, 10, 60, seed=SEED)
+
+    data = {'trees': trees,
+            'sptree': '%s_sp_tree.nwk' % prefix,
+            'cladedf': '%s_node_data.tsv' % prefix,
+            'seedsp': seedsp}
+    with open(trees) as handle:
+        data['lines'] = [x.rstrip('\n') for x in handle]
+    data['context'] = get_t2in_dist.get_context(data['sptree'],
+                                                data['cladedf'], seedsp)
+
+    data['normgroup'] = get_normgroup(data['context']['event_species'])
+
+    return data
+
+
+@pytest.fixture(scope='session')
+def single(phylome, tmp_path_factory):
+    '''
+    Run each distance script once on the phylome with the array engine
+
+    Returns:
+        dict: table of each script
+    '''
+
+    odir = tmp_path_factory.mktemp('single')
+    return {driver: run_script(phylome, driver, 'array', str(odir / driver))
+            for driver in KEYS}
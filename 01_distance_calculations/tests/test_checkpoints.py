@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_checkpoints.py -- Checkpoints and resume of the table writers
+
+An interrupted TableWriter keeps the rows of the trees logged in its
+checkpoint, a new run resumes from them and the forced seeds are computed
+again, with every seed written once, in the tables of the writers and of
+the distance scripts.
+'''
+
+# Import libraries ----
+import subprocess
+import pandas as pd
+import pytest
+from conftest import KEYS, get_script_cmd, run_script, assert_same_rows
+from writers import TableWriter, get_done_seeds, get_common_done_seeds
+
+
+COLUMNS = ['seed', 'value']
+
+
+# Define functions ----
+def write_seeds(ofile, seeds, resume=False, fail=False):
+    # Writing two rows per seed, each seed in its own batch
+    with TableWriter(ofile, COLUMNS, resume=resume, seedsize=1) as writer:
+        for seed in seeds:
+            writer.write([{'seed': seed, 'value': 1.5},
+                          {'seed': seed, 'value': 2.5}], seed)
+        if fail:
+            raise KeyboardInterrupt
+
+
+def read_table(ofile):
+    return pd.read_csv(ofile).sort_values(COLUMNS).reset_index(drop=True)
+
+
+# Define tests ----
+def test_resume(tmp_path):
+    ofile = str(tmp_path / 'table.csv')
+    with pytest.raises(KeyboardInterrupt):
+        write_seeds(ofile, ['a', 'b'], fail=True)
+
+    # A last line cut by the interruption is dropped
+    with open('%s.part' % ofile, 'a') as handle:
+        handle.write('c,3.')
+
+    done = get_done_seeds(ofile, 'seed')
+    assert done == {'a', 'b'}
+    write_seeds(ofile, ['c'], resume=len(done) > 0)
+
+    odf = read_table(ofile)
+    assert odf['seed'].tolist() == ['a', 'a', 'b', 'b', 'c', 'c']
+    assert get_done_seeds(ofile, 'seed') is None
+
+
+def test_force(tmp_path):
+    ofile = str(tmp_path / 'table.csv')
+    write_seeds(ofile, ['a', 'b', 'c'])
+    with open(ofile) as handle:
+        lines = handle.readlines()
+
+    done = get_done_seeds(ofile, 'seed', redo_seeds={'b'})
+    assert done == {'a', 'c'}
+
+    # The kept rows are copied as they were written
+    with open('%s.part' % ofile) as handle:
+        assert handle.readlines() == [x for x in lines
+                                      if not x.startswith('b,')]
+
+    write_seeds(ofile, ['b'], resume=True)
+    assert read_table(ofile)['seed'].tolist() == ['a', 'a', 'b', 'b', 'c',
+                                                  'c']
+
+
+def test_redo(tmp_path):
+    ofile = str(tmp_path / 'table.csv')
+    with pytest.raises(KeyboardInterrupt):
+        write_seeds(ofile, ['a'], fail=True)
+
+    assert get_done_seeds(ofile, 'seed', redo=True) == set()
+    write_seeds(ofile, ['b'])
+    assert read_table(ofile)['seed'].tolist() == ['b', 'b']
+
+
+def test_common_done_seeds(tmp_path):
+    tables = [str(tmp_path / ('%s.csv' % x)) for x in ['t2t', 't2in']]
+    with pytest.raises(KeyboardInterrupt):
+        write_seeds(tables[0], ['a', 'b'], fail=True)
+    with pytest.raises(KeyboardInterrupt):
+        write_seeds(tables[1], ['a'], fail=True)
+
+    # Seed b is only done in one of the tables, so it is computed again
+    done = get_common_done_seeds([(x, 'seed', TableWriter) for x in tables])
+    assert done == {'a'}
+    for table in tables:
+        with open('%s.done' % table) as handle:
+            assert handle.read() == 'a\n'
+        assert set(pd.read_csv('%s.part' % table)['seed']) == {'a'}
+
+
+@pytest.mark.parametrize('driver', list(KEYS))
+def test_force_script(phylome, single, tmp_path, driver):
+    # The forced seeds of a finished run are computed again
+    oprefix = str(tmp_path / driver)
+    ofile = run_script(phylome, driver, 'array', oprefix)
+    seeds = [x.split('\t', 1)[0] for x in phylome['lines'][:3]]
+    cmd = get_script_cmd(phylome, driver, 'array', oprefix)
+    cmd.remove('-r')
+    subprocess.run(cmd + ['-f', ','.join(seeds)],
+                   stdout=subprocess.DEVNULL, check=True)
+    assert_same_rows(ofile, single[driver], KEYS[driver])
+    with open('%s.done' % ofile) as handle:
+        assert sorted(handle.read().split()) == \
+            sorted(x.split('\t', 1)[0] for x in phylome['lines'])
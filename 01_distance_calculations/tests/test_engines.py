@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_engines.py -- Tree functions of the ete3 and array engines
+
+tree_stats, count_dupl_specs, get_group_mrca and get_groups_mrca must give
+the same results with both engines on every tree of the simulated phylome,
+rooted by each rooting mode.
+'''
+
+# Import libraries ----
+import pytest
+from rooting import ROOT_MODES, get_rooting
+from treecache import read_rooted
+from treefuns import read_treeline
+import arraytree
+import treefuns
+
+
+# Define functions ----
+def get_trees(phylome, line, rooting):
+    # The tree rooted by a rooting mode with each engine
+    context = phylome['context']
+    root_tree, params = get_rooting(rooting, context['sp2agedic'])
+    return [read_rooted(line, read_treeline, root_tree, rooting, params,
+                        engine=engine, spidx=context['spidx'])
+            for engine in ['ete3', 'array']]
+
+
+def summarise_mrca(mrca):
+    # MRCA dictionary without the node, whose leaves are compared instead
+    summary = {k: v for k, v in mrca.items() if k != 'node'}
+    summary['leaves'] = set(mrca['node'].get_leaf_names())
+    return summary
+
+
+def get_group_mrca(engine, tree, feature):
+    # Summary of the group MRCA of a tree, None if it has none
+    try:
+        return summarise_mrca(engine.get_group_mrca(tree['tree'],
+                                                    tree['seed'], feature,
+                                                    tree['seed']))
+    except IndexError:
+        return None
+
+
+# Define tests ----
+@pytest.mark.parametrize('rooting', ROOT_MODES)
+def test_tree_stats(phylome, rooting):
+    for line in phylome['lines']:
+        ete_tree, array_tree = get_trees(phylome, line, rooting)
+        expected = treefuns.tree_stats(ete_tree['tree'])
+        assert arraytree.tree_stats(array_tree['tree']) == \
+            pytest.approx(expected, rel=1e-9, nan_ok=True)
+
+
+@pytest.mark.parametrize('rooting', ROOT_MODES)
+def test_count_dupl_specs(phylome, rooting):
+    for line in phylome['lines']:
+        ete_tree, array_tree = get_trees(phylome, line, rooting)
+        assert arraytree.count_dupl_specs(array_tree['tree']) == \
+            treefuns.count_dupl_specs(ete_tree['tree'])
+
+
+def test_get_group_mrca(phylome):
+    event_species = phylome['context']['event_species']
+    found = 0
+    for line in phylome['lines']:
+        ete_tree, array_tree = get_trees(phylome, line, 'species_age')
+        for group, species in event_species.items():
+            mrcas = list()
+            for engine, tree in [(treefuns, ete_tree),
+                                 (arraytree, array_tree)]:
+                engine.annotate_tree(tree['tree'], group, species)
+                mrcas.append(get_group_mrca(engine, tree, group))
+            assert mrcas[1] == mrcas[0]
+            found += mrcas[0] is not None
+
+    assert found > 0
+
+
+def test_get_groups_mrca(phylome):
+    context = phylome['context']
+    found = 0
+    for line in phylome['lines']:
+        mrcas = list()
+        for engine, tree in zip([treefuns, arraytree],
+                                get_trees(phylome, line, 'species_age')):
+            groupsmrca = engine.get_groups_mrca(tree['tree'], tree['seed'],
+                                                context['event_species'],
+                                                context['spgroups'],
+                                                tree['seed'],
+                                                context['firstsplit'],
+                                                context['spidx'])
+            mrcas.append({k: summarise_mrca(v)
+                          for k, v in groupsmrca.items()})
+        assert mrcas[1] == mrcas[0]
+        found += len(mrcas[0])
+
+    assert found > 0
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_evol_events.py -- Duplication and speciation labels of each engine
+
+The species overlap labels of ete3 get_descendant_evol_events, of
+treefuns.get_evol_events and of ArrayTree.get_descendant_evol_events must
+be the same on every node of the simulated trees, with each rooting mode.
+'''
+
+# Import libraries ----
+import pytest
+from arraytree import ArrayTree, EVOLTYPES
+from rooting import ROOT_MODES, get_rooting
+from treecache import read_rooted
+from treefuns import read_treeline, get_evol_events
+
+
+# Define functions ----
+def get_labels(tree):
+    # Event of each internal node of a PhyloTree, in preorder
+    return [getattr(x, 'evoltype', None) for x in tree.traverse('preorder')
+            if not x.is_leaf()]
+
+
+# Define tests ----
+@pytest.mark.parametrize('rooting', ROOT_MODES)
+def test_evol_events(phylome, rooting):
+    root_tree, params = get_rooting(rooting, phylome['context']['sp2agedic'])
+    for line in phylome['lines']:
+        rooted = read_rooted(line, read_treeline, root_tree, rooting, params,
+                             engine='array')['tree']
+
+        # Unlabelled copies of the rooted tree for each implementation
+        rooted.evolcode[:] = 0
+        atree = ArrayTree.from_phylotree(rooted.to_phylotree())
+        ete_tree = rooted.to_phylotree()
+        fun_tree = rooted.to_phylotree()
+        assert set(get_labels(ete_tree)) == {None}
+
+        ete_tree.get_descendant_evol_events()
+        get_evol_events(fun_tree)
+        atree.get_descendant_evol_events()
+
+        expected = get_labels(ete_tree)
+        assert set(expected) <= {'D', 'S'}
+        assert get_labels(fun_tree) == expected
+        assert [EVOLTYPES[x] for x in atree.evolcode[~atree.is_leaf]] == \
+            expected
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_filter_t2in.py -- Long format and quantiles of the t2in tables
+
+iter_long must give one row per seed, rooting and node with a distance,
+and get_quantile the quantiles of np.quantile (R type 7) when the values
+do not fit in memory.
+'''
+
+# Import libraries ----
+import numpy as np
+import pandas as pd
+import pytest
+from filter_t2in_dist import iter_long, get_quantile
+
+
+# Define tests ----
+@pytest.mark.parametrize('rooting', [False, True])
+def test_iter_long(tmp_path, rooting):
+    idf = pd.DataFrame({'seed': ['s1', 's2', 's3'],
+                        'tree_leafno': [10, 20, 30],
+                        '4_dist': [1.0, np.nan, 3.0],
+                        '4_ndist': [0.1, np.nan, 0.3],
+                        '26_dist': [4.0, 5.0, np.nan],
+                        '26_ndist': [0.4, 0.5, np.nan]})
+    if rooting:
+        idf.insert(1, 'rooting', ['species_age', 'midpoint', 'midpoint'])
+    ifile = str(tmp_path / 't2in.csv')
+    idf.to_csv(ifile, index=False)
+
+    ldf = pd.concat(iter_long(ifile, chunksize=2), ignore_index=True)
+    idcols = ['seed', 'rooting'] if rooting else ['seed']
+    assert list(ldf.columns) == idcols + ['node', 'dist', 'ndist']
+
+    ldf = ldf.sort_values(['seed', 'node']).reset_index(drop=True)
+    assert ldf['seed'].tolist() == ['s1', 's1', 's2', 's3']
+    assert ldf['node'].tolist() == ['26', '4', '26', '4']
+    assert ldf['dist'].tolist() == [4.0, 1.0, 5.0, 3.0]
+    assert ldf['ndist'].tolist() == [0.4, 0.1, 0.5, 0.3]
+    if rooting:
+        assert ldf['rooting'].tolist() == ['species_age', 'species_age',
+                                           'midpoint', 'midpoint']
+
+
+@pytest.mark.parametrize('prob', [0, 0.001, 0.05, 0.5, 0.95, 0.999, 1])
+def test_get_quantile(prob):
+    # Values with ties, read in chunks, and more of them than kept in memory
+    rng = np.random.default_rng(3)
+    values = np.round(rng.lognormal(size=200000), 3)
+    chunks = np.array_split(values, 17)
+
+    quantile = get_quantile(lambda: iter(chunks), prob, bins=64,
+                            maxvalues=1000)
+    assert quantile == pytest.approx(np.quantile(values, prob), rel=1e-12)
+
+
+def test_get_quantile_empty():
+    assert np.isnan(get_quantile(lambda: iter([np.array([])]), 0.5))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_moments.py -- Segment moments of tree_stats
+
+get_segment_moments must give the numpy and scipy.stats statistics of
+each segment, with nan skewness and kurtosis for the segments which are
+constant up to rounding.
+'''
+
+# Import libraries ----
+import numpy as np
+import pytest
+from scipy import stats
+from treefuns import get_segment_moments
+
+
+# Define tests ----
+def test_segment_moments():
+    rng = np.random.default_rng(1)
+    groups = [rng.lognormal(size=x) for x in [1, 2, 7, 50]]
+    values = np.concatenate(groups)
+    seg = np.repeat(np.arange(len(groups)), [len(x) for x in groups])
+    moments = get_segment_moments(values, seg, len(groups) + 1)
+
+    for i, group in enumerate(groups):
+        assert moments['median'][i] == pytest.approx(np.median(group))
+        assert moments['mean'][i] == pytest.approx(np.mean(group))
+        assert moments['var'][i] == pytest.approx(np.var(group))
+        assert moments['sum'][i] == pytest.approx(np.sum(group))
+        assert moments['max'][i] == np.max(group)
+        if len(group) > 1:
+            assert moments['skew'][i] == pytest.approx(stats.skew(group))
+            assert moments['kurt'][i] == \
+                pytest.approx(stats.kurtosis(group))
+
+    # The single value and the empty segments have no moments
+    assert np.isnan(moments['skew'][0])
+    for stat in ['median', 'mean', 'var', 'kurt', 'skew']:
+        assert np.isnan(moments[stat][-1])
+
+
+def test_constant_segments():
+    # Branch lengths equal up to a few units in the last place
+    values = np.array([0.1, 0.3, 0.3, 0.1, 0.2])
+    values = np.concatenate([values, 0.1 + np.arange(-4, 5) * 1.4e-17])
+    seg = np.repeat([0, 1], [5, 9])
+    moments = get_segment_moments(values, seg, 2)
+
+    assert np.isfinite(moments['skew'][0])
+    assert moments['var'][1] > 0
+    assert np.isnan(moments['skew'][1])
+    assert np.isnan(moments['kurt'][1])
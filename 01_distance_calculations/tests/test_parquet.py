@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_parquet.py -- Parquet output of the distance tables
+
+The rows written by ParquetWriter are read back with their types, and the
+tables whose first batches, or all of them, have no rows keep the types of
+their columns, so they can be resumed and merged with the others.
+'''
+
+# Import libraries ----
+import pandas as pd
+import pytest
+from shards import merge_tables
+from writers import ParquetWriter, get_done_seeds
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+COLUMNS = ['tree', 'from', 'from_seq', 'sp_count', 'dist']
+
+TYPES = {'from': 'string', 'sp_count': 'int64'}
+
+
+# Define functions ----
+def get_rows(seed):
+    return [{'tree': seed, 'from': '%s_%s' % (seed, i), 'from_seq': 'HUMAN',
+             'sp_count': i, 'dist': i / 2} for i in range(3)]
+
+
+def write_table(ofile, seeds, resume=False, fail=False):
+    # Writing each seed in its own row group, the seeds ending with _empty
+    # have no rows
+    with ParquetWriter(ofile, COLUMNS, resume=resume, seedsize=1,
+                       dictionary=['tree', 'from_seq'],
+                       floattype='float32', types=TYPES) as writer:
+        for seed in seeds:
+            writer.write(None if seed.endswith('_empty') else get_rows(seed),
+                         seed)
+        if fail:
+            raise KeyboardInterrupt
+
+
+def get_expected(seeds):
+    return pd.DataFrame([row for seed in seeds if not seed.endswith('_empty')
+                         for row in get_rows(seed)], columns=COLUMNS)
+
+
+def read_table(ofile):
+    odf = pd.read_parquet(ofile)
+    for col in ['tree', 'from_seq']:
+        odf[col] = odf[col].astype(str)
+
+    return odf
+
+
+# Define tests ----
+def test_round_trip(tmp_path):
+    ofile = str(tmp_path / 'table.parquet')
+    write_table(ofile, ['a', 'b'])
+
+    schema = pq.ParquetFile(ofile).schema_arrow
+    assert pa.types.is_dictionary(schema.field('tree').type)
+    assert schema.field('from').type == pa.string()
+    assert schema.field('sp_count').type == pa.int64()
+    assert schema.field('dist').type == pa.float32()
+    pd.testing.assert_frame_equal(read_table(ofile),
+                                  get_expected(['a', 'b']),
+                                  check_dtype=False)
+
+
+def test_empty_first_batch(tmp_path):
+    ofile = str(tmp_path / 'table.parquet')
+    write_table(ofile, ['a_empty', 'b'])
+    pd.testing.assert_frame_equal(read_table(ofile), get_expected(['b']),
+                                  check_dtype=False)
+
+
+def test_resume(tmp_path):
+    ofile = str(tmp_path / 'table.parquet')
+    with pytest.raises(KeyboardInterrupt):
+        write_table(ofile, ['a_empty'], fail=True)
+
+    done = get_done_seeds(ofile, 'tree', writer=ParquetWriter)
+    assert done == {'a_empty'}
+    write_table(ofile, ['b'], resume=True)
+    pd.testing.assert_frame_equal(read_table(ofile), get_expected(['b']),
+                                  check_dtype=False)
+
+
+def test_merge_empty_table(tmp_path):
+    tfiles = [str(tmp_path / ('%s.parquet' % x)) for x in ['s1', 's2']]
+    write_table(tfiles[0], ['a_empty'])
+    write_table(tfiles[1], ['b', 'c'])
+
+    schemas = [pq.ParquetFile(x).schema_arrow for x in tfiles]
+    assert schemas[0].equals(schemas[1])
+
+    ofile = str(tmp_path / 'merged.parquet')
+    merge_tables(ofile, tfiles)
+    pd.testing.assert_frame_equal(read_table(ofile),
+                                  get_expected(['b', 'c']),
+                                  check_dtype=False)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_root_modes.py -- Tip-to-internode distances of several rooting modes
+
+A t2in run with several rooting modes must give one row per seed and mode,
+with a rooting column, whose species age rows are the rows of a run without
+rooting modes, and filter_t2in_dist must keep that column in the long table.
+'''
+
+# Import libraries ----
+import pandas as pd
+import pytest
+from conftest import KEYS, run_script, run_tool, assert_same_rows
+from rooting import ROOT_MODES, parse_root_modes
+
+
+# Define fixtures ----
+@pytest.fixture(scope='module')
+def modes(phylome, tmp_path_factory):
+    odir = tmp_path_factory.mktemp('modes')
+    return run_script(phylome, 't2in', 'array', str(odir / 't2in'),
+                      ['-R', ','.join(ROOT_MODES)])
+
+
+# Define tests ----
+def test_parse_root_modes():
+    assert parse_root_modes('midpoint, species_age,midpoint') == \
+        ['midpoint', 'species_age']
+    with pytest.raises(ValueError):
+        parse_root_modes('species_age,outgroup')
+
+
+def test_rooting_column(phylome, single, modes, tmp_path):
+    odf = pd.read_csv(modes)
+    # One row per seed and rooting mode
+    assert len(odf) == len(ROOT_MODES) * odf['seed'].nunique()
+    assert (odf.groupby('seed')['rooting'].apply(set) ==
+            set(ROOT_MODES)).all()
+
+    # The species age rows are the rows of a run without rooting modes
+    spfile = str(tmp_path / 'species_age.csv')
+    odf[odf['rooting'] == 'species_age'].drop(columns='rooting').to_csv(
+        spfile, index=False)
+    assert_same_rows(spfile, single['t2in'], KEYS['t2in'])
+
+
+def test_midpoint_engines(phylome, modes, tmp_path):
+    # The midpoint rows of both engines are the same
+    ofile = run_script(phylome, 't2in', 'ete3', str(tmp_path / 't2in'),
+                       ['-R', 'midpoint'])
+    odf = pd.read_csv(modes)
+    mpfile = str(tmp_path / 'midpoint.csv')
+    odf[odf['rooting'] == 'midpoint'].to_csv(mpfile, index=False)
+    assert_same_rows(ofile, mpfile, KEYS['t2in'])
+
+
+def test_filter_long(modes, tmp_path):
+    oprefix = str(tmp_path / 'long')
+    run_tool('filter_t2in_dist.py', ['-i', modes, '-q', '1', '-p', oprefix])
+    ldf = pd.read_csv('%s.csv' % oprefix)
+    assert list(ldf.columns) == ['seed', 'rooting', 'node', 'dist', 'ndist']
+
+    # Every row of the long table comes from a seed and mode of the table
+    odf = pd.read_csv(modes)
+    pairs = set(zip(odf['seed'], odf['rooting']))
+    assert len(ldf) > 0
+    assert set(zip(ldf['seed'], ldf['rooting'])) <= pairs
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_screen.py -- Tree size screen on the raw newick strings
+
+The leaves read from the raw newick string must be the ones of the parsed
+tree, so screen_treeline keeps the trees that check_tree_size keeps on
+their parsed sizes.
+'''
+
+# Import libraries ----
+import pytest
+from treefuns import (read_treeline, get_newick_leaves, screen_treeline,
+                      check_tree_size)
+
+
+# Define tests ----
+@pytest.mark.parametrize('newick, leaves', [
+    ('A_HUMAN;', ['A_HUMAN']),
+    ('(A_HUMAN:0.1,B_MOUSE:0.2);', ['A_HUMAN', 'B_MOUSE']),
+    ('((A_HUMAN,B_MOUSE)0.95:0.1, C_RAT:1e-3)root;',
+     ['A_HUMAN', 'B_MOUSE', 'C_RAT']),
+    ('((A_HUMAN:1,B_MOUSE:1)N1:0.5[&&NHX:D=Y],(C_RAT:1)N2:1);',
+     ['A_HUMAN', 'B_MOUSE', 'C_RAT']),
+])
+def test_get_newick_leaves(newick, leaves):
+    assert get_newick_leaves(newick) == leaves
+
+
+def test_phylome_leaves(phylome):
+    for line in phylome['lines']:
+        tree = read_treeline(line)['tree']
+        assert get_newick_leaves(line.split('\t')[3]) == \
+            tree.get_leaf_names()
+
+
+@pytest.mark.parametrize('filters', [
+    {'min_species': 8},
+    {'max_leaves': 30},
+    {'max_copies': 2.5},
+    {'min_species': 6, 'max_leaves': 40, 'max_copies': 3},
+])
+def test_screen_treeline(phylome, filters):
+    kept = 0
+    for line in phylome['lines']:
+        tree = read_treeline(line)['tree']
+        leafno = len(tree.get_leaves())
+        spno = len(set(x.species for x in tree.get_leaves()))
+        expected = check_tree_size(leafno, spno, **filters)
+        assert screen_treeline(line, **filters) == expected
+        kept += expected
+
+    # The filters keep some trees and skip others
+    assert 0 < kept < len(phylome['lines'])
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_scripts.py -- Tables of the distance scripts
+
+get_t2t_dist.py and get_t2in_dist.py are run on the simulated phylome with
+the ete3 engine, and they must give the rows of the array engine.
+'''
+
+# Import libraries ----
+import pytest
+from conftest import KEYS, run_script, assert_same_rows
+
+
+# Define tests ----
+@pytest.mark.parametrize('driver', list(KEYS))
+def test_engines(phylome, single, tmp_path, driver):
+    ofile = run_script(phylome, driver, 'ete3', str(tmp_path / driver))
+    assert_same_rows(ofile, single[driver], KEYS[driver])
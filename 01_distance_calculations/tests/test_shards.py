@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_shards.py -- Static sharding of the trees across jobs
+
+Every tree must be in exactly one shard, and the merged tables of a
+sharded run must have the rows of a single run.
+'''
+
+# Import libraries ----
+import pytest
+from conftest import KEYS, run_tool, run_script, assert_same_rows
+from shards import get_shard_rows, parse_shard
+
+
+# Define tests ----
+@pytest.mark.parametrize('shard', ['0/2', '3/2', '1-2', 'a/2'])
+def test_parse_shard(shard):
+    with pytest.raises(ValueError):
+        parse_shard(shard)
+
+
+@pytest.mark.parametrize('nshards', [1, 3, 20])
+def test_shard_rows(phylome, nshards):
+    rows = list()
+    for i in range(1, nshards + 1):
+        rows += get_shard_rows(phylome['trees'], '%s/%s' % (i, nshards))
+    assert sorted(x.rstrip('\n') for x in rows) == sorted(phylome['lines'])
+
+
+@pytest.mark.parametrize('driver', list(KEYS))
+def test_shards(phylome, single, tmp_path, driver):
+    oprefix = str(tmp_path / driver)
+    for i in [1, 2]:
+        run_script(phylome, driver, 'array', oprefix, ['-j', '%s/2' % i])
+    run_tool('shards.py', ['-p', oprefix, '-n', '2'])
+    assert_same_rows('%s.csv' % oprefix, single[driver], KEYS[driver])
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_stats_index.py -- tree_stats of every subtree from StatsIndex
+
+StatsIndex must give the treefuns.tree_stats of the subtree below each
+internal node, also when the subtrees are processed in several batches.
+'''
+
+# Import libraries ----
+import pytest
+from arraytree import StatsIndex
+from rooting import get_rooting
+from treecache import read_rooted
+from treefuns import read_treeline, tree_stats
+
+
+# Define tests ----
+@pytest.mark.parametrize('maxvalues', [1000000, 50])
+def test_stats_index(phylome, maxvalues):
+    root_tree, params = get_rooting('species_age',
+                                    phylome['context']['sp2agedic'])
+    for line in phylome['lines']:
+        tree = read_rooted(line, read_treeline, root_tree, 'species_age',
+                           params, engine='array')['tree']
+        index = StatsIndex(tree, maxvalues)
+        nodes = list(tree.to_phylotree().traverse('preorder'))
+        for i, node in enumerate(nodes):
+            if node.is_leaf():
+                continue
+            assert index.get_stats(i) == \
+                pytest.approx(tree_stats(node), rel=1e-9, nan_ok=True)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_treecache.py -- Disk cache of the rooted trees
+
+A tree read through the cache, when it is missing and computed or when it
+is loaded, must be the tree read without the cache, and the distance
+scripts sharing a cache must give the rows of a run without it.
+'''
+
+# Import libraries ----
+import os
+import numpy as np
+import pytest
+from arraytree import ArrayTree
+from conftest import KEYS, run_script, assert_same_rows
+from rooting import ROOT_MODES, get_rooting
+from treecache import TreeCache, read_rooted
+from treefuns import read_treeline
+
+
+# Define functions ----
+def not_read(tree_row):
+    raise AssertionError('The tree is parsed instead of loaded.')
+
+
+def assert_same_tree(tree, expected):
+    # Same rooted topology, branch lengths, names, species and events
+    trees = [x['tree'] for x in [tree, expected]]
+    trees = [x if isinstance(x, ArrayTree) else ArrayTree.from_phylotree(x)
+             for x in trees]
+    assert [tree[x] for x in ['seed', 'model', 'likelihood']] == \
+        [str(expected[x]) for x in ['seed', 'model', 'likelihood']]
+    assert np.array_equal(trees[0].parent, trees[1].parent)
+    assert np.array_equal(trees[0].brlen, trees[1].brlen)
+    assert np.array_equal(trees[0].evolcode, trees[1].evolcode)
+    assert list(trees[0].names) == list(trees[1].names)
+    assert [trees[0].species[x] for x in trees[0].leaf_sp[trees[0].is_leaf]] \
+        == [trees[1].species[x] for x in trees[1].leaf_sp[trees[1].is_leaf]]
+
+
+def count_files(cachedir):
+    return sum(len(files) for _, _, files in os.walk(cachedir))
+
+
+# Define tests ----
+@pytest.mark.parametrize('engine', ['ete3', 'array'])
+def test_read_rooted(phylome, tmp_path, engine):
+    cache = TreeCache(str(tmp_path / 'cache'))
+    spidx = phylome['context']['spidx']
+    nfiles = 0
+    for rooting in ROOT_MODES:
+        root_tree, params = get_rooting(rooting,
+                                        phylome['context']['sp2agedic'])
+        for line in phylome['lines']:
+            expected = read_rooted(line, read_treeline, root_tree, rooting,
+                                   params, engine=engine, spidx=spidx)
+
+            # The missing tree is computed and saved, then it is loaded
+            missed = read_rooted(line, read_treeline, root_tree, rooting,
+                                 params, cache, engine, spidx)
+            nfiles += 1
+            assert count_files(cache.cachedir) == nfiles
+            hit = read_rooted(line, not_read, root_tree, rooting, params,
+                              cache, engine, spidx)
+            assert count_files(cache.cachedir) == nfiles
+
+            assert_same_tree(missed, expected)
+            assert_same_tree(hit, expected)
+
+
+def test_scripts_cache(phylome, single, tmp_path):
+    # A second run of each script loads the trees cached by the first, t2t
+    # rooting by midpoint and t2in by species age
+    cachedir = str(tmp_path / 'cache')
+    nfiles = 0
+    for driver in ['t2t', 't2in']:
+        for run in ['miss', 'hit']:
+            oprefix = str(tmp_path / ('%s_%s' % (driver, run)))
+            ofile = run_script(phylome, driver, 'array', oprefix,
+                               ['-a', cachedir])
+            assert_same_rows(ofile, single[driver], KEYS[driver])
+            if run == 'miss':
+                nfiles += len(phylome['lines'])
+            assert count_files(cachedir) == nfiles
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_treestore.py -- Round trip of the trees through a tree store
+
+The trees loaded from a store must be the ArrayTree conversion of the
+parsed tree lines, and the distance scripts must give the same rows with
+the store as input.
+'''
+
+# Import libraries ----
+import numpy as np
+import pytest
+from arraytree import ArrayTree
+from conftest import KEYS, run_script, assert_same_rows
+from treefuns import read_treeline, screen_treeline
+from treestore import TreeStore, write_store
+
+
+# Define functions ----
+def get_leaf_species(tree):
+    return [tree.species[x] for x in tree.leaf_sp[tree.is_leaf]]
+
+
+# Define fixtures ----
+@pytest.fixture(scope='module')
+def store(phylome, tmp_path_factory):
+    odir = str(tmp_path_factory.mktemp('store') / 'trees.store')
+    write_store(phylome['trees'], odir, threads=2, chunksize=3)
+    return odir
+
+
+# Define tests ----
+def test_round_trip(phylome, store):
+    # The trees are stored in the order their conversion finishes
+    tstore = TreeStore(store)
+    assert sorted(tstore.seeds) == \
+        sorted(x.split('\t', 1)[0] for x in phylome['lines'])
+
+    for line in phylome['lines']:
+        tree_dict = read_treeline(line)
+        expected = ArrayTree.from_phylotree(tree_dict['tree'])
+        stored = tstore.read_arraytree(tree_dict['seed'])
+        tree = stored['tree']
+
+        assert stored['model'] == tree_dict['model']
+        assert float(stored['likelihood']) == float(tree_dict['likelihood'])
+        assert np.array_equal(tree.parent, expected.parent)
+        assert np.array_equal(tree.brlen, expected.brlen)
+        assert np.array_equal(tree.supports, expected.supports)
+        assert list(tree.names) == list(expected.names)
+        assert get_leaf_species(tree) == get_leaf_species(expected)
+        assert tstore.screen_treeline(tree_dict['seed'], max_copies=2) == \
+            screen_treeline(line, max_copies=2)
+
+
+@pytest.mark.parametrize('driver', list(KEYS))
+def test_store_input(phylome, single, store, tmp_path, driver):
+    ofile = run_script(dict(phylome, trees=store), driver, 'array',
+                       str(tmp_path / driver))
+    assert_same_rows(ofile, single[driver], KEYS[driver])
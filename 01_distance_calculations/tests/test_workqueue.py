@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_workqueue.py -- Work queue of tree batches
+
+Every tree of the queue must be leased in one batch, the expired and
+failed leases go back to the queue until they run out of attempts, and
+the merged tables of the workers of a queue run must have the rows of a
+single run.
+'''
+
+# Import libraries ----
+import subprocess
+import pytest
+from conftest import KEYS, get_script_cmd, run_tool, assert_same_rows
+from shards import index_trees
+from workqueue import WorkQueue
+
+
+# Define tests ----
+def test_lease(phylome, tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.db'))
+    assert queue.fill(index_trees(phylome['trees']), batchsize=5)
+    assert not queue.fill(index_trees(phylome['trees']), batchsize=5)
+
+    seeds = list()
+    while True:
+        leased = queue.lease()
+        if leased is None:
+            break
+        batch, trees = leased
+        seeds += [x[0] for x in trees]
+        assert queue.complete(batch, 'part%s.csv' % batch)
+        assert not queue.complete(batch, 'part%s.csv' % batch)
+
+    assert sorted(seeds) == sorted(x.split('\t', 1)[0]
+                                   for x in phylome['lines'])
+    assert queue.get_status()['done'] == 3
+    assert queue.get_parts() == ['part0.csv', 'part1.csv', 'part2.csv']
+    queue.close()
+
+
+def test_attempts(phylome, tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.db'))
+    queue.fill(index_trees(phylome['trees']), batchsize=20, timeout=0,
+               attempts=2)
+
+    # An expired lease is leased again, then it runs out of attempts
+    batch, trees = queue.lease()
+    assert queue.lease()[0] == batch
+    assert queue.lease() is None
+    assert queue.get_status()['failed'] == 1
+    assert queue.get_failed_seeds() == [x[0] for x in trees]
+    queue.close()
+
+    queue = WorkQueue(str(tmp_path / 'queue2.db'))
+    queue.fill(index_trees(phylome['trees']), batchsize=20, attempts=2)
+
+    # A failed batch is given back until it runs out of attempts
+    batch, trees = queue.lease()
+    queue.fail(batch)
+    assert queue.get_status()['todo'] == 1
+    assert queue.lease()[0] == batch
+    queue.fail(batch)
+    assert queue.get_status()['failed'] == 1
+    assert queue.lease() is None
+    queue.close()
+
+
+@pytest.mark.parametrize('driver', list(KEYS))
+def test_queue(phylome, single, tmp_path, driver):
+    # Two workers computing the batches of the queue at the same time
+    oprefix = str(tmp_path / driver)
+    queue = str(tmp_path / 'queue.db')
+    run_tool('workqueue.py', ['-q', queue, '-i', phylome['trees'],
+                              '-b', '2'])
+    cmd = get_script_cmd(phylome, driver, 'array', oprefix, 1)
+    workers = [subprocess.Popen(cmd + ['-u', queue],
+                                stdout=subprocess.DEVNULL)
+               for _ in range(2)]
+    assert [x.wait() for x in workers] == [0, 0]
+
+    run_tool('workqueue.py', ['-q', queue, '-p', oprefix])
+    assert_same_rows('%s.csv' % oprefix, single[driver], KEYS[driver])
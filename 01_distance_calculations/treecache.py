@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+treecache.py -- Disk cache of rooted and reconciled trees
+
+Rooting a tree and inferring its duplication and speciation nodes with
+species overlap is, after parsing, the most expensive step of the
+distance scripts. The cache keeps the rooted topology and the evoltype of
+each node as ArrayTree arrays in one .npz file per tree, named by a hash of
+the tree line and of the rooting method and parameters. Any later run with
+the same tree and rooting, from either script, loads it without parsing,
+rooting or reconciling the tree.
+
+Requirements:
+ - copy
+ - hashlib
+ - json
+ - os
+ - numpy
+ - ete3
+'''
+
+# Import libraries ----
+import copy
+import hashlib
+import json
+import os
+import numpy as np
+from arraytree import ArrayTree
+from profiling import stage, set_leafno
+
+
+# Define classes ----
+class TreeCache:
+    '''
+    Content-addressed cache of rooted trees with their evolutionary events
+
+    Args:
+        cachedir (str): cache directory, shared by any number of runs
+
+        store (TreeStore): tree store the tree rows refer to, None if the
+        rows are tree lines
+    '''
+
+    def __init__(self, cachedir, store=None):
+        self.cachedir = cachedir
+        self.store = store
+
+    def get_key(self, tree_row, rooting, params=None):
+        '''
+        Get the cache key of a tree rooted with a method
+
+        Args:
+            tree_row (str): tree line, or tree seed in the store
+
+            rooting (str): rooting method name
+
+            params (dict): rooting parameters, they have to be JSON
+            serialisable
+
+        Returns:
+            str: hexadecimal SHA-1 digest
+        '''
+
+        digest = hashlib.sha1()
+        digest.update(rooting.encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        if self.store is not None:
+            digest.update(self.store.get_bytes(tree_row))
+        else:
+            digest.update(tree_row.rstrip('\n').encode())
+
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cachedir, key[:2], '%s.npz' % key)
+
+    def load(self, key, spidx=None):
+        '''
+        Load a cached tree
+
+        Args:
+            key (str): cache key
+
+            spidx (dict): species code to integer id dictionary for the
+            ArrayTree, as in ArrayTree.from_phylotree
+
+        Returns:
+            dict: seed, model, likelihood and the rooted ArrayTree with its
+            evolcode, None if the tree is not cached
+        '''
+
+        path = self.get_path(key)
+        if not os.path.isfile(path):
+            return None
+
+        with np.load(path) as data:
+            seed, model, likelihood = data['meta'].tolist()
+            atree = ArrayTree(data['parent'], data['brlen'],
+                              data['supports'], data['names'].tolist(),
+                              data['species'].tolist(), data['leaf_sp'],
+                              data['evolcode'])
+
+        # Translating the cached species ids to the run ones
+        if spidx is not None:
+            atree.set_species_index(spidx)
+
+        return {'seed': seed, 'model': model, 'likelihood': likelihood,
+                'tree': atree}
+
+    def save(self, key, tree):
+        '''
+        Save a rooted tree with its evolutionary events
+
+        The file is written to a temporary name and renamed, so concurrent
+        runs never read a partial file.
+
+        Args:
+            key (str): cache key
+
+            tree (dict): seed, model, likelihood and the tree, as an
+            ArrayTree or a PhyloTree whose evol events are computed
+        '''
+
+        atree = tree['tree']
+        if not isinstance(atree, ArrayTree):
+            atree = ArrayTree.from_phylotree(atree)
+
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpfile = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmpfile, 'wb') as handle:
+            np.savez(handle, parent=atree.parent, brlen=atree.brlen,
+                     supports=atree.supports,
+                     names=np.array(atree.names.tolist(), dtype=str),
+                     species=np.array(atree.species, dtype=str),
+                     leaf_sp=atree.leaf_sp, evolcode=atree.evolcode,
+                     meta=np.array([tree['seed'], tree['model'],
+                                    tree['likelihood']], dtype=str))
+        os.replace(tmpfile, path)
+
+
+# Define functions ----
+def read_rooted(tree_row, read, root_tree, rooting, params=None, cache=None,
+                engine='ete3', spidx=None):
+    '''
+    Read a tree rooted and with its evolutionary events computed
+
+    A cached tree is loaded instead of being parsed, rooted and reconciled
+    again. Trees missing in the cache are computed and saved to it.
+
+    Args:
+        tree_row (str): tree line, or tree seed in the store
+
+        read (function): tree reading function, returning the tree dict
+        with the tree as a PhyloTree or an ArrayTree
+
+        root_tree (function): function rooting an ArrayTree in place, such
+        as the ones of rooting.py
+
+        rooting (str): rooting method name, part of the cache key
+
+        params (dict): rooting parameters, part of the cache key
+
+        cache (TreeCache): tree cache, None to compute every tree
+
+        engine (str): tree engine of the returned tree (ete3 or array)
+
+        spidx (dict): species code to integer id dictionary of the array
+        engine
+
+    Returns:
+        dict: seed, model, likelihood and the tree as a PhyloTree or an
+        ArrayTree depending on the engine
+    '''
+
+    tree = None
+    if cache is not None:
+        with stage('cache'):
+            key = cache.get_key(tree_row, rooting, params)
+            tree = cache.load(key, spidx)
+
+    if tree is None:
+        # Rooting and labelling the evolutionary events on the arrays, the
+        # PhyloTree of the ete3 engine is built from the rooted tree
+        with stage('parse'):
+            tree = read(tree_row)
+        with stage('convert'):
+            if not isinstance(tree['tree'], ArrayTree):
+                tree['tree'] = ArrayTree.from_phylotree(tree['tree'], spidx)
+            elif spidx is not None:
+                tree['tree'].set_species_index(spidx)
+        with stage('rooting'):
+            root_tree(tree['tree'])
+        with stage('evol_events'):
+            tree['tree'].get_descendant_evol_events()
+
+        if cache is not None:
+            with stage('cache'):
+                cache.save(key, tree)
+
+    set_leafno(len(tree['tree'].leafidx))
+    if engine == 'ete3':
+        with stage('convert'):
+            tree['tree'] = tree['tree'].to_phylotree()
+
+    return tree
+
+
+def get_shared_reader(read):
+    '''
+    Get a reading function parsing a tree once for several rootings
+
+    The first call reads the tree, converted to an ArrayTree, and every call
+    returns a new handle to its unrooted arrays. Rooting a handle replaces
+    its arrays without modifying the shared ones, so each rooting of the
+    tree starts from the tree as it was read.
+
+    Args:
+        read (function): tree reading function, as in read_rooted
+
+    Returns:
+        function: reading function of a single tree, to use in read_rooted
+    '''
+
+    parsed = dict()
+
+    def read_shared(tree_row):
+        if not parsed:
+            parsed.update(read(tree_row))
+            if not isinstance(parsed['tree'], ArrayTree):
+                parsed['tree'] = ArrayTree.from_phylotree(parsed['tree'])
+
+        return dict(parsed, tree=copy.copy(parsed['tree']))
+
+    return read_shared
@@ -6,7 +6,7 @@ treefuns.py -- Functions useful to manipulate phylome trees
 
 Requirements:
  - operator
- - scipy
+ - re
  - numpy
  - ete3
 
@@ -16,7 +16,7 @@ August 2022
 
 # Import libraries ----
 from operator import itemgetter
-from scipy import stats
+import re
 import numpy as np
 import ete3
 import pandas as pd
@@ -88,6 +88,89 @@ def read_treeline(line):
     return tree_dict
 
 
+# Leaf names follow an opening parenthesis or a comma in newick, internal
+# node names follow a closing parenthesis
+NEWICK_LEAF = re.compile(r'[(,]\s*([^(),:;\[\]\s]+)')
+
+
+def get_newick_leaves(newick):
+    '''
+    Get the leaf names of a newick string without building the tree
+
+    Args:
+        newick (str): tree in newick format
+
+    Returns:
+        list: leaf names in the newick order
+    '''
+
+    if '(' not in newick:
+        name = re.split('[:;]', newick.strip())[0]
+        return [name] if name != '' else []
+
+    return NEWICK_LEAF.findall(newick)
+
+
+def screen_treeline(line, min_species=None, max_leaves=None,
+                    max_copies=None):
+    '''
+    Check the size of a phylome tree line before parsing it
+
+    The leaves and species are read from the raw newick string, so the
+    trees out of the limits are skipped without paying their parsing.
+
+    Args:
+        line (str): tree line
+
+        min_species (int): minimum number of species
+
+        max_leaves (int): maximum number of leaves
+
+        max_copies (float): trees with at least this mean number of leaves
+        per species are skipped
+
+    Returns:
+        boolean: whether the tree passes the filters
+    '''
+
+    leaves = get_newick_leaves(line.split('\t')[3])
+    spno = len(set(get_species(x) for x in leaves))
+
+    return check_tree_size(len(leaves), spno, min_species, max_leaves,
+                           max_copies)
+
+
+def check_tree_size(leafno, spno, min_species=None, max_leaves=None,
+                    max_copies=None):
+    '''
+    Check the number of leaves and species of a tree against size limits
+
+    Args:
+        leafno (int): number of leaves
+
+        spno (int): number of species
+
+        min_species (int): minimum number of species
+
+        max_leaves (int): maximum number of leaves
+
+        max_copies (float): trees with at least this mean number of leaves
+        per species are skipped
+
+    Returns:
+        boolean: whether the tree passes the filters
+    '''
+
+    if min_species is not None and spno < min_species:
+        return False
+    elif max_leaves is not None and leafno > max_leaves:
+        return False
+    elif max_copies is not None and leafno >= max_copies * spno:
+        return False
+    else:
+        return True
+
+
 def get_sp2age(tree, seed):
     '''
     A short description.
@@ -156,6 +239,111 @@ def get_group_species(tab_file):
     return group_species
 
 
+def get_group_bitmasks(event_species):
+    '''
+    Converts the group species dictionary to species membership bitmasks
+
+    Each species gets an integer where the bit i is set when the species
+    belongs to the i-th group of the event_species dictionary.
+
+    Args:
+        event_species (dict): dictionary with the group as key and the
+        species list as value
+
+    Returns:
+        dict: dictionary with the species as key and the bitmask as value
+    '''
+
+    spgroups = dict()
+    for i, group in enumerate(event_species):
+        for sp in event_species[group]:
+            spgroups[sp] = spgroups.get(sp, 0) | (1 << i)
+
+    return spgroups
+
+
+def get_species_index(sptree, event_species=None):
+    '''
+    Assigns an integer id to each species code
+
+    The species are numbered following the species tree leaves and then the
+    species of the clades table which are not in the species tree.
+
+    Args:
+        sptree (PhyloTree): species tree
+
+        event_species (dict): dictionary with the group as key and the
+        species list as value
+
+    Returns:
+        dict: dictionary with the species code as key and the id as value
+    '''
+
+    spidx = dict()
+    for sp in sptree.get_leaf_names():
+        spidx.setdefault(sp, len(spidx))
+
+    if event_species is not None:
+        for group in event_species:
+            for sp in event_species[group]:
+                spidx.setdefault(sp, len(spidx))
+
+    return spidx
+
+
+def get_species_mask(species, spidx):
+    '''
+    Converts a species collection to a bitmask
+
+    The bit of each species is its id in the species index. Species missing
+    in the index are added to it with a new id.
+
+    Args:
+        species (iterable): species codes
+
+        spidx (dict): species index from get_species_index
+
+    Returns:
+        int: species bitmask
+    '''
+
+    mask = 0
+    for sp in species:
+        mask |= 1 << spidx.setdefault(sp, len(spidx))
+
+    return mask
+
+
+def agrees_first_split(stspl, sptspl):
+    '''
+    Checks a subtree first partition against the species tree one
+
+    Exactly one of the two subtree species bitmasks has to be included in
+    each side of the species tree partition and not in the other side.
+
+    Args:
+        stspl (tuple): species bitmasks of the first two subtree descendants
+
+        sptspl (tuple): species bitmasks of the species tree partition
+
+    Returns:
+        boolean: whether the partitions agree
+    '''
+
+    in_first = [not x & ~sptspl[0] and bool(x & ~sptspl[1]) for x in stspl]
+    in_second = [not x & ~sptspl[1] and bool(x & ~sptspl[0]) for x in stspl]
+
+    return in_first.count(True) == 1 and in_second.count(True) == 1
+
+
+def get_split_masks(firstsplit, spidx):
+    # Converting species sets partitions to bitmasks, bitmasks are kept
+    if isinstance(firstsplit[0], int):
+        return firstsplit
+    else:
+        return tuple(get_species_mask(x, spidx) for x in firstsplit)
+
+
 def root(tree, root_dict):
     '''
     Root the tree according to a rooting dictionary
@@ -180,11 +368,13 @@ def root(tree, root_dict):
         Exception: description
     '''
 
-    if any(sp in root_dict for sp in tree.get_species()):
-        ogdval = max([root_dict.get(sp, 0) for sp in tree.get_species()])
+    tree_sp = tree.get_species()
+    if any(sp in root_dict for sp in tree_sp):
+        ogdval = max([root_dict.get(sp, 0) for sp in tree_sp])
         ogsps = [k for k, val in root_dict.items()
-                 if val == ogdval and k in tree.get_species()][0]
-        ogseq = [seq for seq in tree.get_leaf_names() if ogsps in seq][0]
+                 if val == ogdval and k in tree_sp][0]
+        ogseq = next(leaf.name for leaf in tree.iter_leaves()
+                     if ogsps in leaf.name)
     else:
         ogseq = tree.get_farthest_leaf()[0].get_leaf_names()[0]
 
@@ -217,11 +407,13 @@ def annotate_tree(tree, key, splist):
         Exception: description
     '''
 
+    # Set for constant time membership checks
+    spset = set(splist)
+
     # Iterate the leaves
-    for leaf in tree.get_leaves():
+    for leaf in tree.iter_leaves():
         # Iterate the dataframe columns
-        sp = list(leaf.get_species())[0]
-        if sp in splist:
+        if leaf.species in spset:
             leaf.add_feature(key, key)
         else:
             leaf.add_feature(key, 'nan')
@@ -269,6 +461,43 @@ def annotate_tree(tree, key, splist):
 #     return nodedict
 
 
+def get_evol_events(tree):
+    '''
+    Label the duplication and speciation nodes by species overlap
+
+    It labels the same evoltype features as ete3 get_descendant_evol_events
+    (species overlap, sos_thr=0), from the root of the tree whatever the
+    given node: an internal node is a duplication (D) if the species below
+    its two children overlap and a speciation (S) otherwise. The species
+    below each node are integer bitmasks accumulated in a single postorder
+    pass instead of species sets built at every node.
+
+    Args:
+        tree (PhyloTree): ete3 PhyloTree object with a get_species_tag function
+
+    Raises:
+        TypeError: if the root or any internal node does not have two
+        children
+    '''
+
+    root = tree.get_tree_root()
+    if len(root.children) != 2:
+        raise TypeError('Tree is not rooted')
+
+    spbits = dict()
+    masks = dict()
+    for node in root.traverse('postorder'):
+        if node.is_leaf():
+            masks[node] = 1 << spbits.setdefault(node.species, len(spbits))
+        elif len(node.children) != 2:
+            raise TypeError('nodes are expected to have two childs.')
+        else:
+            mask_a = masks.pop(node.children[0])
+            mask_b = masks.pop(node.children[1])
+            node.add_feature('evoltype', 'D' if mask_a & mask_b else 'S')
+            masks[node] = mask_a | mask_b
+
+
 def is_rooted(tree):
     # Get the tree's root
     root = tree.get_tree_root()
@@ -281,13 +510,114 @@ def is_rooted(tree):
         return True
 
 
+# Keys of the tree_stats dictionary in order
+TREE_STATS_KEYS = ['leafno', 'spno',
+                   'median_r2t', 'mean_r2t', 'var_r2t', 'kurt_r2t', 'skew_r2t',
+                   'median_brlens', 'mean_brlens', 'var_brlens',
+                   'kurt_brlens', 'skew_brlens',
+                   'median_int_brlens', 'mean_int_brlens', 'var_int_brlens',
+                   'kurt_int_brlens', 'skew_int_brlens',
+                   'median_tip_brlens', 'mean_tip_brlens', 'var_tip_brlens',
+                   'kurt_tip_brlens', 'skew_tip_brlens',
+                   'mean_bs', 'width', 'tree_length', 'tlen_leafno_ratio',
+                   'S', 'D', 'duprate', 'treeness', 'single_copy']
+
+
+def get_segment_moments(values, seg, nseg):
+    '''
+    Get the median and moments of the segments of an array
+
+    The mean, variance, skewness and kurtosis of every segment are computed
+    together with segmented sums of the powers of the deviations, and the
+    medians from a single sort by segment and value. The results are the
+    ones of np.median, np.mean, np.var, stats.kurtosis and stats.skew
+    (biased, Fisher kurtosis). Constant segments, whose variance is within
+    the float resolution of their mean, have nan skewness and kurtosis as
+    in scipy, and empty segments get nan.
+
+    Args:
+        values (np.ndarray): float values
+
+        seg (np.ndarray): segment of each value, from 0 to nseg - 1
+
+        nseg (int): number of segments
+
+    Returns:
+        dictionary: median, mean, var, kurt, skew, sum and max arrays
+        indexed by segment
+    '''
+
+    sizes = np.bincount(seg, minlength=nseg)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Central moments from the deviations to the segment means
+        total = np.bincount(seg, values, nseg)
+        mean = total / sizes
+        dev = values - mean[seg]
+        dev2 = dev * dev
+        m2 = np.bincount(seg, dev2, nseg) / sizes
+        m3 = np.bincount(seg, dev2 * dev, nseg) / sizes
+        m4 = np.bincount(seg, dev2 * dev2, nseg) / sizes
+
+        # Constant segments have no skewness nor kurtosis, as in scipy
+        zero = m2 <= (np.finfo(float).resolution * mean) ** 2
+        skew = np.where(zero, np.nan, m3 / m2 ** 1.5)
+        kurt = np.where(zero, np.nan, m4 / m2 ** 2 - 3)
+
+    # Medians and maxima from the values sorted within each segment
+    median = np.full(nseg, np.nan)
+    vmax = np.full(nseg, np.nan)
+    full = sizes > 0
+    if len(values) > 0:
+        svalues = values[np.lexsort((values, seg))]
+        starts = (np.cumsum(sizes) - sizes)[full]
+        lo = starts + (sizes[full] - 1) // 2
+        hi = starts + sizes[full] // 2
+        median[full] = (svalues[lo] + svalues[hi]) / 2
+        vmax[full] = svalues[starts + sizes[full] - 1]
+
+    return {'median': median, 'mean': mean, 'var': m2, 'kurt': kurt,
+            'skew': skew, 'sum': total, 'max': vmax}
+
+
+def get_moments(groups):
+    '''
+    Get the median and moments of several groups of values at once
+
+    The groups are concatenated in a typed array and their statistics are
+    computed together by get_segment_moments.
+
+    Args:
+        groups (dict): one-dimensional arrays of values by group name
+
+    Returns:
+        dictionary: median_, mean_, var_, kurt_ and skew_ values of each
+        group, suffixed with the group name. Empty groups get nan.
+    '''
+
+    names = list(groups)
+    sizes = [len(groups[x]) for x in names]
+    values = np.concatenate([np.asarray(groups[x], dtype=float)
+                             for x in names])
+    seg = np.repeat(np.arange(len(names)), sizes)
+    segmoments = get_segment_moments(values, seg, len(names))
+
+    moments = dict()
+    for i, name in enumerate(names):
+        for stat in ['median', 'mean', 'var', 'kurt', 'skew']:
+            moments[stat + '_' + name] = segmoments[stat][i]
+
+    return moments
+
+
 def tree_stats(tree):
     '''
     Get tree branch stats
 
     From a tree the function retrieves basic numerical information about the
-    branches lengths. First, it creates a list where stores all the root to
-    tip distances, then calculates the median, the mean, the width and the sum
+    branches lengths. First, it gathers the branch lengths, supports and root
+    to tip distances in one preorder pass, then calculates the median, the
+    moments, the width and the sum
 
     Args:
         tree (PhyloTree): ete3 PhyloTree object with a get_species_tag function
@@ -299,36 +629,49 @@ def tree_stats(tree):
         Exception: description
     '''
 
+    # The events of a tree rooted and labelled before are kept
     if not is_rooted(tree):
         og = tree.get_midpoint_outgroup()
         tree.set_outgroup(og)
-    
-    tree.get_descendant_evol_events()
+        get_evol_events(tree)
+    elif 'evoltype' not in tree.get_tree_root().features:
+        get_evol_events(tree)
 
-    # Retrieving all, internal, tip and root-to-tip branch lengths lists and the supports
+    # Retrieving all, internal, tip and root-to-tip branch lengths and the
+    # supports, each root-to-tip distance is the one of the parent plus the
+    # branch length
     brlenl = list()
-    int_brlenl = list()
+    leafl = list()
     supportl = list()
-    tip_brlenl = list()
     r2t_distl = list()
+    depth = {tree: 0.0}
 
     evoltypes = dict()
     evoltypes['S'] = 0
     evoltypes['D'] = 0
 
-    for node in tree.traverse():
+    for node in tree.traverse('preorder'):
         brlenl.append(node.dist)
+        if node is not tree:
+            depth[node] = depth[node.up] + node.dist
+
         if not node.is_leaf():
+            leafl.append(False)
             supportl.append(node.support)
-            int_brlenl.append(node.dist)
         else:
-            tip_brlenl.append(node.dist)
-            r2t_distl.append(tree.get_distance(node.name))
+            leafl.append(True)
+            r2t_distl.append(depth[node])
 
         if 'evoltype' in node.features:
             evoltypes[node.evoltype] += 1
 
-    treelen = sum(brlenl)
+    brlenl = np.array(brlenl, dtype=float)
+    leafm = np.array(leafl, dtype=bool)
+    int_brlenl = brlenl[~leafm]
+    tip_brlenl = brlenl[leafm]
+    r2t_distl = np.array(r2t_distl, dtype=float)
+
+    treelen = brlenl.sum()
 
     # Generating the output dictionary
     nodedict = dict()
@@ -336,35 +679,19 @@ def tree_stats(tree):
     nodedict['spno'] = len(tree.get_species())
 
     if nodedict['leafno'] > 1:
-        nodedict['median_r2t'] = np.median(r2t_distl)
-        nodedict['mean_r2t'] = np.mean(r2t_distl)
-        nodedict['var_r2t'] = np.var(r2t_distl)
-        nodedict['kurt_r2t'] = stats.kurtosis(r2t_distl)
-        nodedict['skew_r2t'] = stats.skew(r2t_distl)
-        nodedict['median_brlens'] = np.median(brlenl)
-        nodedict['mean_brlens'] = np.mean(brlenl)
-        nodedict['var_brlens'] = np.var(brlenl)
-        nodedict['kurt_brlens'] = stats.kurtosis(brlenl)
-        nodedict['skew_brlens'] = stats.skew(brlenl)
-        nodedict['median_int_brlens'] = np.median(int_brlenl)
-        nodedict['mean_int_brlens'] = np.mean(int_brlenl)
-        nodedict['var_int_brlens'] = np.var(int_brlenl)
-        nodedict['kurt_int_brlens'] = stats.kurtosis(int_brlenl)
-        nodedict['skew_int_brlens'] = stats.skew(int_brlenl)
-        nodedict['median_tip_brlens'] = np.median(tip_brlenl)
-        nodedict['mean_tip_brlens'] = np.mean(tip_brlenl)
-        nodedict['var_tip_brlens'] = np.var(tip_brlenl)
-        nodedict['kurt_tip_brlens'] = stats.kurtosis(tip_brlenl)
-        nodedict['skew_tip_brlens'] = stats.skew(tip_brlenl)
+        nodedict.update(get_moments({'r2t': r2t_distl,
+                                     'brlens': brlenl,
+                                     'int_brlens': int_brlenl,
+                                     'tip_brlens': tip_brlenl}))
         nodedict['mean_bs'] = np.mean(supportl)
-        nodedict['width'] = tree.get_farthest_leaf()[1]
+        nodedict['width'] = r2t_distl.max()
         nodedict['tree_length'] = treelen
         nodedict['tlen_leafno_ratio'] = nodedict['tree_length'] / nodedict['leafno']
         nodedict['S'] = evoltypes['S']
         nodedict['D'] = evoltypes['D']
         nodedict['duprate'] =  evoltypes['S'] / sum(evoltypes.values())
         if treelen != 0:
-            nodedict['treeness'] = sum(int_brlenl) / treelen
+            nodedict['treeness'] = int_brlenl.sum() / treelen
         if nodedict['D'] == 0:
             nodedict['single_copy'] = True
         else:
@@ -373,7 +700,8 @@ def tree_stats(tree):
     return nodedict
 
 
-def get_group_mrca(tree, tree_id, feature, sp_in=None, firstsplit=None):
+def get_group_mrca(tree, tree_id, feature, sp_in=None, firstsplit=None,
+                   spidx=None):
     '''
     Get the greatest monophyletic subtree of a labeled group
 
@@ -381,6 +709,12 @@ def get_group_mrca(tree, tree_id, feature, sp_in=None, firstsplit=None):
     of the feature indicated. Check all groups with these conditions and
     returns one that maximizes the number of leaves.
 
+    The subtrees are summarised in a single bottom-up pass (reverse
+    levelorder): each node gets its number of leaves, its common feature
+    value, its width, its species bitmask and whether it contains sp_in
+    from its children summaries. The best group is kept as a running
+    maximum, ties are solved in favour of the first node in levelorder.
+
     Args:
         tree (PhyloTree): ete3 PhyloTree object with a get_species_tag function
 
@@ -392,87 +726,198 @@ def get_group_mrca(tree, tree_id, feature, sp_in=None, firstsplit=None):
         sp_in (string): the name of the species that has to be inside the
         MRCA group
 
+        firstsplit (dict or tuple): species tree first split of the groups,
+        as species sets or as bitmasks of the spidx index
+
+        spidx (dict): species index from get_species_index, a new one is
+        created if None
+
     Returns:
         dictionary: dictionary with some information about the node and
         the node
 
     Raises:
-        Exception: description
+        IndexError: there is no subtree fulfilling the conditions
     '''
 
+    if spidx is None:
+        spidx = dict()
+
     if firstsplit is not None:
         if isinstance(firstsplit, tuple):
-            sptspl = firstsplit
+            sptspl = get_split_masks(firstsplit, spidx)
         else:
-            sptspl = firstsplit[feature]
+            sptspl = get_split_masks(firstsplit[feature], spidx)
+
+    # Subtree summaries: leaves number, feature value (mixed if the leaves
+    # do not share it), width, species bitmask and sp_in inclusion
+    mixed = object()
+    summ = dict()
+
+    nodes = list(tree.traverse('levelorder'))
+    tlno = len([st for st in nodes if st.is_leaf()])
+    best = None
+    for st in reversed(nodes):
+        if st.is_leaf():
+            summ[st] = (1, getattr(st, feature), 0.0,
+                        get_species_mask([st.species], spidx),
+                        sp_in is None or st.name == sp_in)
+            continue
+
+        chsumm = [summ[ch] for ch in st.children]
+        stlno = sum(x[0] for x in chsumm)
+        feat = chsumm[0][1]
+        if any(x[1] is mixed or x[1] != feat for x in chsumm):
+            feat = mixed
+        stwdth = max(x[2] + ch.dist for x, ch in zip(chsumm, st.children))
+        stsp = 0
+        for x in chsumm:
+            stsp |= x[3]
+        incl = any(x[4] for x in chsumm)
+        summ[st] = (stlno, feat, stwdth, stsp, incl)
+
+        # Check the subtree contains sp_in, has 1 attribute, it is not the
+        # entire tree, it is not a polytomy and it is larger than the best
+        if (incl and feat is not mixed and feat != 'nan' and
+                stlno != tlno and stwdth != 0 and
+                st.evoltype == 'S' and
+                (best is None or stlno >= best['seq_no'])):
+            if firstsplit is not None:
+                # Species of the first two descendants in levelorder
+                stspl = list()
+                queue = list(st.children)
+                while len(stspl) < 2:
+                    node = queue.pop(0)
+                    stspl.append(summ[node][3])
+                    queue += node.children
 
-    # Get the number of leaves in the tree
-    tlno = len(tree.get_leaf_names())
+                # Checkig whether the first partition of the subtree agrees
+                # with the species tree topology
+                if not agrees_first_split(stspl, sptspl):
+                    continue
 
-    # Get the monophyletic sets containing all species with col attribute
-    mphysets = list()
-    for st in tree.traverse():
-        # Get the tree leaves
-        leaves = st.get_leaves()
-        stlno = len(leaves)
+            # Storing a dictionary with the basic information of the
+            # monophyletic group
+            best = dict()
+            best['tree'] = tree_id
+            best['node'] = st
+            best['seq_no'] = stlno
+            best['set_featlist'] = {feat}
+            best['sp_no'] = bin(stsp).count('1')
+            best['evoltype'] = st.evoltype
+            best[feature] = feat
 
-        if stlno > 1:
-            # Width of the monophyletic group
-            stwdth = st.get_farthest_leaf()[1]
+    if best is None:
+        raise IndexError('No monophyletic group for %s in %s.' %
+                         (feature, tree_id))
 
-            # Geting the evolutionary event of the node
-            evtype = st.evoltype
+    return best
 
-            # Generate list of col attributes in subtree
-            feat_list = list()
-            for stleag in st.get_leaves():
-                feat_list.append(getattr(stleag, feature))
 
-            # If the species to include is None we get the first leaf
-            lnames = st.get_leaf_names()
-            if sp_in is None:
-                sptoincl = lnames[0]
-            else:
-                sptoincl = sp_in
+def get_groups_mrca(tree, tree_id, event_species, spgroups, sp_in=None,
+                    firstsplit=None, spidx=None):
+    '''
+    Get the greatest monophyletic subtree of every group at once
 
-            if firstsplit is None:
-                first_sp_bbol = True
-            else:
-                # Getting the first partition of the subtree
-                stspl = get_first_split_sp(st)
+    Same conditions as get_group_mrca, but all the groups are evaluated in
+    a single bottom-up pass. Instead of annotating the leaves, each node
+    keeps the bitmask of the groups that contain all its leaves, obtained
+    as the intersection of its children bitmasks.
 
-                # Checkig whether the first partition of the subtree agrees
-                # with the species tree topology
-                if ([x.issubset(sptspl[0]) and not x.issubset(sptspl[1])
-                     for x in stspl].count(True) == 1 and
-                        [x.issubset(sptspl[1]) and not x.issubset(sptspl[0])
-                         for x in stspl].count(True) == 1):
-                    first_sp_bbol = True
-                else:
-                    first_sp_bbol = False
+    Args:
+        tree (PhyloTree): ete3 PhyloTree object with a get_species_tag function
 
-            # Check the subtree only contains 1 attributes, it has more
-            # than 1 leaves, it is not the entire tree and it is not a polytomy
-            if (sptoincl in lnames and len(set(feat_list)) == 1
-                    and list(set(feat_list))[0] != 'nan' and
-                    stlno != tlno and stwdth != 0 and
-                    evtype == 'S' and first_sp_bbol):
-                # Appending to a list a dictionary with the basic information
-                # of the group monophyletic group
-                mphy = dict()
-                mphy['tree'] = tree_id
-                mphy['node'] = st
-                mphy['seq_no'] = stlno
-                mphy['set_featlist'] = set(feat_list)
-                mphy['sp_no'] = len(st.get_species())
-                mphy['evoltype'] = evtype
-                mphy[feature] = feat_list[0]
-                mphysets.append((stlno, mphy))
+        tree_id (string): the phylome tree id
 
-        # Get the maximum leaves monophyletic group for each group
-        mphylist = sorted(mphysets, key=itemgetter(0), reverse=True)
+        event_species (dict): dictionary with the group as key and the
+        species list as value
 
-    return mphylist[0][1]
+        spgroups (dict): species group bitmasks from get_group_bitmasks
+
+        sp_in (string): the name of the sequence that has to be inside the
+        MRCA groups
+
+        firstsplit (dict): species tree first split of each group, as species
+        sets or as bitmasks of the spidx index
+
+        spidx (dict): species index from get_species_index, a new one is
+        created if None
+
+    Returns:
+        dictionary: dictionary with the group as key and the get_group_mrca
+        dictionary as value, groups without MRCA are missing
+    '''
+
+    groups = list(event_species)
+
+    if spidx is None:
+        spidx = dict()
+
+    if firstsplit is not None:
+        firstsplit = {group: get_split_masks(firstsplit[group], spidx)
+                      for group in groups}
+
+    # Subtree summaries: leaves number, group bitmask, width, species
+    # bitmask and sp_in inclusion
+    summ = dict()
+
+    nodes = list(tree.traverse('levelorder'))
+    tlno = len([st for st in nodes if st.is_leaf()])
+    best = dict()
+    for st in reversed(nodes):
+        if st.is_leaf():
+            summ[st] = (1, spgroups.get(st.species, 0), 0.0,
+                        get_species_mask([st.species], spidx),
+                        sp_in is None or st.name == sp_in)
+            continue
+
+        chsumm = [summ[ch] for ch in st.children]
+        stlno = sum(x[0] for x in chsumm)
+        stmask = chsumm[0][1]
+        for x in chsumm[1:]:
+            stmask &= x[1]
+        stwdth = max(x[2] + ch.dist for x, ch in zip(chsumm, st.children))
+        stsp = 0
+        for x in chsumm:
+            stsp |= x[3]
+        incl = any(x[4] for x in chsumm)
+        summ[st] = (stlno, stmask, stwdth, stsp, incl)
+
+        # Conditions shared by all the groups
+        if not (incl and stmask and stlno != tlno and stwdth != 0 and
+                st.evoltype == 'S'):
+            continue
+
+        stspl = None
+        for i, group in enumerate(groups):
+            if not stmask >> i & 1 or (group in best and
+                                       stlno < best[group]['seq_no']):
+                continue
+
+            if firstsplit is not None:
+                if stspl is None:
+                    # Species of the first two descendants in levelorder
+                    stspl = list()
+                    queue = list(st.children)
+                    while len(stspl) < 2:
+                        node = queue.pop(0)
+                        stspl.append(summ[node][3])
+                        queue += node.children
+
+                if not agrees_first_split(stspl, firstsplit[group]):
+                    continue
+
+            mphy = dict()
+            mphy['tree'] = tree_id
+            mphy['node'] = st
+            mphy['seq_no'] = stlno
+            mphy['set_featlist'] = {group}
+            mphy['sp_no'] = bin(stsp).count('1')
+            mphy['evoltype'] = st.evoltype
+            mphy[group] = group
+            best[group] = mphy
+
+    return best
 
 
 def old_get_group_mrca(tree, tree_id, feature, sp_in=None):
@@ -553,14 +998,17 @@ def old_get_group_mrca(tree, tree_id, feature, sp_in=None):
     return mphylist[0][1]
 
 
-def get_first_split_sp(tree):
+def get_first_split_sp(tree, spidx=None):
     # Writing in a tupple the species after the first partition
-    # in two groups
+    # in two groups, as bitmasks if there is a species index
     i = 0
     ol = list()
     for node in tree.iter_descendants():
         if i < 2:
-            ol.append(set(node.get_species()))
+            if spidx is None:
+                ol.append(set(node.get_species()))
+            else:
+                ol.append(get_species_mask(node.get_species(), spidx))
             i += 1
         else:
             break
@@ -568,9 +1016,9 @@ def get_first_split_sp(tree):
     return (ol[0], ol[1])
 
 
-def get_fist_part_sp(sptree, event_species, sorted_keys, seed):
+def get_fist_part_sp(sptree, event_species, sorted_keys, seed, spidx=None):
     # Getting the evolutionary events of the tree (MRCA function requirement)
-    sptree.get_descendant_evol_events()
+    get_evol_events(sptree)
 
     # Generating the output dictionary
     odict = dict()
@@ -585,7 +1033,7 @@ def get_fist_part_sp(sptree, event_species, sorted_keys, seed):
 
         # Writing in a tupple the species after the first partition
         # in two groups
-        ot = get_first_split_sp(spgroupt['node'])
+        ot = get_first_split_sp(spgroupt['node'], spidx)
 
         odict[group] = ot
 
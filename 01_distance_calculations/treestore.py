@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+treestore.py -- Binary store of phylome trees
+
+The trees of a phylome file are converted once into flat arrays written to
+a store directory, so the distance runs over the same trees load them
+without parsing their newick strings. The arrays of all the trees are
+concatenated and memory mapped when the store is opened, and each tree is
+a zero-copy slice of them. The store directory contains:
+
+ - parent.i32: parent of each node in the preorder numbering of its tree,
+   -1 for the roots
+ - brlen.f64 and support.f64: branch length and support of each node
+ - leafsp.i32: species id of each leaf, -1 for the internal nodes
+ - names.bin and nameoff.i64: UTF-8 node names and their offsets
+ - species.txt: species codes by id
+ - index.tsv: seed, model, likelihood, first and last node of each tree
+
+The index is written last, from a temporary name, so a store directory
+with an index.tsv file is complete. The distance scripts read a store when
+their input is a store directory.
+
+Requirements:
+ - os
+ - numpy
+ - ete3
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+import os
+import numpy as np
+from treefuns import read_treeline, check_tree_size
+from arraytree import ArrayTree
+from runner import run_pool
+from utils import file_exists
+
+
+# Store arrays and their types ----
+ARRAYS = {'parent': np.int32, 'brlen': np.float64, 'support': np.float64,
+          'leafsp': np.int32, 'nameoff': np.int64, 'names': np.uint8}
+
+FILENAMES = {'parent': 'parent.i32', 'brlen': 'brlen.f64',
+             'support': 'support.f64', 'leafsp': 'leafsp.i32',
+             'nameoff': 'nameoff.i64', 'names': 'names.bin'}
+
+
+# Define classes ----
+class convert_process:
+    # Built once per pool process, run() parses one tree line and returns
+    # its arrays with the species codes of the leaves
+    def run(self, line):
+        tree = read_treeline(line)
+        atree = ArrayTree.from_phylotree(tree['tree'])
+
+        return {'model': tree['model'],
+                'likelihood': tree['likelihood'],
+                'parent': atree.parent,
+                'brlen': atree.brlen,
+                'support': atree.supports,
+                'leafsp': atree.leaf_sp,
+                'species': atree.species,
+                'names': atree.names.tolist()}
+
+
+class TreeStore:
+    '''
+    Memory mapped binary store of phylome trees
+
+    Args:
+        path (str): store directory written by write_store
+
+    Attributes:
+        seeds (list): tree seeds in the store order
+        species (list): species codes by id
+        index (dict): model, likelihood, first and last node of each seed
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = dict()
+        for key, dtype in ARRAYS.items():
+            filename = os.path.join(path, FILENAMES[key])
+            if os.path.getsize(filename) > 0:
+                self.arrays[key] = np.memmap(filename, dtype=dtype, mode='r')
+            else:
+                self.arrays[key] = np.zeros(0, dtype=dtype)
+
+        with open(os.path.join(path, 'species.txt')) as handle:
+            self.species = [x.rstrip('\n') for x in handle]
+
+        self.seeds = list()
+        self.index = dict()
+        with open(os.path.join(path, 'index.tsv')) as handle:
+            for line in handle:
+                fields = line.rstrip('\n').split('\t')
+                seed, model, likelihood, start, end = fields
+                self.seeds.append(seed)
+                self.index[seed] = (model, likelihood, int(start), int(end))
+
+    def get_arraytree(self, seed):
+        '''
+        Load a tree of the store
+
+        The parent, branch length, support and species arrays of the tree
+        are views of the memory mapped store, only the names are decoded.
+
+        Args:
+            seed (str): tree seed
+
+        Returns:
+            ArrayTree: the tree, unrooted as it was in the newick file
+        '''
+
+        start, end = self.index[seed][2:]
+        offsets = self.arrays['nameoff'][start:end + 1]
+        blob = self.arrays['names'][offsets[0]:offsets[-1]].tobytes()
+        offsets = offsets - offsets[0]
+        names = [blob[offsets[i]:offsets[i + 1]].decode()
+                 for i in range(end - start)]
+
+        return ArrayTree(self.arrays['parent'][start:end],
+                         self.arrays['brlen'][start:end],
+                         self.arrays['support'][start:end],
+                         names, self.species,
+                         self.arrays['leafsp'][start:end])
+
+    def get_bytes(self, seed):
+        '''
+        Get the content of a tree of the store as bytes
+
+        Two trees have the same bytes if they have the same topology,
+        branch lengths, supports, names and leaf species, whatever store
+        they come from.
+
+        Args:
+            seed (str): tree seed
+
+        Returns:
+            bytes: the tree arrays, names and species codes
+        '''
+
+        start, end = self.index[seed][2:]
+        leafsp = self.arrays['leafsp'][start:end]
+        species = '\t'.join(self.species[x] if x >= 0 else ''
+                            for x in leafsp.tolist())
+        offsets = self.arrays['nameoff'][start:end + 1]
+        names = self.arrays['names'][offsets[0]:offsets[-1]]
+
+        return b''.join([self.arrays['parent'][start:end].tobytes(),
+                         self.arrays['brlen'][start:end].tobytes(),
+                         self.arrays['support'][start:end].tobytes(),
+                         np.diff(offsets).tobytes(), names.tobytes(),
+                         species.encode()])
+
+    def read_treeline(self, seed):
+        '''
+        Read a tree of the store as read_treeline reads a tree line
+
+        Args:
+            seed (str): tree seed
+
+        Returns:
+            dict: containing the seed, the model, the likelihood and the tree
+        '''
+
+        tree_dict = self.read_arraytree(seed)
+        tree_dict['tree'] = tree_dict['tree'].to_phylotree()
+
+        return tree_dict
+
+    def read_arraytree(self, seed):
+        '''
+        Read a tree of the store without building its ete3 nodes
+
+        Args:
+            seed (str): tree seed
+
+        Returns:
+            dict: containing the seed, the model, the likelihood and the tree
+            as an ArrayTree
+        '''
+
+        tree_dict = dict()
+        tree_dict['seed'] = seed
+        tree_dict['model'] = self.index[seed][0]
+        tree_dict['likelihood'] = self.index[seed][1]
+        tree_dict['tree'] = self.get_arraytree(seed)
+
+        return tree_dict
+
+    def screen_treeline(self, seed, min_species=None, max_leaves=None,
+                        max_copies=None):
+        '''
+        Check the size of a tree of the store before loading it
+
+        Args:
+            seed (str): tree seed
+
+            min_species (int): minimum number of species
+
+            max_leaves (int): maximum number of leaves
+
+            max_copies (float): trees with at least this mean number of
+            leaves per species are skipped
+
+        Returns:
+            boolean: whether the tree passes the filters
+        '''
+
+        start, end = self.index[seed][2:]
+        leafsp = self.arrays['leafsp'][start:end]
+        leafsp = leafsp[leafsp >= 0]
+
+        return check_tree_size(len(leafsp), len(np.unique(leafsp)),
+                               min_species, max_leaves, max_copies)
+
+
+# Define functions ----
+def write_store(ifile, odir, threads=1, chunksize=8):
+    '''
+    Convert a phylome trees file into a binary store
+
+    Args:
+        ifile (str): file with multiple trees in newick, each line has the
+        format: seed\tmodel\tlikelihood\tnewick
+
+        odir (str): store directory
+
+        threads (int): number of processes parsing the trees
+
+        chunksize (int): number of trees sent to a process at once
+    '''
+
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+
+    # The index of a previous store goes first, an interrupted conversion
+    # leaves no index
+    indexfile = os.path.join(odir, 'index.tsv')
+    if os.path.isfile(indexfile):
+        os.remove(indexfile)
+
+    handles = {key: open(os.path.join(odir, filename), 'wb')
+               for key, filename in FILENAMES.items()}
+    index = open('%s.part' % indexfile, 'w')
+
+    spidx = dict()
+    nodeno = 0
+    nameno = 0
+    tree_rows = (x for x in open(ifile, 'r') if x.strip() != '')
+    for result in run_pool(tree_rows, convert_process, dict(), threads,
+                           chunksize):
+        if result is None:
+            continue
+        seed, tree = result
+
+        # Translating the tree species ids to the store ones
+        for sp in tree['species']:
+            spidx.setdefault(sp, len(spidx))
+        spmap = np.array([spidx[sp] for sp in tree['species']] + [-1],
+                         dtype=np.int32)
+        leafsp = spmap[tree['leafsp']]
+
+        names = [x.encode() for x in tree['names']]
+        nameoff = nameno + np.cumsum([0] + [len(x) for x in names[:-1]])
+        nameno += sum(len(x) for x in names)
+
+        handles['parent'].write(tree['parent'].astype(np.int32).tobytes())
+        handles['brlen'].write(tree['brlen'].astype(np.float64).tobytes())
+        handles['support'].write(tree['support'].astype(np.float64).tobytes())
+        handles['leafsp'].write(leafsp.astype(np.int32).tobytes())
+        handles['nameoff'].write(nameoff.astype(np.int64).tobytes())
+        handles['names'].write(b''.join(names))
+
+        index.write('%s\t%s\t%s\t%s\t%s\n' % (seed, tree['model'],
+                                              tree['likelihood'], nodeno,
+                                              nodeno + len(tree['parent'])))
+        nodeno += len(tree['parent'])
+
+    # Closing offset of the last name
+    handles['nameoff'].write(np.array([nameno], dtype=np.int64).tobytes())
+
+    for handle in handles.values():
+        handle.close()
+    index.close()
+
+    with open(os.path.join(odir, 'species.txt'), 'w') as handle:
+        for sp in sorted(spidx, key=spidx.get):
+            handle.write('%s\n' % sp)
+
+    # Marking the store as complete
+    os.replace('%s.part' % indexfile, indexfile)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='ifile',
+                      help=('File with multiple trees in newick, each line has'
+                            ' the format: seed\tmodel\tlikelihood\tnewick'),
+                      metavar='<file.nwk>')
+    parser.add_option('-o', '--output', dest='odir',
+                      help='Output store directory.',
+                      metavar='<trees.store>')
+    parser.add_option('-t', '--threads', dest='threads',
+                      help='Number of threads.',
+                      metavar='<N>', type='int', default=4)
+    parser.add_option('-k', '--chunksize', dest='chunksize',
+                      help='Number of trees sent to a process at once.',
+                      metavar='<N>', type='int', default=8)
+    parser.add_option('-r', '--redo', dest='redo',
+                      help='Ommit done file and redo.',
+                      action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    ifile = options.ifile
+    odir = options.odir
+    cpus = options.threads
+    chunksize = options.chunksize
+    redo = options.redo
+
+    if not file_exists(os.path.join(odir, 'index.tsv')) or redo:
+        write_store(ifile, odir, cpus, chunksize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+workqueue.py -- Work queue of tree batches for elastic runs
+
+The trees of a phylome are split in batches stored in a SQLite queue file.
+The distance scripts run with --queue as workers, which can be started at
+any time and on any host sharing the filesystem: each worker leases a batch,
+computes its trees with its pool of processes, writes the rows to its own
+part table in <prefix>.parts and marks the batch done. Leases expire after a
+timeout, so the batches of workers which died are leased again, and batches
+with failed trees are leased again up to a number of attempts. The SQLite
+file locks have to work on the shared filesystem.
+
+This script creates the queue, reports the state of its batches and, once
+they are all finished, merges the part tables into <prefix>.<format>.
+
+Requirements:
+ - os
+ - socket
+ - sqlite3
+ - time
+ - numpy
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+import os
+import socket
+import sqlite3
+import time
+import numpy as np
+from runner import start_pool, run_worker
+from shards import index_trees, index_store, read_lines, merge_tables
+from utils import create_folder, file_exists
+
+
+# Queue tables ----
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY,
+                                    status TEXT NOT NULL,
+                                    owner TEXT,
+                                    lease_until REAL,
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    part TEXT);
+CREATE TABLE IF NOT EXISTS trees (seed TEXT NOT NULL,
+                                  batch INTEGER NOT NULL,
+                                  offset INTEGER);
+CREATE INDEX IF NOT EXISTS trees_batch ON trees (batch);
+'''
+
+STATUSES = ['todo', 'leased', 'done', 'failed']
+
+
+# Define classes ----
+class WorkQueue:
+    '''
+    SQLite queue of tree batches
+
+    Args:
+        dbfile (str): queue file, created if it does not exist
+
+    Attributes:
+        owner (str): host and process id of this worker
+    '''
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.owner = '%s-%s' % (socket.gethostname(), os.getpid())
+        self.conn = sqlite3.connect(dbfile, timeout=600,
+                                    isolation_level=None)
+        self.conn.executescript(SCHEMA)
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                (key,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def fill(self, index, batchsize=50, timeout=3600, attempts=3):
+        '''
+        Add the trees of an index to an empty queue
+
+        The trees are sorted from the largest to the smallest, so the
+        largest ones are leased first and the smallest fill the end of the
+        run. Queues which already have batches are kept as they are.
+
+        Args:
+            index (dict): index from index_trees or index_store
+
+            batchsize (int): number of trees of each batch
+
+            timeout (float): seconds before a lease expires
+
+            attempts (int): number of leases of a batch before it is
+            considered failed
+
+        Returns:
+            boolean: whether the queue was filled
+        '''
+
+        order = np.argsort(-index['leafno'], kind='stable')
+        offsets = index.get('offset')
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            count = self.conn.execute('SELECT COUNT(*) FROM batches')
+            if count.fetchone()[0] > 0:
+                self.conn.execute('COMMIT')
+                return False
+
+            for key, value in [('timeout', timeout), ('attempts', attempts)]:
+                self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                  (key, str(value)))
+
+            for batch, start in enumerate(range(0, len(order), batchsize)):
+                self.conn.execute("INSERT INTO batches (id, status) "
+                                  "VALUES (?, 'todo')", (batch,))
+                rows = [(index['seeds'][i], batch,
+                         None if offsets is None else int(offsets[i]))
+                        for i in order[start:start + batchsize]]
+                self.conn.executemany('INSERT INTO trees VALUES (?, ?, ?)',
+                                      rows)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        return True
+
+    def lease(self):
+        '''
+        Lease the next pending batch
+
+        Batches whose lease expired are leased again, or marked as failed if
+        they ran out of attempts.
+
+        Returns:
+            tuple: batch id and list of (seed, offset) of its trees, None if
+            there are no batches left to lease
+        '''
+
+        now = time.time()
+        timeout = float(self.get_meta('timeout'))
+        attempts = int(self.get_meta('attempts'))
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute("UPDATE batches SET status = 'failed', "
+                              "owner = NULL WHERE status = 'leased' AND "
+                              "lease_until < ? AND attempts >= ?",
+                              (now, attempts))
+            row = self.conn.execute("SELECT id FROM batches WHERE "
+                                    "status = 'todo' OR (status = 'leased' "
+                                    "AND lease_until < ?) ORDER BY id "
+                                    "LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE batches SET status = 'leased', "
+                                  "owner = ?, lease_until = ?, "
+                                  "attempts = attempts + 1 WHERE id = ?",
+                                  (self.owner, now + timeout, row[0]))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        if row is None:
+            return None
+
+        trees = self.conn.execute('SELECT seed, offset FROM trees WHERE '
+                                  'batch = ? ORDER BY rowid',
+                                  (row[0],)).fetchall()
+
+        return row[0], trees
+
+    def renew(self, batch):
+        '''
+        Extend the lease of a batch which is still being computed
+
+        Args:
+            batch (int): batch id
+        '''
+
+        timeout = float(self.get_meta('timeout'))
+        self.conn.execute("UPDATE batches SET lease_until = ? WHERE id = ? "
+                          "AND owner = ? AND status = 'leased'",
+                          (time.time() + timeout, batch, self.owner))
+
+    def complete(self, batch, part):
+        '''
+        Mark a batch as done with its part table
+
+        Args:
+            batch (int): batch id
+
+            part (str): part table of the batch
+
+        Returns:
+            boolean: whether the batch was marked, False if another worker
+            finished it first after the lease expired
+        '''
+
+        cursor = self.conn.execute("UPDATE batches SET status = 'done', "
+                                   "part = ?, owner = NULL WHERE id = ? AND "
+                                   "status != 'done'", (part, batch))
+
+        return cursor.rowcount == 1
+
+    def fail(self, batch):
+        '''
+        Give back a leased batch, it is leased again unless it ran out of
+        attempts
+
+        Args:
+            batch (int): batch id
+        '''
+
+        attempts = int(self.get_meta('attempts'))
+        self.conn.execute("UPDATE batches SET owner = NULL, status = CASE "
+                          "WHEN attempts >= ? THEN 'failed' ELSE 'todo' END "
+                          "WHERE id = ? AND owner = ? AND status = 'leased'",
+                          (attempts, batch, self.owner))
+
+    def get_status(self):
+        '''
+        Count the batches of each status
+
+        Returns:
+            dict: number of batches by status
+        '''
+
+        status = {x: 0 for x in STATUSES}
+        for key, count in self.conn.execute('SELECT status, COUNT(*) FROM '
+                                            'batches GROUP BY status'):
+            status[key] = count
+
+        return status
+
+    def get_parts(self):
+        # Part tables of the done batches in batch order
+        return [x[0] for x in self.conn.execute("SELECT part FROM batches "
+                                                "WHERE status = 'done' "
+                                                "ORDER BY id")]
+
+    def get_failed_seeds(self):
+        # Seeds of the batches which ran out of attempts
+        return [x[0] for x in self.conn.execute("SELECT seed FROM trees JOIN "
+                                                "batches ON batch = id WHERE "
+                                                "status = 'failed' ORDER BY "
+                                                "batch, trees.rowid")]
+
+    def close(self):
+        self.conn.close()
+
+
+# Define functions ----
+def get_queue(dbfile, ifile, store=None):
+    '''
+    Open the queue of a run, filling it with default batches if it is new
+
+    Args:
+        dbfile (str): queue file
+
+        ifile (str): trees file, ignored if store is given
+
+        store (str): tree store directory
+
+    Returns:
+        WorkQueue: the queue
+    '''
+
+    queue = WorkQueue(dbfile)
+    if sum(queue.get_status().values()) == 0:
+        if store is not None:
+            queue.fill(index_store(store))
+        else:
+            queue.fill(index_trees(ifile))
+
+    return queue
+
+
+def get_parts_dir(ofile):
+    # Directory of the part tables of a queue run
+    return '%s.parts' % os.path.splitext(ofile)[0]
+
+
+def run_queue(queue, ifile, store, worker_class, context, threads,
+              chunksize, ofile, writer_class, columns=None,
+              writer_args=None, profile=None):
+    '''
+    Compute the batches of a queue until none is left
+
+    Each batch is written to <prefix>.parts/<batch>.<owner>.<format> with
+    the writer of the run. The lease of the batch is renewed as its trees
+    are done, so only the batches of dead workers expire. A batch with
+    failed trees is given back to the queue and its part table removed.
+
+    Args:
+        queue (WorkQueue): queue of the run
+
+        ifile (str): trees file, ignored if store is given
+
+        store (str): tree store directory
+
+        worker_class (class): worker class, it has a run(line) method
+
+        context (dict): keyword arguments of the worker class constructor
+
+        threads (int): number of processes
+
+        chunksize (int): number of trees sent to a process at once
+
+        ofile (str): output table of the whole run
+
+        writer_class (class): writer class of the tables
+
+        columns (list): output columns
+
+        writer_args (dict): extra arguments of the writer class
+
+        profile (dict): keyword arguments of profiling.enable, None to not
+        profile the trees
+    '''
+
+    pdir = get_parts_dir(ofile)
+    create_folder(pdir)
+    ext = os.path.splitext(ofile)[1]
+    writer_args = writer_args or dict()
+    renewal = float(queue.get_meta('timeout')) / 2
+
+    with start_pool(worker_class, context, threads, profile) as pool:
+        while True:
+            leased = queue.lease()
+            if leased is None:
+                break
+            batch, trees = leased
+            print('Batch %s: %s trees' % (batch, len(trees)))
+
+            if store is not None:
+                tree_rows = [x[0] for x in trees]
+            else:
+                tree_rows = read_lines(ifile, [x[1] for x in trees])
+
+            part = os.path.join(pdir, '%s.%s%s' % (batch, queue.owner, ext))
+            failed = 0
+            renewed = time.time()
+            try:
+                with writer_class(part, columns, **writer_args) as writer:
+                    for result in pool.imap_unordered(run_worker, tree_rows,
+                                                      chunksize):
+                        if result is None:
+                            failed += 1
+                        else:
+                            seed, rows = result
+                            writer.write(rows, seed)
+                        if time.time() - renewed > renewal:
+                            queue.renew(batch)
+                            renewed = time.time()
+            except BaseException:
+                # Interrupted batches go back to the queue
+                queue.fail(batch)
+                if os.path.isfile('%s.part' % part):
+                    os.remove('%s.part' % part)
+                raise
+            finally:
+                # The queue is the checkpoint of the batches
+                if os.path.isfile('%s.done' % part):
+                    os.remove('%s.done' % part)
+
+            if failed > 0 or not queue.complete(batch, part):
+                os.remove(part)
+                if failed > 0:
+                    print('Batch %s: %s trees failed' % (batch, failed))
+                    queue.fail(batch)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-q', '--queue', dest='queue',
+                      help='Queue file.',
+                      metavar='<queue.db>')
+    parser.add_option('-i', '--input', dest='ifile',
+                      help=('Trees file or tree store to fill a new queue '
+                            'with.'),
+                      metavar='<file.nwk>')
+    parser.add_option('-b', '--batchsize', dest='batchsize',
+                      help='Number of trees of each batch.',
+                      metavar='<N>', type='int', default=50)
+    parser.add_option('-T', '--timeout', dest='timeout',
+                      help=('Seconds without news of the worker of a batch '
+                            'before another worker can take it.'),
+                      metavar='<seconds>', type='float', default=3600)
+    parser.add_option('-a', '--attempts', dest='attempts',
+                      help='Number of leases of a batch before it fails.',
+                      metavar='<N>', type='int', default=3)
+    parser.add_option('-p', '--prefix', dest='prefix',
+                      help=('Output prefix of the queue run, its part tables '
+                            'are merged once all the batches are finished.'),
+                      metavar='</path/to/dir/prefix> or <prefix>')
+    parser.add_option('-o', '--format', dest='format',
+                      help='Output table format (csv or parquet).',
+                      metavar='<format>', type='choice',
+                      choices=['csv', 'parquet'], default='csv')
+    parser.add_option('-r', '--redo', dest='redo',
+                      help='Ommit done file and redo.',
+                      action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    dbfile = options.queue
+    ifile = options.ifile
+    prefix = options.prefix
+    oformat = options.format
+    redo = options.redo
+
+    if ifile is not None:
+        if redo and os.path.isfile(dbfile):
+            os.remove(dbfile)
+        if os.path.isdir(ifile):
+            index = index_store(ifile)
+        else:
+            index = index_trees(ifile)
+        queue = WorkQueue(dbfile)
+        queue.fill(index, options.batchsize, options.timeout,
+                   options.attempts)
+    else:
+        queue = WorkQueue(dbfile)
+
+    status = queue.get_status()
+    print('Batches: %s' % ', '.join('%s %s' % (v, k)
+                                    for k, v in status.items()))
+
+    if prefix is not None:
+        ofile = '%s.%s' % (prefix, oformat)
+        if status['todo'] > 0 or status['leased'] > 0:
+            print('The queue is not finished, the tables are not merged.')
+        elif not file_exists(ofile) or redo:
+            for seed in queue.get_failed_seeds():
+                print('Tree %s failed' % seed)
+            parts = queue.get_parts()
+            if parts:
+                merge_tables(ofile, parts)
+
+    queue.close()
+
+
+if __name__ == '__main__':
+    main()
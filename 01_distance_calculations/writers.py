@@ -0,0 +1,495 @@
+'''
+writers.py -- Streaming writers for the distance tables
+
+The distance workers return the rows of each tree to the parent process,
+which appends them to the output file in batches as they arrive. Only the
+current batch is kept in memory. The table is written to a <file>.part
+file that can be read while the run goes on, and it is renamed to the final
+name when the run finishes. The tables are written as CSV, or as Parquet
+with one row group per batch of trees.
+
+The seeds of the trees whose rows are already in the part file are logged
+in a <file>.done checkpoint each time a batch is written. A batch is
+written when it reaches a number of rows, of trees or an age, so the
+checkpoint of the tables with one row per tree keeps up with the run. A
+new run on the same output skips those trees and appends the rest to the
+part file, and selected seeds can be forced to be computed again.
+
+Requirements:
+ - csv
+ - os
+ - time
+ - pandas
+ - pyarrow (optional, Parquet output)
+'''
+
+# Import libraries ----
+import csv
+import os
+import time
+import pandas as pd
+from utils import file_exists
+
+
+# Trees of a batch of the tables with one row per tree
+TREE_BATCH = 100
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Define functions ----
+def read_checkpoint(donefile):
+    '''
+    Read the seeds of a checkpoint file
+
+    Args:
+        donefile (str): checkpoint file path
+
+    Returns:
+        set: seeds in the checkpoint, empty if the file does not exist
+    '''
+
+    if not os.path.isfile(donefile):
+        return set()
+
+    return set(line.strip() for line in open(donefile) if line.strip() != '')
+
+
+def read_seeds(seeds):
+    '''
+    Read a seeds selection
+
+    Args:
+        seeds (str): file with one seed per line or comma separated seeds
+
+    Returns:
+        set: selected seeds, empty if seeds is None
+    '''
+
+    if seeds is None:
+        return set()
+    elif os.path.isfile(seeds):
+        return read_checkpoint(seeds)
+    else:
+        return set(x.strip() for x in seeds.split(',') if x.strip() != '')
+
+
+def get_done_seeds(ofile, seedcol, redo=False, redo_seeds=None,
+                   writer=None):
+    '''
+    Prepare the output table of a run and get the seeds already done
+
+    With redo, previous partial tables and checkpoints are removed. A
+    finished table is kept as it is unless some seeds have to be computed
+    again: then it goes back to a partial table. The rows of the partial
+    table whose seed is not in the checkpoint, or has to be computed again,
+    are removed, so every seed is written once.
+
+    Args:
+        ofile (str): output table path
+
+        seedcol (str): column of the table with the tree seed
+
+        redo (boolean): compute all the trees again
+
+        redo_seeds (set): seeds to compute again
+
+        writer (class): writer class of the table, TableWriter if None
+
+    Returns:
+        set: seeds already in the partial table, None if the table is
+        finished and there is nothing to compute
+    '''
+
+    partfile = '%s.part' % ofile
+    donefile = '%s.done' % ofile
+
+    if redo:
+        for filename in [partfile, donefile]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        return set()
+
+    if file_exists(ofile):
+        if not redo_seeds:
+            return None
+        os.replace(ofile, partfile)
+
+    if not file_exists(partfile):
+        if os.path.isfile(donefile):
+            os.remove(donefile)
+        return set()
+
+    done = read_checkpoint(donefile) - set(redo_seeds or [])
+
+    # Keeping only the rows of the done seeds, an unreadable part file is
+    # computed again
+    if writer is None:
+        writer = TableWriter
+    if not writer.filter_part(partfile, seedcol, done):
+        done = set()
+
+    with open(donefile, 'w') as handle:
+        for seed in sorted(done):
+            handle.write('%s\n' % seed)
+
+    return done
+
+
+def get_common_done_seeds(tables, redo=False, redo_seeds=None):
+    '''
+    Prepare the output tables of a run writing several tables and get the
+    seeds done in all of them
+
+    The tables are prepared as in get_done_seeds, finished ones going back
+    to partial tables if some of the others are not finished. Then the
+    rows of the seeds which are not done in every table are removed, so the
+    trees are computed again for all the tables.
+
+    Args:
+        tables (list): output table path, seed column and writer class of
+        each table
+
+        redo (boolean): compute all the trees again
+
+        redo_seeds (set): seeds to compute again
+
+    Returns:
+        set: seeds already in all the partial tables, None if all the tables
+        are finished and there is nothing to compute
+    '''
+
+    if (not redo and not redo_seeds and
+            all(file_exists(ofile) for ofile, _, _ in tables)):
+        return None
+
+    dones = list()
+    for ofile, seedcol, writer in tables:
+        if not redo and file_exists(ofile):
+            os.replace(ofile, '%s.part' % ofile)
+        dones.append(get_done_seeds(ofile, seedcol, redo, redo_seeds,
+                                    writer))
+
+    done = set.intersection(*dones)
+    for (ofile, seedcol, writer), tdone in zip(tables, dones):
+        if tdone != done:
+            partfile = '%s.part' % ofile
+            writer.filter_part(partfile, seedcol, done)
+            with open('%s.done' % ofile, 'w') as handle:
+                for seed in sorted(done):
+                    handle.write('%s\n' % seed)
+
+    return done
+
+
+# Define classes ----
+class TableWriter:
+    '''
+    Streaming CSV writer with a fixed set of columns
+
+    Args:
+        ofile (str): output file path
+
+        columns (list): output columns, rows missing some of them get empty
+        values and extra keys are dropped. If None, the columns of the first
+        batch are used.
+
+        batchsize (int): number of rows kept before appending them to the
+        file
+
+        resume (boolean): append to the existing part file and checkpoint
+
+        seedsize (int): number of trees kept before appending their rows,
+        None to only count the rows
+
+        interval (float): seconds after which the batch is appended with
+        the next tree, None to not flush by time
+    '''
+
+    def __init__(self, ofile, columns=None, batchsize=50000, resume=False,
+                 seedsize=None, interval=60.0):
+        self.ofile = ofile
+        self.partfile = '%s.part' % ofile
+        self.donefile = '%s.done' % ofile
+        self.columns = columns
+        self.batchsize = batchsize
+        self.seedsize = seedsize
+        self.interval = interval
+        self.batch = list()
+        self.seeds = list()
+        self.nrows = 0
+        self.last = time.monotonic()
+
+        if resume and file_exists(self.partfile):
+            self.header = False
+        else:
+            # Starting an empty part file and checkpoint
+            self.header = True
+            open(self.partfile, 'w').close()
+            open(self.donefile, 'w').close()
+
+    def write(self, rows, seed=None):
+        '''
+        Add rows to the table
+
+        Args:
+            rows (list or DataFrame): list of row dictionaries or data frame,
+            None if the tree has no rows
+
+            seed (str): seed of the tree, logged in the checkpoint once its
+            rows are written
+        '''
+
+        if rows is not None:
+            if not isinstance(rows, pd.DataFrame):
+                rows = pd.DataFrame(rows)
+
+            if len(rows) > 0:
+                self.batch.append(rows)
+                self.nrows += len(rows)
+
+        if seed is not None:
+            self.seeds.append(seed)
+
+        if (self.nrows >= self.batchsize or
+                (self.seedsize is not None and
+                 len(self.seeds) >= self.seedsize) or
+                (self.interval is not None and
+                 time.monotonic() - self.last >= self.interval)):
+            self.flush()
+
+    def flush(self):
+        # Appending the batch rows to the part file
+        if self.batch:
+            odf = pd.concat(self.batch, ignore_index=True)
+            if self.columns is None:
+                self.columns = list(odf.columns)
+            odf = odf.reindex(columns=self.columns)
+        elif self.header and self.columns is not None:
+            odf = pd.DataFrame(columns=self.columns)
+        else:
+            odf = None
+
+        if odf is not None:
+            self.write_batch(odf)
+            self.header = False
+
+        # Logging the seeds after their rows are in the file
+        if self.seeds:
+            with open(self.donefile, 'a') as handle:
+                for seed in self.seeds:
+                    handle.write('%s\n' % seed)
+
+        self.batch = list()
+        self.seeds = list()
+        self.nrows = 0
+        self.last = time.monotonic()
+
+    def write_batch(self, odf):
+        with open(self.partfile, 'a') as handle:
+            odf.to_csv(handle, index=False, header=self.header)
+
+    @staticmethod
+    def filter_part(partfile, seedcol, seeds):
+        '''
+        Keep the rows of a part file whose seed is in seeds
+
+        The kept lines are copied as they are, so the values of the rows
+        already computed are not printed again. A last line cut by an
+        interrupted run is dropped.
+
+        Args:
+            partfile (str): part file path
+
+            seedcol (str): column of the table with the tree seed
+
+            seeds (set): seeds to keep
+
+        Returns:
+            boolean: whether the part file could be read
+        '''
+
+        with open(partfile) as handle:
+            header = handle.readline()
+        if not header.endswith('\n'):
+            return False
+        col = next(csv.reader([header])).index(seedcol)
+
+        tmpfile = '%s.tmp' % partfile
+        with open(partfile) as ihandle, open(tmpfile, 'w') as ohandle:
+            ohandle.write(ihandle.readline())
+            for line in ihandle:
+                if (line.endswith('\n') and
+                        next(csv.reader([line]))[col] in seeds):
+                    ohandle.write(line)
+        os.replace(tmpfile, partfile)
+
+        return True
+
+    def close(self):
+        # Writing the last batch and giving the table its final name
+        self.flush()
+        os.replace(self.partfile, self.ofile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        # An interrupted run keeps its rows in the part file
+        if exc_type is None:
+            self.close()
+        else:
+            self.flush()
+
+
+class ParquetWriter(TableWriter):
+    '''
+    Streaming Parquet writer with a fixed set of columns
+
+    Each batch is written as a row group. The text columns in dictionary are
+    dictionary encoded and the float columns are stored as floattype. If the
+    run is interrupted the file is closed, so the written row groups can be
+    read and the run resumed.
+
+    Args:
+        ofile (str): output file path
+
+        columns (list): output columns, as in TableWriter
+
+        batchsize (int): number of rows of each row group
+
+        resume (boolean): keep the row groups of the existing part file and
+        append to it and to the checkpoint
+
+        seedsize (int): number of trees of each row group, as in TableWriter
+
+        interval (float): seconds after which the row group is written, as
+        in TableWriter
+
+        dictionary (list): columns to dictionary encode
+
+        floattype (str): type of the float columns (float64 or float32)
+
+        types (dict): arrow type name of the columns which are not floats,
+        such as string or int64, the rest are floattype. If None, the types
+        are the ones of the first batch with rows.
+
+    Raises:
+        ImportError: if pyarrow is not installed
+    '''
+
+    def __init__(self, ofile, columns=None, batchsize=50000, resume=False,
+                 seedsize=None, interval=60.0, dictionary=None,
+                 floattype='float64', types=None):
+        if pa is None:
+            raise ImportError('The Parquet output requires pyarrow.')
+
+        self.dictionary = dictionary or list()
+        self.floattype = floattype
+        self.types = types
+        self.writer = None
+        super().__init__(ofile, columns, batchsize, resume, seedsize,
+                         interval)
+
+        if resume and file_exists(self.partfile):
+            # Parquet files cannot be appended, the row groups of the
+            # previous run are copied to a new part file
+            prevfile = '%s.prev' % self.partfile
+            os.replace(self.partfile, prevfile)
+            pfile = pq.ParquetFile(prevfile)
+            self.writer = pq.ParquetWriter(self.partfile, pfile.schema_arrow)
+            for i in range(pfile.num_row_groups):
+                self.writer.write_table(pfile.read_row_group(i))
+            os.remove(prevfile)
+
+    def get_schema(self, table=None):
+        # Dictionary encoding the text columns and setting the floats type.
+        # The columns missing in types, or without a type in the batch
+        # table, are floats
+        fields = list()
+        for name in self.columns or list():
+            if name in self.dictionary:
+                ftype = pa.dictionary(pa.int32(), pa.string())
+            elif self.types is not None and name in self.types:
+                ftype = pa.type_for_alias(self.types[name])
+            elif (self.types is None and table is not None and
+                  not pa.types.is_floating(table.schema.field(name).type)):
+                ftype = table.schema.field(name).type
+            else:
+                ftype = pa.from_numpy_dtype(self.floattype)
+            fields.append(pa.field(name, ftype))
+
+        return pa.schema(fields)
+
+    def open_writer(self, table=None):
+        # Starting the part file with the schema of the table
+        self.writer = pq.ParquetWriter(self.partfile, self.get_schema(table))
+
+    def write_batch(self, odf):
+        table = pa.Table.from_pandas(odf, preserve_index=False)
+        if self.writer is None:
+            # An empty batch has null columns, so without types the schema
+            # is taken from the first batch with rows
+            if self.types is None and len(table) == 0:
+                return
+            self.open_writer(table)
+
+        table = table.cast(self.writer.schema)
+        self.writer.write_table(table, row_group_size=max(len(table), 1))
+
+    @staticmethod
+    def filter_part(partfile, seedcol, seeds):
+        '''
+        Keep the rows of a part file whose seed is in seeds
+
+        Args:
+            partfile (str): part file path
+
+            seedcol (str): column of the table with the tree seed
+
+            seeds (set): seeds to keep
+
+        Returns:
+            boolean: whether the part file could be read, files of runs
+            killed before closing them have no footer
+        '''
+
+        try:
+            pfile = pq.ParquetFile(partfile)
+        except pa.ArrowInvalid:
+            return False
+
+        tmpfile = '%s.tmp' % partfile
+        seeds = pa.array(sorted(seeds), pa.string())
+        with pq.ParquetWriter(tmpfile, pfile.schema_arrow) as writer:
+            for i in range(pfile.num_row_groups):
+                table = pfile.read_row_group(i)
+                keep = pc.is_in(table[seedcol].cast(pa.string()),
+                                value_set=seeds)
+                writer.write_table(table.filter(keep))
+        os.replace(tmpfile, partfile)
+
+        return True
+
+    def close(self):
+        # Writing the last row group and the footer, a table without rows
+        # is written with the types of its columns
+        self.flush()
+        if self.writer is None:
+            self.open_writer()
+        self.writer.close()
+        os.replace(self.partfile, self.ofile)
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        super().__exit__(exc_type, exc_value, exc_tb)
+
+        # Writing the footer of an interrupted run
+        if exc_type is not None:
+            if self.writer is None:
+                self.open_writer()
+            self.writer.close()